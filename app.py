@@ -1,14 +1,37 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify, url_for
+import click
+from flask import (Flask, Response, render_template, request, flash, redirect, session, g,
+                   jsonify, url_for, abort)
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_migrate import Migrate
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm
 from models import db, connect_db, User, Message, Follows, Likes
+from passwords import hasher, PasswordHasherBusy
+import feed
+from cache import entity_cache
+from fragments import fragments
+from jobs import jobs, run_workers
+from likecounts import like_counts
+from live import broker, TooManySubscribers
+from partitions import partitions
+from purge import purger
+import recommendations
+from timelines import timelines
+from metrics import instrumentation, stats_required
+from replicas import replicas
+import http_cache
+from http_cache import bump_viewer, cache_control, conditional
+from search import USERS_PAGE_SIZE, browse_users, search_users, autocomplete_users
+from pagination import PAGE_SIZE, decode_cursor, next_cursor, page_size
 from functools import wraps
 
 CURR_USER_KEY = "curr_user"
+MAX_LIKE_BATCH = 100
+RECONCILE_BATCH = 10000
 
 app = Flask(__name__)
 
@@ -17,13 +40,36 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 0
+# Comma-separated read replicas of DATABASE_URL; see replicas.py.
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+# Request threads (or greenlets) per worker process, as given to the
+# server; live streams may hold up to half of them. See live.py.
+app.config['LIVE_SERVER_THREADS'] = int(os.environ.get('SERVER_THREADS', 1))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+# Bearer token for /metrics and /_stats; unset, they're refused. See metrics.py.
+app.config['STATS_TOKEN'] = os.environ.get('STATS_TOKEN')
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+replicas.init_app(app)
+migrate = Migrate(app, db)
+timelines.init_app(app)
+entity_cache.init_app(app)
+fragments.init_app(app)
+like_counts.init_app(app)
+purger.init_app(app)
+partitions.init_app(app)
+jobs.init_app(app)
+broker.init_app(app)
+hasher.init_app(app)
+instrumentation.init_app(app, db.engine)
+for engine in replicas.engines:
+    instrumentation.watch(engine)
+http_cache.init_app(app)
 
 
 ##############################################################################
@@ -32,15 +78,27 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a cached snapshot; write paths use current_user_record().
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = entity_cache.user(session[CURR_USER_KEY])
+        if g.user is None:
+            # the account is gone
+            do_logout()
 
     else:
         g.user = None
 
 
+def current_user_record():
+    """The logged-in user as a live ORM object, for routes that change it."""
+
+    return User.visible().filter_by(id=g.user.id).first_or_404()
+
+
 def do_login(user):
     """Log in user."""
 
@@ -68,6 +126,79 @@ def context_processor():
     form = MessageForm()
     return dict(form=form)
 
+def feed_cursor():
+    """Decode the ?cursor= query param, 400 if it was tampered with."""
+
+    try:
+        return decode_cursor(request.args.get('cursor'))
+    except ValueError:
+        abort(400)
+
+
+def liked_ids(messages):
+    """Ids of `messages` the current user has liked, in a single query."""
+
+    if not g.user:
+        return set()
+    return Likes.message_ids_liked_by(g.user.id, [msg.id for msg in messages])
+
+
+def followed_ids(users):
+    """Ids of `users` the current user follows, in a single query."""
+
+    if not g.user:
+        return set()
+    return g.user.following_among([user.id for user in users])
+
+
+def feed_page(messages, limit, endpoint, **values):
+    """JSON page of messages: rendered items plus the cursor for the next page."""
+
+    cursor = next_cursor(messages, limit)
+    return jsonify(
+        messages=[msg.serialize() for msg in messages],
+        html=render_template('messages/items.html', messages=messages,
+                             liked=liked_ids(messages)),
+        cursor=cursor,
+        next=url_for(endpoint, cursor=cursor, **values) if cursor else None
+    )
+
+
+def profile_validator(user_id):
+    """The profile, the ids and like counts of its first page and (via the ETag) the viewer."""
+
+    user = entity_cache.user(user_id)
+    if not user:
+        return None, None
+    page = feed.like_counts_by_user(user_id, PAGE_SIZE)
+    return ((user.version(), [(message_id, likes) for message_id, likes, _ in page]),
+            page[0].timestamp if page else None)
+
+
+def home_validator():
+    """The top of the viewer's timeline with its like counts, plus deletions
+    and profile edits anywhere.
+
+    The timeline ids come from the store, not the read replica; home()
+    looks up any the replica doesn't have yet on the primary, so the page
+    always holds what this ETag promises.
+    """
+
+    if not g.user:
+        return None, None
+    stored, pulled = timelines.head(g.user.id, PAGE_SIZE)
+    return ((stored, pulled),
+            [tuple(row) for row in feed.like_counts(stored + pulled)],
+            entity_cache.version('messages'),
+            entity_cache.version('profiles'),
+            entity_cache.version('recommendations')), None
+
+
+def message_validator(message_id):
+    msg = entity_cache.message(message_id)
+    return msg, msg and msg.timestamp
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     # note that we set the 404 status explicitly
@@ -78,6 +209,12 @@ def resource_not_found(e):
     # note that we set the 405 status explicitly
     return render_template('405.html'), 405
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    """Too many logins/signups at once: shed load instead of queueing."""
+    flash("We're very busy right now, please try again in a moment.", "danger")
+    return render_template('users/login.html', user_form=LoginForm()), 503
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -129,6 +266,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # saves the password hash if authenticate() upgraded its cost
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -159,29 +298,52 @@ def list_users():
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users = browse_users(after=request.args.get('after', type=int))
+        next_url = (url_for('list_users', after=users[-1].id)
+                    if len(users) == USERS_PAGE_SIZE else None)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = request.args.get('page', 1, type=int)
+        users, has_next = search_users(search, page)
+        next_url = url_for('list_users', q=search, page=page + 1) if has_next else None
+
+    return render_template('users/index.html', users=users, following=followed_ids(users),
+                           next_url=next_url)
 
-    return render_template('users/index.html', users=users)
+
+@app.route('/users/autocomplete')
+@cache_control(public=True, max_age=30)
+def autocomplete():
+    """Usernames starting with 'q' as JSON, for the search box."""
+
+    rows = autocomplete_users(request.args.get('q', ''))
+    return jsonify(users=[dict(id=id, username=username, image_url=image_url)
+                          for id, username, image_url in rows])
 
 
 @app.route('/users/<int:user_id>', methods=["GET","POST"])
+@conditional(profile_validator)
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
-    
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    user = entity_cache.user(user_id) or abort(404)
+    messages = feed.by_user(user_id, PAGE_SIZE)
+    cursor = next_cursor(messages, PAGE_SIZE)
+    next_url = url_for('users_messages', user_id=user_id, cursor=cursor) if cursor else None
 
-    return render_template('users/show.html', user=user, messages=messages)
+    return render_template('users/show.html', user=user, messages=messages,
+                           liked=liked_ids(messages), following=followed_ids([user]),
+                           next_url=next_url)
+
+
+@app.route('/users/<int:user_id>/messages')
+def users_messages(user_id):
+    """Next page of a user's messages as JSON (infinite scroll)."""
+
+    entity_cache.user(user_id) or abort(404)
+    limit = page_size(request.args.get('limit'))
+    messages = feed.by_user(user_id, limit, feed_cursor())
+
+    return feed_page(messages, limit, 'users_messages', user_id=user_id)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -189,8 +351,10 @@ def users_show(user_id):
 def show_following(user_id):
     """Show list of people this user is following."""
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = entity_cache.user(user_id) or abort(404)
+    users = User.following_of(user_id)
+    return render_template('users/following.html', user=user, users=users,
+                           following=followed_ids(users + [user]))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -198,8 +362,10 @@ def show_following(user_id):
 def users_followers(user_id):
     """Show list of followers of this user."""
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = entity_cache.user(user_id) or abort(404)
+    users = User.followers_of(user_id)
+    return render_template('users/followers.html', user=user, users=users,
+                           following=followed_ids(users + [user]))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -207,9 +373,13 @@ def users_followers(user_id):
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = User.visible().filter_by(id=follow_id).first_or_404()
+    current_user_record().follow(followed_user)
     db.session.commit()
+    entity_cache.invalidate_user(g.user.id, follow_id)
+    bump_viewer(g.user.id)
+    timelines.follow(g.user.id, follow_id)
+    broker.publish_follow(g.user.id, follow_id, True)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -220,8 +390,12 @@ def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
     followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    current_user_record().unfollow(followed_user)
     db.session.commit()
+    entity_cache.invalidate_user(g.user.id, follow_id)
+    bump_viewer(g.user.id)
+    timelines.unfollow(g.user.id, follow_id)
+    broker.publish_follow(g.user.id, follow_id, False)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -230,21 +404,24 @@ def stop_following(follow_id):
 @login_required
 def profile():
     """Update profile for current user."""
-    form = UserAddForm(obj=g.user)
+    me = current_user_record()
+    form = UserAddForm(obj=me)
 
     if form.validate_on_submit():
 
         user = User.authenticate(form.username.data,form.password.data)
         """update all fields, correct password needs to be entered to update"""
         if user:
-            g.user.username = form.username.data
-            g.user.email = form.email.data
-            g.user.image_url = form.image_url.data
-            g.user.header_image_url = form.header_image_url.data,
-            g.user.location = form.location.data,
-            g.user.bio = form.bio.data
+            me.username = form.username.data
+            me.email = form.email.data
+            me.image_url = form.image_url.data
+            me.header_image_url = form.header_image_url.data,
+            me.location = form.location.data,
+            me.bio = form.bio.data
             db.session.commit()
-            return redirect(f'/users/{g.user.id}')
+            entity_cache.invalidate_user(me.id)
+            entity_cache.bump_version('profiles')
+            return redirect(f'/users/{me.id}')
 
         flash("Invalid password", 'danger')
         return redirect('/')
@@ -254,11 +431,22 @@ def profile():
 @app.route('/users/delete', methods=["POST"])
 @login_required
 def delete_user():
-    """Delete user."""    
+    """Delete user.
+
+    The account and its messages are hidden right away; purge.py deletes
+    them and their follows and likes in the background.
+    """
     do_logout()
 
-    db.session.delete(g.user)
+    me = current_user_record()
+    me.soft_delete()
     db.session.commit()
+    # the user's cached messages disappear with them: message
+    # snapshots are only served while their author is cached
+    entity_cache.invalidate_user(g.user.id)
+    entity_cache.bump_version('profiles')
+    entity_cache.bump_version('messages')
+    purger.schedule()
 
     return redirect("/signup")
 
@@ -266,34 +454,67 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET","POST"])
+@app.route('/messages/new', methods=["POST"])
 @login_required
 def messages_add():
-    """Create a message on the front end(modal window) and save it in the database"""
-    text = request.json["text"]
-    msg = Message(text=text)
-    g.user.messages.append(msg)
+    """Create a message from the modal window.
+
+    script.js posts JSON and gets back the new message plus its rendered
+    <li> to put at the top of #messages, or {"errors": {field: [...]}}
+    with a 400. A plain form post redirects to the user's profile.
+    """
+
+    form = MessageForm()
+
+    if not form.validate():
+        if request.is_json:
+            return jsonify(errors=form.errors), 400
+        for error in form.text.errors:
+            flash(error, "danger")
+        return redirect("/")
+
+    msg = Message(text=form.text.data)
+    current_user_record().add_message(msg)
     db.session.commit()
+    entity_cache.invalidate_user(g.user.id)
+    timelines.fanout(msg)
 
-    return (jsonify(message=msg.serialize()), 201)
+    item = feed.FeedMessage.of(msg, g.user)
+    broker.publish_message(item.user_id, item.id, fragments.render_one(item))
+
+    if not request.is_json:
+        return redirect(f"/users/{g.user.id}")
+
+    return jsonify(message=item.serialize(),
+                   html=render_template('messages/items.html', messages=[item],
+                                        liked=set())), 201
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@conditional(message_validator)
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = entity_cache.message(message_id) or abort(404)
     return render_template('messages/show.html', message=msg)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
 @login_required
 def messages_destroy(message_id):
-    """Delete a message."""
+    """Delete a message (hidden now, purged in the background)."""
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    msg = (Message.visible()
+           .filter(Message.id == message_id, Message.user_id == g.user.id)
+           .first_or_404())
+    msg.soft_delete()
     db.session.commit()
+    timelines.retract(msg)
+    entity_cache.invalidate_message(message_id)
+    entity_cache.invalidate_user(msg.user_id)
+    fragments.invalidate_message(message_id)
+    entity_cache.bump_version('messages')
+    purger.schedule()
 
     return redirect(f"/users/{g.user.id}")
 
@@ -302,52 +523,156 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 @app.route('/')
+@conditional(home_validator)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: first page of the most recent messages of followed_users,
+      read from the precomputed timeline store; more pages come from
+      /messages/feed as the user scrolls
     """
 
     if g.user:
-        following = [user.id for user in g.user.following]
-        messages = (Message
-                   .query
-                   .filter(Message.user_id.in_(following))
-                   .order_by(Message.timestamp.desc())
-                   .limit(100)
-                   .all())
-        
-        return render_template('home.html', messages=messages)
+        messages = timelines.home(g.user.id, limit=PAGE_SIZE)
+        cursor = next_cursor(messages, PAGE_SIZE)
+        next_url = url_for('home_feed', cursor=cursor) if cursor else None
+
+        return render_template('home.html', messages=messages,
+                               liked=liked_ids(messages), next_url=next_url,
+                               suggestions=recommendations.who_to_follow(g.user.id))
 
     else:
         return render_template('home-anon.html')
 
+
+@app.route('/messages/feed')
+@login_required
+def home_feed():
+    """Next page of the home timeline as JSON (infinite scroll)."""
+
+    limit = page_size(request.args.get('limit'))
+    messages = timelines.home(g.user.id, limit=limit, before=feed_cursor())
+
+    return feed_page(messages, limit, 'home_feed')
+
+
+@app.route('/messages/stream')
+@login_required
+def home_stream():
+    """New messages from followed users as Server-Sent Events.
+
+    Each `message` event carries the id and pre-rendered <li> of a warble
+    posted after the stream opened; `resync` means events were dropped and
+    the page should be reloaded. A stream holds a request thread while
+    open, so each worker streams to at most LIVE_MAX_SUBSCRIBERS clients
+    and answers 503 beyond that. See live.py.
+    """
+
+    following = [followed for (followed,) in (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == g.user.id))]
+    try:
+        sub = broker.subscribe(g.user.id, following)
+    except TooManySubscribers:
+        abort(503)
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            yield from sub.events(broker.heartbeat)
+        finally:
+            broker.unsubscribe(sub)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def set_likes(like_ids, unlike_ids):
+    """Like and unlike messages as the current user, in one transaction.
+
+    Returns how many likes actually changed.
+    """
+
+    added = Likes.add(g.user.id, like_ids)
+    removed = Likes.remove(g.user.id, unlike_ids)
+    if len(added) != len(removed):
+        User.bump_counts(g.user.id, likes_count=len(added) - len(removed))
+    db.session.commit()
+
+    if added or removed:
+        entity_cache.invalidate_user(g.user.id)
+        bump_viewer(g.user.id)
+    for message_id in added:
+        like_counts.add(message_id, 1)
+    for message_id in removed:
+        like_counts.add(message_id, -1)
+    return len(added) + len(removed)
+
+
 @app.route('/users/add_like/<int:message_id>', methods=["POST","DELETE"])
 @login_required
 def like_unlike_post(message_id):
-    """Add/Delete liked messages"""
-    
-    message = Message.query.get(message_id)
-    if message not in g.user.likes:
-        like = Likes(user_id=message.user_id,message_id=message_id)
-        g.user.likes.append(message)
-        db.session.commit()
-        serialized = like.serialize()
-        like = Likes.query.filter(Likes.message_id == message_id).first()
-        return jsonify(like=serialized), 201
-    else:
-        like = Likes.query.filter(Likes.message_id == message_id).first()
-        db.session.delete(like)
-        db.session.commit()
-        return jsonify(message="Deleted")
-    return render_template('home.html')
+    """Like (POST) or unlike (DELETE) a message; repeating either changes nothing."""
+
+    if request.method == 'POST':
+        entity_cache.message(message_id) or abort(404)
+        changed = set_likes([message_id], [])
+        return jsonify(message_id=message_id, liked=True), 201 if changed else 200
+
+    set_likes([], [message_id])
+    return jsonify(message_id=message_id, liked=False)
+
+
+@app.route('/users/likes', methods=["POST"])
+@login_required
+def batch_likes():
+    """Apply queued like toggles from script.js in one request.
+
+    The body is {"likes": {"<message_id>": true or false, ...}} with the
+    state each message should end up in.
+    """
+
+    body = request.get_json(silent=True)
+    likes = body.get('likes') if isinstance(body, dict) else None
+    if not isinstance(likes, dict) or len(likes) > MAX_LIKE_BATCH:
+        abort(400)
+    try:
+        states = {int(message_id): bool(liked) for message_id, liked in likes.items()}
+    except ValueError:
+        abort(400)
+
+    wanted = [message_id for message_id, liked in states.items() if liked]
+    unwanted = sorted(message_id for message_id, liked in states.items() if not liked)
+    existing = sorted(message_id for (message_id,) in (Message
+                      .visible()
+                      .with_entities(Message.id)
+                      .filter(Message.id.in_(wanted)))) if wanted else []
+
+    set_likes(existing, unwanted)
+    return jsonify(liked=existing, unliked=unwanted,
+                   missing=sorted(set(wanted) - set(existing)))
 
 @app.route('/messages/liked')
+@login_required
 def liked_posts():
     """Will diplay only liked messages of the users the authorized user follows"""
-    # not_signed_in()
-    return render_template('home.html',messages=g.user.likes)
+    messages = feed.liked_by(g.user.id, PAGE_SIZE)
+    cursor = next_cursor(messages, PAGE_SIZE)
+    next_url = url_for('liked_feed', cursor=cursor) if cursor else None
+
+    return render_template('home.html', messages=messages,
+                           liked={msg.id for msg in messages}, next_url=next_url)
+
+
+@app.route('/messages/liked/feed')
+@login_required
+def liked_feed():
+    """Next page of liked messages as JSON (infinite scroll)."""
+
+    limit = page_size(request.args.get('limit'))
+    messages = feed.liked_by(g.user.id, limit, feed_cursor())
+
+    return feed_page(messages, limit, 'liked_feed')
 
 
     
@@ -356,18 +681,94 @@ def liked_posts():
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Maintenance commands and stats
+
+@app.route('/_stats/cache')
+@stats_required
+def cache_stats():
+    """Entity and fragment cache hit/miss counters and live stream counts
+    for this worker, as JSON."""
+
+    return jsonify(dict(entity_cache.stats(), fragments=fragments.stats(),
+                        live=broker.stats()))
+
+
+@app.route('/_stats/jobs')
+@stats_required
+def job_stats():
+    """Background job queue depth and recent wait/run times, as JSON."""
+
+    return jsonify(jobs.stats())
+
+
+@app.cli.command('repair-counts')
+@jobs.task('repair-counts', max_attempts=1)
+def repair_counts():
+    """Recompute the denormalized user counters from the base tables."""
+
+    User.repair_counts()
+    db.session.commit()
+    print("User counters repaired.")
+
+
+@app.cli.command('purge-deleted')
+@jobs.task('purge-deleted')
+def purge_deleted():
+    """Finish removing soft-deleted users and messages, reporting each batch."""
+
+    finished = purger.run(progress=lambda purge_id, rows:
+                          print(f"purge {purge_id}: {rows} rows deleted"))
+    print(f"{finished} purges finished.")
+
+
+@app.cli.command('reconcile-like-counts')
+@jobs.task('reconcile-like-counts', max_attempts=1)
+def reconcile_like_counts():
+    """Recompute every message's like_count from the likes table, in id ranges."""
+
+    like_counts.flush()
+    last_id = db.session.query(func.max(Message.id)).scalar() or 0
+    for first_id in range(1, last_id + 1, RECONCILE_BATCH):
+        Message.repair_like_counts(first_id, first_id + RECONCILE_BATCH - 1)
+        db.session.commit()
+    print("Message like counts reconciled.")
+
+
+@app.cli.command('recommend-follows')
+@jobs.task('recommend-follows', max_attempts=1)
+def recommend_follows():
+    """Recompute who-to-follow suggestions for every user from the follow graph."""
+
+    stats = recommendations.refresh(
+        db.engine,
+        per_user=app.config.setdefault('RECOMMENDATIONS_PER_USER', recommendations.PER_USER),
+        block_rows=app.config.setdefault('RECOMMEND_BLOCK_ROWS', recommendations.BLOCK_ROWS),
+        follows_you_weight=app.config.setdefault('RECOMMEND_FOLLOWS_YOU_WEIGHT',
+                                                 recommendations.FOLLOWS_YOU_WEIGHT))
+    entity_cache.bump_version('recommendations')
+    print(f"{stats['recommendations']} recommendations for {stats['users']} users "
+          f"({stats['edges']} follows) in {stats['total_seconds']}s.")
+
+
+@app.cli.command('rollover-messages')
+@jobs.task('rollover-messages', max_attempts=1)
+def rollover_messages():
+    """Create upcoming monthly partitions of messages and archive expired ones."""
+
+    done = partitions.rollover()
+    if done['messages']:
+        entity_cache.bump_version('messages')
+    for name in done['created']:
+        print(f"created {name}")
+    for name in done['archived']:
+        print(f"archived {name}")
+    print(f"{done['messages']} messages archived.")
+
+
+@app.cli.command('jobs-worker')
+@click.option('--threads', default=1, help="worker threads per process")
+@click.option('--processes', default=1, help="worker processes")
+def jobs_worker(threads, processes):
+    """Run queued background jobs (see jobs.py) until interrupted."""
+
+    run_workers(jobs, threads=threads, processes=processes)
@@ -0,0 +1,82 @@
+"""Benchmarks for Warbler's hot paths.
+
+Run them from the repository root, e.g.:
+
+    python -m benchmarks.feed_queries
+
+Each benchmark builds its own synthetic dataset, so point BENCH_DATABASE_URL
+at a throwaway database; it defaults to a SQLite file in the temp dir.
+Never point it at a database you care about: its tables are dropped.
+"""
+
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCH_DATABASE_URL = os.environ.get(
+    'BENCH_DATABASE_URL',
+    'sqlite:///' + os.path.join(tempfile.gettempdir(), 'warbler-bench.db'))
+
+# like the tests: pick the database before the app is imported
+os.environ['DATABASE_URL'] = BENCH_DATABASE_URL
+
+from app import app
+from models import db, User, Message, Follows
+
+# bcrypt hash of "password", as in generator/users.csv
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+
+def seed(num_users=500, num_messages=20000, follows_per_user=50, seed=1):
+    """Drop and recreate the schema, then fill it with synthetic rows."""
+
+    rng = random.Random(seed)
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, [
+        dict(id=i, email=f"user{i}@bench.test", username=f"user{i}",
+             image_url=f"/static/images/default-pic.png", password=PASSWORD_HASH)
+        for i in range(1, num_users + 1)
+    ])
+
+    now = datetime.utcnow()
+    db.session.bulk_insert_mappings(Message, [
+        dict(text=f"warble {i}", user_id=rng.randint(1, num_users),
+             timestamp=now - timedelta(seconds=rng.randint(0, 86400 * 365)))
+        for i in range(num_messages)
+    ])
+
+    follows = set()
+    for follower in range(1, num_users + 1):
+        for followed in rng.sample(range(1, num_users + 1), min(follows_per_user, num_users)):
+            if followed != follower:
+                follows.add((followed, follower))
+    db.session.bulk_insert_mappings(Follows, [
+        dict(user_being_followed_id=followed, user_following_id=follower)
+        for followed, follower in follows
+    ])
+
+    User.repair_counts()
+    db.session.commit()
+
+
+def percentile(samples, pct):
+    """The `pct` percentile of a list of numbers (nearest rank)."""
+
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def timed(fn, repeat):
+    """Call `fn` `repeat` times; return the list of durations in ms."""
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
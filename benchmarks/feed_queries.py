@@ -0,0 +1,94 @@
+"""Compare the old ORM timeline read with the feed.py projection.
+
+    python -m benchmarks.feed_queries [--messages 100] [--repeat 50]
+
+For one 100-message home timeline it reports SQL statements, latency and
+peak Python memory of:
+
+- orm:  Message.query ... .all(), then msg.user.* per message (lazy loads)
+- feed: feed.by_authors(), one joined column-only query into FeedMessages
+"""
+
+import argparse
+import tracemalloc
+
+from sqlalchemy import event
+
+from benchmarks import app, db, seed, percentile, timed
+import feed
+from models import Message, Follows
+
+
+def render_fields(messages):
+    """Touch what users_messages.html touches for each message."""
+
+    for msg in messages:
+        (msg.id, msg.text, msg.timestamp, msg.user.id, msg.user.username, msg.user.image_url)
+
+
+def orm_path(following, limit):
+    messages = (Message
+                .query
+                .filter(Message.user_id.in_(following))
+                .order_by(Message.timestamp.desc())
+                .limit(limit)
+                .all())
+    render_fields(messages)
+
+
+def feed_path(following, limit):
+    render_fields(feed.by_authors(following, limit))
+
+
+def measure(fn, repeat):
+    """Statements per call, latency percentiles and peak memory for `fn`."""
+
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    def run():
+        fn()
+        # start every call with an empty identity map, like a new request
+        db.session.remove()
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    run()
+    event.remove(db.engine, 'before_cursor_execute', count)
+
+    samples = timed(run, repeat)
+
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return dict(statements=len(statements),
+                p50_ms=round(percentile(samples, 50), 2),
+                p95_ms=round(percentile(samples, 95), 2),
+                peak_kb=round(peak / 1024, 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--rows', type=int, default=20000, help="messages to seed")
+    parser.add_argument('--messages', type=int, default=100, help="timeline length")
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(num_users=args.users, num_messages=args.rows)
+        following = [followed for (followed,) in (db.session
+                     .query(Follows.user_being_followed_id)
+                     .filter(Follows.user_following_id == 1))]
+
+        print(f"{args.messages}-message timeline, following {len(following)} users")
+        for name, fn in [('orm', orm_path), ('feed', feed_path)]:
+            result = measure(lambda: fn(following, args.messages), args.repeat)
+            print(f"{name:>5}: " + ", ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Render time of a timeline's message items, with and without fragments.py.
+
+    python -m benchmarks.fragment_render [--messages 100] [--repeat 200]
+
+Renders messages/items.html for one --messages long timeline and reports
+p50/p95 latency for:
+
+- loop: the items rendered in a Jinja loop on every request (the old items.html)
+- cold: message_items() with an empty fragment cache (every item a miss)
+- warm: message_items() with every item already cached
+"""
+
+import argparse
+
+from flask import g, render_template
+
+from benchmarks import app, db, seed, percentile, timed
+import feed
+from cache import entity_cache
+from fragments import fragments
+from models import Follows, Likes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--rows', type=int, default=20000, help="messages to seed")
+    parser.add_argument('--messages', type=int, default=100, help="timeline length")
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(num_users=args.users, num_messages=args.rows)
+        following = [followed for (followed,) in (db.session
+                     .query(Follows.user_being_followed_id)
+                     .filter(Follows.user_following_id == 1))]
+        messages = feed.by_authors(following, args.messages)
+        liked = {msg.id for msg in messages[::3]}
+        db.session.bulk_insert_mappings(Likes, [dict(user_id=1, message_id=message_id)
+                                                for message_id in liked])
+        db.session.commit()
+
+        with app.test_request_context('/'):
+            g.user = entity_cache.user(1)
+
+            # the old items.html: the item markup inline in a loop
+            item_source = app.jinja_loader.get_source(app.jinja_env, 'messages/item.html')[0]
+            loop_template = app.jinja_env.from_string(
+                "{% for msg in messages %}"
+                "{% set own = msg.user_id == g.user.id %}{% set liked = msg.id in liked_ids %}"
+                + item_source + "{% endfor %}")
+
+            def loop():
+                loop_template.render(messages=messages, liked_ids=liked, g=g)
+
+            def cold():
+                fragments.clear()
+                render_template('messages/items.html', messages=messages, liked=liked)
+
+            def warm():
+                render_template('messages/items.html', messages=messages, liked=liked)
+
+            print(f"{len(messages)}-item timeline")
+            for name, fn in [('loop', loop), ('cold', cold), ('warm', warm)]:
+                fn()
+                samples = timed(fn, args.repeat)
+                print(f"{name:>5}: p50_ms={percentile(samples, 50):.3f}, "
+                      f"p95_ms={percentile(samples, 95):.3f}")
+
+
+if __name__ == '__main__':
+    main()
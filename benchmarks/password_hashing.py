@@ -0,0 +1,53 @@
+"""Login throughput per worker at different bcrypt costs.
+
+    python -m benchmarks.password_hashing [--rounds 8 10 12] [--threads 4]
+
+Simulates a login burst: --logins concurrent password checks are pushed
+through passwords.PasswordHasher from --clients request threads, and
+the logins/second one worker sustains is reported for each cost. Checks
+turned away by admission control are counted separately.
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passwords import PasswordHasher, PasswordHasherBusy
+
+
+def burst(hasher, hashed, logins, clients):
+    """Run `logins` password checks from `clients` threads; (ok, rejected, seconds)."""
+
+    def login(_):
+        try:
+            return hasher.check(hashed, "password")
+        except PasswordHasherBusy:
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+
+    return results.count(True), results.count(None), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, nargs='+', default=[8, 10, 12])
+    parser.add_argument('--threads', type=int, default=4, help="hashing threads")
+    parser.add_argument('--queue', type=int, default=32, help="admission queue")
+    parser.add_argument('--clients', type=int, default=16, help="request threads")
+    parser.add_argument('--logins', type=int, default=64)
+    args = parser.parse_args()
+
+    for rounds in args.rounds:
+        hasher = PasswordHasher(rounds=rounds, threads=args.threads, queue=args.queue)
+        hashed = hasher.hash("password")
+        ok, rejected, elapsed = burst(hasher, hashed, args.logins, args.clients)
+        print(f"cost {rounds:>2}: {ok / elapsed:8.1f} logins/s per worker, "
+              f"{elapsed / max(ok, 1) * 1000:7.1f} ms/login, {rejected} rejected")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Runtime and memory of the who-to-follow computation on a large graph.
+
+    python -m benchmarks.recommendations [--users 500000] [--edges 5000000]
+
+Builds a synthetic follow graph in memory (followers picked uniformly,
+followed accounts drawn from a power law so a few are very popular),
+then runs recommendations.recommend() over all of it and reports, per
+phase, wall time and peak memory allocated (tracemalloc, which sees
+NumPy/SciPy buffers), plus the process's max RSS. The database isn't
+involved: this is the part of `flask recommend-follows` that grows with
+the graph; loading and writing rows are bounded by the database.
+"""
+
+import argparse
+import resource
+import time
+import tracemalloc
+
+import numpy as np
+
+import recommendations
+
+
+def synthetic_graph(users, edges, skew, seed):
+    """(ids, A) with about `edges` distinct follows among `users` users."""
+
+    rng = np.random.default_rng(seed)
+    followers = rng.integers(0, users, edges)
+    followed = (users * rng.random(edges) ** skew).astype(np.int64)
+    ids = np.arange(1, users + 1, dtype=np.int64)
+
+    A = recommendations.adjacency(ids, ids[followers], ids[followed])
+    A.setdiag(0)
+    A.eliminate_zeros()
+    A.data[:] = 1
+    return ids, A
+
+
+def measure(fn):
+    """(result, seconds, peak MB allocated) of calling `fn`."""
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=500000)
+    parser.add_argument('--edges', type=int, default=5000000)
+    parser.add_argument('--skew', type=float, default=2.0,
+                        help="power-law exponent for picking followed accounts")
+    parser.add_argument('--per-user', type=int, default=recommendations.PER_USER)
+    parser.add_argument('--block-rows', type=int, default=recommendations.BLOCK_ROWS)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    (ids, A), build_s, build_mb = measure(
+        lambda: synthetic_graph(args.users, args.edges, args.skew, args.seed))
+    print(f"graph: {len(ids)} users, {A.nnz} follows, max followers "
+          f"{int(np.bincount(A.indices).max())}: {build_s:.1f}s, peak {build_mb:.0f} MB")
+
+    def run():
+        written = 0
+        for *_, rank in recommendations.recommend(A, args.per_user, args.block_rows):
+            written += len(rank)
+        return written
+
+    written, run_s, run_mb = measure(run)
+    print(f"recommend: {written} suggestions, {run_s:.1f}s "
+          f"({len(ids) / run_s:.0f} users/s), peak {run_mb:.0f} MB "
+          f"with --block-rows {args.block_rows}")
+    print(f"max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
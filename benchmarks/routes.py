@@ -0,0 +1,288 @@
+"""Load test the main routes with concurrent simulated sessions.
+
+    python -m benchmarks.routes [--sessions 8] [--requests 200] [--output run.json]
+    python -m benchmarks.routes --url http://127.0.0.1:5000 --skip-seed
+    python -m benchmarks.routes --compare before.json after.json
+
+Each session logs in as a random seeded user and loops over a weighted
+mix of /, /users, /users/<id>, /users/<id>/followers, POST /messages/new
+and POST /users/add_like/<id>. By default requests go through the WSGI
+app in this process; with --url they go over HTTP to a running server
+(seed the server's database first, e.g. by running once without --url
+and the same BENCH_DATABASE_URL).
+
+Per route it reports p50/p95/p99 latency, requests/second, errors and,
+in-process only, SQL statements per request. --output writes the same
+numbers as JSON; --compare prints the change between two such files.
+"""
+
+import argparse
+import http.cookiejar
+import json
+import platform
+import random
+import re
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import event
+
+from benchmarks import app, db, seed, percentile, BENCH_DATABASE_URL
+from app import CURR_USER_KEY
+from models import User, Message
+
+# route name -> relative weight in the mix
+MIX = {
+    'home': 30,
+    'users': 10,
+    'user_profile': 20,
+    'followers': 10,
+    'new_message': 10,
+    'like': 20,
+}
+
+
+class Session:
+    """One simulated logged-in user."""
+
+    def __init__(self, rng, user_id, num_users, message_ids):
+        self.rng = rng
+        self.user_id = user_id
+        self.num_users = num_users
+        self.message_ids = message_ids
+
+    def next_request(self):
+        """(route name, method, path, json body) of a random request from MIX."""
+
+        name = self.rng.choices(list(MIX), weights=list(MIX.values()))[0]
+        other = self.rng.randint(1, self.num_users)
+
+        if name == 'home':
+            return name, 'GET', '/', None
+        if name == 'users':
+            return name, 'GET', '/users', None
+        if name == 'user_profile':
+            return name, 'GET', f'/users/{other}', None
+        if name == 'followers':
+            return name, 'GET', f'/users/{other}/followers', None
+        if name == 'new_message':
+            return name, 'POST', '/messages/new', {'text': f"bench warble {self.rng.random()}"}
+        return name, 'POST', f'/users/add_like/{self.rng.choice(self.message_ids)}', None
+
+
+class WSGIClient:
+    """Requests through app.test_client(), counting SQL statements per request."""
+
+    statements = threading.local()
+
+    def __init__(self, user_id):
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    @classmethod
+    def install(cls):
+        # sessions are faked, so there is no CSRF token to send
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        def count(*args):
+            cls.statements.count = getattr(cls.statements, 'count', 0) + 1
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+
+    def request(self, method, path, body):
+        """(status, statement count) of one request."""
+
+        self.statements.count = 0
+        resp = self.client.open(path, method=method, json=body)
+        return resp.status_code, self.statements.count
+
+
+class HTTPClient:
+    """Requests over HTTP to a running server, logged in through /login."""
+
+    def __init__(self, base_url, username, password):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+        page = self.opener.open(self.base_url + '/login').read().decode()
+        token = re.search(r'name="csrf_token"[^>]*value="([^"]+)"', page)
+        form = dict(username=username, password=password)
+        if token:
+            form['csrf_token'] = token.group(1)
+        page = self.opener.open(self.base_url + '/login',
+                                urllib.parse.urlencode(form).encode()).read().decode()
+
+        # JSON posts from the page carry the CSRF token of the logged-in session
+        token = re.search(r'name="csrf_token"[^>]*value="([^"]+)"', page)
+        self.csrf_token = token.group(1) if token else None
+
+    def request(self, method, path, body):
+        if body is not None and self.csrf_token:
+            body = dict(body, csrf_token=self.csrf_token)
+        data = json.dumps(body).encode() if body is not None else b''
+        req = urllib.request.Request(self.base_url + path, method=method, data=data,
+                                     headers={'Content-Type': 'application/json'})
+        try:
+            with self.opener.open(req) as resp:
+                resp.read()
+                return resp.status, None
+        except urllib.error.HTTPError as err:
+            return err.code, None
+
+
+def run_session(make_client, session, requests, results, lock):
+    client = make_client(session.user_id)
+    samples = []
+    for _ in range(requests):
+        name, method, path, body = session.next_request()
+        start = time.perf_counter()
+        try:
+            status, statements = client.request(method, path, body)
+        except Exception:
+            status, statements = None, None
+        samples.append((name, (time.perf_counter() - start) * 1000, status, statements))
+
+    with lock:
+        results.extend(samples)
+
+
+def summarize(samples, elapsed):
+    """Latency, throughput, error and SQL numbers for a list of samples."""
+
+    latencies = [ms for _, ms, _, _ in samples]
+    statements = [count for _, _, _, count in samples if count is not None]
+    errors = sum(1 for _, _, status, _ in samples if status is None or status >= 400)
+
+    return dict(
+        requests=len(samples),
+        errors=errors,
+        rps=round(len(samples) / elapsed, 1),
+        p50_ms=round(percentile(latencies, 50), 2),
+        p95_ms=round(percentile(latencies, 95), 2),
+        p99_ms=round(percentile(latencies, 99), 2),
+        sql_per_request=round(sum(statements) / len(statements), 2) if statements else None,
+        sql_p95=percentile(statements, 95) if statements else None,
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_path, after_path):
+    """Print the change in each route's numbers between two --output files."""
+
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    print(f"{before['meta']['commit']} -> {after['meta']['commit']}")
+    keys = ['rps', 'p50_ms', 'p95_ms', 'p99_ms', 'sql_per_request', 'errors']
+    for route in after['routes']:
+        old, new = before['routes'].get(route, {}), after['routes'][route]
+        changes = []
+        for key in keys:
+            if old.get(key) is None or new.get(key) is None:
+                continue
+            delta = f" ({(new[key] - old[key]) / old[key]:+.0%})" if old[key] else ""
+            changes.append(f"{key} {old[key]} -> {new[key]}{delta}")
+        print(f"{route:>13}: " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--follows-per-user', type=int, default=50)
+    parser.add_argument('--sessions', type=int, default=8, help="concurrent sessions")
+    parser.add_argument('--requests', type=int, default=200, help="requests per session")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--url', help="drive a running server instead of the WSGI app")
+    parser.add_argument('--skip-seed', action='store_true', help="reuse the existing dataset")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help="compare two --output files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        if not args.skip_seed:
+            seed(num_users=args.users, num_messages=args.messages,
+                 follows_per_user=args.follows_per_user, seed=args.seed)
+        users = dict(db.session.query(User.id, User.username))
+        message_ids = [message_id for (message_id,) in db.session.query(Message.id)]
+
+    if args.url:
+        def make_client(user_id):
+            return HTTPClient(args.url, users[user_id], 'password')
+    else:
+        WSGIClient.install()
+
+        def make_client(user_id):
+            return WSGIClient(user_id)
+
+    sessions = [Session(random.Random(rng.random()), rng.choice(list(users)), len(users),
+                        message_ids)
+                for _ in range(args.sessions)]
+
+    results, lock = [], threading.Lock()
+    threads = [threading.Thread(target=run_session,
+                                args=(make_client, session, args.requests, results, lock))
+               for session in sessions]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    by_route = defaultdict(list)
+    for sample in results:
+        by_route[sample[0]].append(sample)
+
+    report = dict(
+        meta=dict(
+            commit=git_commit(),
+            started=datetime.utcnow().isoformat(timespec='seconds'),
+            target=args.url or 'wsgi',
+            database=None if args.url else BENCH_DATABASE_URL.split(':')[0],
+            python=platform.python_version(),
+            users=len(users),
+            messages=len(message_ids),
+            follows_per_user=args.follows_per_user,
+            sessions=args.sessions,
+            requests_per_session=args.requests,
+            seconds=round(elapsed, 2),
+        ),
+        total=summarize(results, elapsed),
+        routes={name: summarize(by_route[name], elapsed) for name in MIX if by_route[name]},
+    )
+
+    for name, numbers in [('total', report['total'])] + list(report['routes'].items()):
+        print(f"{name:>13}: " + ", ".join(f"{key}={value}" for key, value in numbers.items()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
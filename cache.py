@@ -0,0 +1,265 @@
+"""Read-through cache of User and Message snapshots, keyed by id.
+
+`add_user_to_g` and the profile/message routes read hot users and messages
+from here instead of the database. Snapshots are plain read-only objects;
+write paths load the ORM row themselves and call `invalidate_*` once they
+have committed.
+
+Backends are pluggable: an in-process LRU (default, also used in tests)
+or Redis when ENTITY_CACHE_REDIS_URL is set.
+"""
+
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import feed
+from models import db, User, Message, MessageArchive, Follows
+from replicas import replicas
+
+CACHE_SIZE = 10000
+CACHE_TTL = 300
+
+
+class UserSnapshot:
+    """The public columns of a User, without its relationships."""
+
+    FIELDS = ('id', 'email', 'username', 'image_url', 'header_image_url', 'bio',
+              'location', 'messages_count', 'followers_count', 'following_count',
+              'likes_count')
+
+    __slots__ = FIELDS
+
+    def __init__(self, **values):
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field))
+
+    @classmethod
+    def of(cls, user):
+        return cls(**{field: getattr(user, field) for field in cls.FIELDS})
+
+    def __getstate__(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __setstate__(self, state):
+        for field in self.FIELDS:
+            setattr(self, field, state.get(field))
+
+    def __eq__(self, other):
+        return isinstance(other, (UserSnapshot, User)) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"<UserSnapshot #{self.id}: {self.username}>"
+
+    def version(self):
+        """Every field, for use in HTTP validators: changes whenever the user does."""
+
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def is_following(self, other_user):
+        return Follows.exists(follower_id=self.id, followed_id=other_user.id)
+
+    def is_followed_by(self, other_user):
+        return Follows.exists(follower_id=other_user.id, followed_id=self.id)
+
+    def following_among(self, user_ids):
+        return Follows.followed_among(self.id, user_ids)
+
+
+class LRUBackend:
+    """Bounded in-process cache with least-recently-used eviction and a TTL."""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (value, time.monotonic() + self.ttl)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class RedisBackend:
+    """Cache shared between workers. `client` has the redis-py API (or fakeredis).
+
+    Redis does the eviction (configure maxmemory-policy allkeys-lru); keys
+    expire after the TTL.
+    """
+
+    def __init__(self, client, ttl=CACHE_TTL, prefix="entity:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.evictions = 0
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value):
+        self.client.setex(self.prefix + key, self.ttl, pickle.dumps(value))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(f"{self.prefix}*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def __len__(self):
+        return sum(1 for key in self.client.scan_iter(f"{self.prefix}*"))
+
+
+class EntityCache:
+    """Read-through lookups by id with hit/miss counters."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or LRUBackend()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        """Pick the backend from the app config.
+
+        ENTITY_CACHE_REDIS_URL selects Redis, otherwise an in-process LRU
+        of ENTITY_CACHE_SIZE entries. Entries live ENTITY_CACHE_TTL seconds.
+        """
+
+        size = app.config.setdefault('ENTITY_CACHE_SIZE', CACHE_SIZE)
+        ttl = app.config.setdefault('ENTITY_CACHE_TTL', CACHE_TTL)
+        redis_url = app.config.get('ENTITY_CACHE_REDIS_URL')
+
+        if redis_url:
+            import redis
+            self.backend = RedisBackend(redis.Redis.from_url(redis_url), ttl=ttl)
+        else:
+            self.backend = LRUBackend(maxsize=size, ttl=ttl)
+
+    def _read_through(self, key, load):
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        # cached rows outlive replica lag, so fill from the primary
+        with replicas.primary():
+            value = load()
+        if value is not None:
+            self.backend.set(key, value)
+        return value
+
+    def user(self, user_id):
+        """UserSnapshot for `user_id`, or None if there is no such user."""
+
+        def load():
+            user = User.visible().filter(User.id == user_id).first()
+            return UserSnapshot.of(user) if user else None
+
+        return self._read_through(f"user:{user_id}", load)
+
+    def message(self, message_id):
+        """A feed.FeedMessage for `message_id`, or None.
+
+        Only the message's own columns are cached; the author is looked
+        up separately so profile edits don't leave stale copies around.
+        Archived messages are found too.
+        """
+
+        def load():
+            row = (db.session
+                   .query(Message.id, Message.text, Message.timestamp, Message.user_id,
+                          Message.like_count)
+                   .filter(Message.id == message_id, Message.deleted_at.is_(None))
+                   .first())
+            if row is None:
+                row = (db.session
+                       .query(MessageArchive.id, MessageArchive.text, MessageArchive.timestamp,
+                              MessageArchive.user_id, MessageArchive.like_count)
+                       .filter(MessageArchive.id == message_id)
+                       .first())
+            return tuple(row) if row else None
+
+        row = self._read_through(f"message:{message_id}", load)
+        if row is None:
+            return None
+
+        author = self.user(row[3])
+        if author is None:
+            return None
+        return feed.FeedMessage(*row, feed.Author(author.id, author.username, author.image_url))
+
+    def invalidate_user(self, *user_ids):
+        for user_id in user_ids:
+            self.backend.delete(f"user:{user_id}")
+
+    def invalidate_message(self, *message_ids):
+        for message_id in message_ids:
+            self.backend.delete(f"message:{message_id}")
+
+    def version(self, name):
+        """Opaque token for `name` that changes on every bump_version(name).
+
+        If the token is evicted a new one is made, which only costs a miss
+        for whoever compares against it.
+        """
+
+        token = self.backend.get(f"version:{name}")
+        if token is None:
+            token = self.bump_version(name)
+        return token
+
+    def bump_version(self, name):
+        token = uuid.uuid4().hex[:12]
+        self.backend.set(f"version:{name}", token)
+        return token
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=round(self.hits / lookups, 4) if lookups else None,
+                    size=len(self.backend),
+                    evictions=self.backend.evictions)
+
+
+entity_cache = EntityCache()
@@ -0,0 +1,105 @@
+"""Print EXPLAIN plans for the SQL each Warbler route runs.
+
+Run it against a seeded database (python seed.py) to spot missing indexes:
+
+    python explain.py             # plans only
+    python explain.py --analyze   # Postgres: EXPLAIN ANALYZE, with timings
+
+The queries are captured by calling each route through the test client as
+the user who follows the most people, so the plans always match the code.
+"""
+
+import sys
+
+from sqlalchemy import event, func
+
+from app import app, CURR_USER_KEY
+from models import db, Message, Follows
+
+ROUTES = [
+    '/',
+    '/messages/feed',
+    '/messages/liked',
+    '/messages/{message_id}',
+    '/users',
+    '/users?q=an',
+    '/users/autocomplete?q=an',
+    '/users/{user_id}',
+    '/users/{user_id}/messages',
+    '/users/{user_id}/following',
+    '/users/{user_id}/followers',
+]
+
+
+def busiest_user_id():
+    """Id of the user following the most people (the heaviest timeline)."""
+
+    return (db.session
+            .query(Follows.user_following_id)
+            .group_by(Follows.user_following_id)
+            .order_by(func.count().desc())
+            .limit(1)
+            .scalar())
+
+
+def capture_queries(url, user_id):
+    """Run `url` as `user_id`; return the distinct SELECTs it issued."""
+
+    statements = []
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and (statement, parameters) not in statements:
+            statements.append((statement, parameters))
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+    event.listen(db.engine, 'before_cursor_execute', before_execute)
+    try:
+        resp = client.get(url)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_execute)
+
+    return resp.status_code, statements
+
+
+def explain(statement, parameters, analyze=False):
+    """Plan lines for one statement, in the database's own EXPLAIN syntax."""
+
+    if db.engine.dialect.name == 'postgresql':
+        prefix = 'EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN '
+    else:
+        prefix = 'EXPLAIN QUERY PLAN '
+
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(prefix + statement, parameters)
+        return [' | '.join(str(col) for col in row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def main(analyze=False):
+    user_id = busiest_user_id()
+    if user_id is None:
+        print("No follows found; seed the database first (python seed.py).")
+        return
+
+    message_id = db.session.query(func.max(Message.id)).scalar()
+    db.session.remove()
+
+    for route in ROUTES:
+        url = route.format(user_id=user_id, message_id=message_id)
+        status, statements = capture_queries(url, user_id)
+        print(f"\n=== GET {url} -> {status}, {len(statements)} distinct SELECTs")
+
+        for statement, parameters in statements:
+            print("\n  " + " ".join(statement.split()))
+            for line in explain(statement, parameters, analyze):
+                print("    " + line)
+
+
+if __name__ == '__main__':
+    main(analyze='--analyze' in sys.argv)
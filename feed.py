@@ -0,0 +1,114 @@
+"""Timeline queries shared by the homepage, profiles, liked and message pages.
+
+Messages are fetched together with the three author columns the templates
+use (id, username, image_url) in a single joined query and returned as
+lightweight read-only rows, so rendering `msg.user.username` never
+lazy-loads a User per message.
+
+Paged feeds read the last MESSAGES_RECENT_DAYS first, see partitions.py.
+"""
+
+from collections import namedtuple
+
+from models import db, User, Message, Likes
+from pagination import newest_page
+from partitions import partitions
+
+
+class Author(namedtuple('Author', 'id username image_url')):
+    """The bits of a User a rendered message needs."""
+
+    __slots__ = ()
+
+
+class FeedMessage(namedtuple('FeedMessage', 'id text timestamp user_id like_count user')):
+    """A Message row plus its Author, shaped like the ORM object templates expect."""
+
+    __slots__ = ()
+
+    serialize = Message.serialize
+
+    @classmethod
+    def of(cls, msg, user):
+        """A FeedMessage for a freshly committed Message written by `user`."""
+
+        return cls(msg.id, msg.text, msg.timestamp, msg.user_id, msg.like_count or 0,
+                   Author(user.id, user.username, user.image_url))
+
+
+COLUMNS = (Message.id, Message.text, Message.timestamp, Message.user_id, Message.like_count,
+           User.username, User.image_url)
+
+
+def _rows(query):
+    return [FeedMessage(id, text, timestamp, user_id, like_count,
+                        Author(user_id, username, image_url))
+            for id, text, timestamp, user_id, like_count, username, image_url in query]
+
+
+def _query():
+    return (db.session
+            .query(*COLUMNS)
+            .join(User, Message.user_id == User.id)
+            .filter(Message.deleted_at.is_(None), User.deleted_at.is_(None)))
+
+
+def by_ids(message_ids):
+    """Messages with the given ids (in no particular order)."""
+
+    if not message_ids:
+        return []
+    return _rows(_query().filter(Message.id.in_(message_ids)))
+
+
+def by_authors(author_ids, limit, before=None):
+    """Newest messages written by any of `author_ids`."""
+
+    if not author_ids:
+        return []
+    return _rows(newest_page(_query().filter(Message.user_id.in_(author_ids)), limit, before,
+                             partitions.recent))
+
+
+def by_user(user_id, limit, before=None):
+    """Newest messages written by `user_id`."""
+
+    return _rows(newest_page(_query().filter(Message.user_id == user_id), limit, before,
+                             partitions.recent))
+
+
+def like_counts_by_user(user_id, limit):
+    """(id, like_count, timestamp) of the newest messages written by `user_id`.
+
+    The part of a profile page that other people's likes change, for its
+    HTTP validator; cheaper than by_user() as it skips the author join.
+    """
+
+    query = (db.session
+             .query(Message.id, Message.like_count, Message.timestamp)
+             .filter(Message.user_id == user_id, Message.deleted_at.is_(None)))
+    return newest_page(query, limit, recent=partitions.recent)
+
+
+def like_counts(message_ids):
+    """(id, like_count) of the given messages, in id order.
+
+    For HTTP validators of pages that show these messages.
+    """
+
+    if not message_ids:
+        return []
+    return (db.session
+            .query(Message.id, Message.like_count)
+            .filter(Message.id.in_(message_ids))
+            .order_by(Message.id)
+            .all())
+
+
+def liked_by(user_id, limit, before=None):
+    """Newest messages liked by `user_id`."""
+
+    query = (_query()
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user_id))
+    return _rows(newest_page(query, limit, before, partitions.recent))
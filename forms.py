@@ -2,11 +2,13 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length
 
+from models import MAX_MESSAGE_LENGTH
+
 
 class MessageForm(FlaskForm):
     """Form for adding/editing messages."""
 
-    text = TextAreaField('text', validators=[DataRequired()])
+    text = TextAreaField('text', validators=[DataRequired(), Length(max=MAX_MESSAGE_LENGTH)])
 
 
 class UserAddForm(FlaskForm):
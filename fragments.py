@@ -0,0 +1,92 @@
+"""Cache of rendered message list items.
+
+A popular warble shows up in thousands of timelines with the same
+markup, so each rendered `<li>` (templates/messages/item.html) is kept in
+a bounded in-process LRU. The timeline templates call
+`message_items(messages, liked)`, which assembles cached fragments and
+renders only the misses.
+
+An entry is per message and holds one fragment per viewer variant (liked
+or not, own message or not) together with the like count and the author's
+username and image URL it was rendered with. New like counts and profile
+edits therefore invalidate the fragment on its next use; deleted messages
+are dropped explicitly with `invalidate_message`.
+"""
+
+from flask import g
+from markupsafe import Markup
+
+from cache import LRUBackend
+
+FRAGMENT_CACHE_SIZE = 20000
+FRAGMENT_CACHE_TTL = 3600
+
+TEMPLATE = 'messages/item.html'
+
+
+class FragmentCache:
+    """Rendered message items keyed by message id and viewer variant."""
+
+    def __init__(self, maxsize=FRAGMENT_CACHE_SIZE, ttl=FRAGMENT_CACHE_TTL):
+        self.backend = LRUBackend(maxsize=maxsize, ttl=ttl)
+        self.jinja_env = None
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        """Size the cache from FRAGMENT_CACHE_SIZE/TTL and expose message_items() to templates."""
+
+        self.backend = LRUBackend(
+            maxsize=app.config.setdefault('FRAGMENT_CACHE_SIZE', FRAGMENT_CACHE_SIZE),
+            ttl=app.config.setdefault('FRAGMENT_CACHE_TTL', FRAGMENT_CACHE_TTL))
+        self.jinja_env = app.jinja_env
+        app.jinja_env.globals['message_items'] = self.render
+
+    def render(self, messages, liked):
+        """The `<li>` items for `messages`, as seen by the current user."""
+
+        viewer_id = g.user.id if g.get('user') else None
+        template = None
+        items = []
+
+        for msg in messages:
+            stamp = (msg.like_count, msg.user.username, msg.user.image_url)
+            variant = (msg.id in liked, msg.user_id == viewer_id)
+
+            entry = self.backend.get(msg.id)
+            if entry is None or entry[0] != stamp:
+                entry = (stamp, {})
+            html = entry[1].get(variant)
+
+            if html is None:
+                self.misses += 1
+                template = template or self.jinja_env.get_template(TEMPLATE)
+                html = template.render(msg=msg, liked=variant[0], own=variant[1])
+                entry[1][variant] = html
+                self.backend.set(msg.id, entry)
+            else:
+                self.hits += 1
+
+            items.append(html)
+
+        return Markup(''.join(items))
+
+    def render_one(self, msg, liked=False, own=False):
+        """One item rendered outside the cache, e.g. to push to live timelines."""
+
+        return self.jinja_env.get_template(TEMPLATE).render(msg=msg, liked=liked, own=own)
+
+    def invalidate_message(self, *message_ids):
+        for message_id in message_ids:
+            self.backend.delete(message_id)
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self.backend),
+                    evictions=self.backend.evictions)
+
+
+fragments = FragmentCache()
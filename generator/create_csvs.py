@@ -3,14 +3,40 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+    python generator/create_csvs.py
+    python generator/create_csvs.py --users 10000000 --messages 50000000 \\
+        --follows 200000000 --workers 16 --seed 7
+
+Rows are generated in fixed-size shards on a process pool and streamed to
+disk, so memory stays flat however many rows are asked for. Each shard has
+its own seed derived from --seed, so the same arguments give byte-identical
+files whatever the number of workers.
+
+- Follower counts follow a power law: a handful of celebrity accounts are
+  followed by a large share of everyone, most users by a few people. How
+  many people a user follows is spread evenly instead.
+- Posting activity is skewed the same way, and timestamps cluster in
+  bursts on top of a uniform background.
+- Usernames and emails end in the user id, so they are unique.
+- Image URLs come from local lists (header_images.txt), no network needed.
+
+User ids are the row numbers of users.csv, which is also what seed.py
+assigns on load.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import (Scatter, get_bursty_datetime, make_bursts, power_law_rank,
+                     profile_image_urls, read_list)
 
 MAX_WARBLER_LENGTH = 140
 
@@ -20,58 +46,175 @@ FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
+
+SHARD_ROWS = 50000
+FOLLOW_SKEW = 1.0
+POST_SKEW = 0.8
+NUM_BURSTS = 200
+YEAR_GAP = 2
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+image_urls = profile_image_urls()
+header_image_urls = read_list('header_images.txt')
 
 fake = Faker()
 
-# Generate random profile image URLs to use for users
-
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
-
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
-
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def shard_random(opts, table, shard):
+    """The seeded Random (and reseeded Faker) for one shard."""
+
+    seed = f"{opts['seed']}:{table}:{shard}"
+    fake.seed_instance(seed)
+    return random.Random(seed)
+
+
+def user_rows(opts, shard, start, stop):
+    rng = shard_random(opts, 'users', shard)
+
+    for user_id in range(start, stop):
+        username = f"{fake.user_name()}{user_id}"
+        yield [
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            fake.sentence(),
+            rng.choice(header_image_urls),
+            fake.city(),
+        ]
+
+
+def message_rows(opts, shard, start, stop):
+    rng = shard_random(opts, 'messages', shard)
+    posters = Scatter(random.Random(f"{opts['seed']}:posters"), opts['users'])
+
+    for _ in range(start, stop):
+        yield [
+            fake.paragraph()[:MAX_WARBLER_LENGTH],
+            get_bursty_datetime(rng, opts['start'], opts['end'], opts['bursts']),
+            posters(power_law_rank(rng, opts['users'], opts['post_skew'])),
+        ]
+
+
+def follow_rows(opts, shard, start, stop):
+    """Follows made by users start..stop-1.
+
+    The shard's share of --follows is dealt out evenly among its users,
+    then each user picks that many distinct accounts to follow from the
+    power-law popularity ranking.
+    """
+
+    rng = shard_random(opts, 'follows', shard)
+    num_users = opts['users']
+    celebrities = Scatter(random.Random(f"{opts['seed']}:celebrities"), num_users)
+
+    first_edge = opts['follows'] * (start - 1) // num_users
+    last_edge = opts['follows'] * (stop - 1) // num_users
+    counts = [0] * (stop - start)
+    for _ in range(last_edge - first_edge):
+        counts[rng.randrange(stop - start)] += 1
+
+    for follower, count in zip(range(start, stop), counts):
+        count = min(count, num_users - 1)
+        followed = set()
+        attempts = 0
+        while len(followed) < count and attempts < count * 20:
+            attempts += 1
+            user_id = celebrities(power_law_rank(rng, num_users, opts['follow_skew']))
+            if user_id != follower:
+                followed.add(user_id)
+
+        for user_id in sorted(followed):
+            yield [user_id, follower]
+
+
+def write_shard(job):
+    """Write one shard to its part file; return the path and row count."""
+
+    rows, opts, shard, start, stop, path = job
+    count = 0
+    with open(path, 'w', newline='') as part:
+        writer = csv.writer(part)
+        for row in rows(opts, shard, start, stop):
+            writer.writerow(row)
+            count += 1
+    return path, count
+
+
+def shards(first, last, size):
+    """(shard, start, stop) ranges covering [first, last)."""
+
+    for shard, start in enumerate(range(first, last, size)):
+        yield shard, start, min(start + size, last)
+
+
+def generate(pool, opts, filename, headers, rows, ranges):
+    """Run `rows` over `ranges` on the pool and concatenate the parts in order."""
+
+    path = os.path.join(opts['out'], filename)
+    parts = os.path.join(opts['out'], '.parts')
+    os.makedirs(parts, exist_ok=True)
+    started = time.perf_counter()
+    total = 0
+
+    jobs = [(rows, opts, shard, start, stop, os.path.join(parts, f"{filename}.{shard:06d}"))
+            for shard, start, stop in ranges]
+
+    with open(path, 'w', newline='') as out:
+        csv.writer(out).writerow(headers)
+        for part_path, count in pool.map(write_shard, jobs):
+            with open(part_path, newline='') as part:
+                shutil.copyfileobj(part, out)
+            os.remove(part_path)
+            total += count
+
+    os.rmdir(parts)
+    elapsed = time.perf_counter() - started
+    print(f"{filename}: {total:,} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate users.csv, messages.csv and follows.csv.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--seed', default='0', help="same seed and arguments, same files")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default=os.path.dirname(os.path.abspath(__file__)),
+                        help="directory to write the CSVs to")
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        default=datetime.combine(datetime.utcnow().date(), datetime.min.time()),
+                        help="newest possible timestamp (default: midnight today, UTC)")
+    parser.add_argument('--follow-skew', type=float, default=FOLLOW_SKEW,
+                        help="power-law exponent of follower counts")
+    parser.add_argument('--post-skew', type=float, default=POST_SKEW,
+                        help="power-law exponent of messages per user")
+    args = parser.parse_args()
+
+    start = args.end - timedelta(days=365 * YEAR_GAP)
+    opts = dict(
+        seed=args.seed,
+        users=args.users,
+        follows=args.follows,
+        follow_skew=args.follow_skew,
+        post_skew=args.post_skew,
+        out=args.out,
+        start=start,
+        end=args.end,
+        bursts=make_bursts(random.Random(f"{args.seed}:bursts"), start, args.end, NUM_BURSTS),
+    )
+    follower_shard = max(1, SHARD_ROWS * args.users // max(args.follows, 1))
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        generate(pool, opts, 'users.csv', USERS_CSV_HEADERS, user_rows,
+                 shards(1, args.users + 1, SHARD_ROWS))
+        generate(pool, opts, 'messages.csv', MESSAGES_CSV_HEADERS, message_rows,
+                 shards(0, args.messages, SHARD_ROWS))
+        generate(pool, opts, 'follows.csv', FOLLOWS_CSV_HEADERS, follow_rows,
+                 shards(1, args.users + 1, follower_shard))
+
+
+if __name__ == '__main__':
+    main()
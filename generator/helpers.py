@@ -1,14 +1,79 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import math
+import os
+from datetime import timedelta
 
+HERE = os.path.dirname(os.path.abspath(__file__))
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+def read_list(filename):
+    """Non-blank lines of a text file next to this module."""
 
-    return datetime.fromtimestamp(random_timestamp)
+    with open(os.path.join(HERE, filename)) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def profile_image_urls():
+    """Profile image URLs to pick from."""
+
+    return [
+        f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+        for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+        for i in range(count)
+    ]
+
+
+def power_law_rank(rng, n, skew):
+    """Random rank in [0, n) with P(rank r) roughly proportional to (r + 1) ** -skew.
+
+    Inverse-CDF sampling of a continuous power law, so it needs no table
+    of n weights and works for any n.
+    """
+
+    u = rng.random()
+    if abs(skew - 1) < 1e-9:
+        x = n ** u
+    else:
+        a = 1 - skew
+        x = ((n ** a - 1) * u + 1) ** (1 / a)
+    return min(int(x) - 1, n - 1)
+
+
+class Scatter:
+    """A cheap seeded bijection from ranks [0, n) to user ids [1, n].
+
+    Keeps the most popular ranks from all landing on the lowest ids without
+    holding a permutation of n ids in memory.
+    """
+
+    def __init__(self, rng, n):
+        self.n = n
+        self.offset = rng.randrange(n)
+        self.step = rng.randrange(1, n) if n > 1 else 1
+        while math.gcd(self.step, n) != 1:
+            self.step += 1
+
+    def __call__(self, rank):
+        return (rank * self.step + self.offset) % self.n + 1
+
+
+def make_bursts(rng, start, end, count, share_of_window=0.002):
+    """`count` (center, width_seconds) bursts of activity between start and end."""
+
+    span = (end - start).total_seconds()
+    return [(start + timedelta(seconds=rng.uniform(0, span)),
+             rng.expovariate(1 / (span * share_of_window)))
+            for _ in range(count)]
+
+
+def get_bursty_datetime(rng, start, end, bursts, burst_share=0.6):
+    """A datetime in [start, end): mostly inside a burst, otherwise uniform."""
+
+    if bursts and rng.random() < burst_share:
+        center, width = rng.choice(bursts)
+        moment = center + timedelta(seconds=rng.expovariate(1 / width))
+        if moment < end:
+            return moment
+
+    return start + timedelta(seconds=rng.uniform(0, (end - start).total_seconds()))
@@ -0,0 +1,116 @@
+"""HTTP caching policy: per-route Cache-Control and conditional GETs.
+
+Views decorated with @conditional name a validator: a cheap function of
+the view's arguments returning the things the page depends on (counters,
+newest message ids, version tokens) and optionally a Last-Modified time.
+They are hashed, together with the viewer, into an ETag; if the client's
+If-None-Match still matches, the view is skipped and a 304 is sent
+without running its queries or rendering its template. If-Modified-Since
+is ignored: a newest-message time says nothing about follows, counters
+or profile edits, so only the ETag can tell the page is unchanged.
+
+Pages are per viewer, so they are `private, no-cache`: browsers keep them
+but revalidate on every visit. Responses without a policy of their own get
+DEFAULT_CACHE_CONTROL.
+"""
+
+import hashlib
+import time
+from functools import wraps
+
+from flask import current_app, g, make_response, request, session
+from werkzeug.http import is_resource_modified
+
+from cache import entity_cache
+
+DEFAULT_CACHE_CONTROL = "no-store"
+
+
+def cache_control(**directives):
+    """Set Cache-Control on the view's responses, e.g. cache_control(public=True, max_age=30)."""
+
+    def decorator(view):
+        @wraps(view)
+        def wrap(*args, **kwargs):
+            resp = make_response(view(*args, **kwargs))
+            for directive, value in directives.items():
+                setattr(resp.cache_control, directive, value)
+            return resp
+        return wrap
+    return decorator
+
+
+def viewer_parts():
+    """What every page depends on besides its own data: who is looking, and when.
+
+    Pages show the viewer's follow and like buttons, and the viewer's
+    counters don't say which follows or likes changed (unfollow X, follow
+    Y), so the viewer's version token is included; see bump_viewer().
+
+    The base template renders a CSRF token, so the ETag changes every half
+    token lifetime to keep a revalidated page from carrying an expired one.
+    """
+
+    csrf_epoch = None
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    if current_app.config.get('WTF_CSRF_ENABLED', True) and limit:
+        csrf_epoch = int(time.time() // (limit / 2))
+
+    if not g.user:
+        return None, csrf_epoch
+    return g.user.version(), entity_cache.version(f"viewer:{g.user.id}"), csrf_epoch
+
+
+def bump_viewer(user_id):
+    """Call after `user_id` follows, unfollows, likes or unlikes anything."""
+
+    entity_cache.bump_version(f"viewer:{user_id}")
+
+
+def make_etag(parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:24]
+
+
+def conditional(validate):
+    """Answer GETs with 304 when `validate(**view_args)` says nothing changed.
+
+    `validate` returns (parts, last_modified); `parts` is anything with a
+    stable repr, `last_modified` a datetime or None.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrap(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                # a flashed message must be shown once, never replayed from cache
+                return view(*args, **kwargs)
+
+            parts, last_modified = validate(**kwargs)
+            etag = make_etag((request.endpoint, parts, viewer_parts()))
+
+            if not is_resource_modified(request.environ, etag=etag):
+                resp = current_app.response_class(status=304)
+            else:
+                resp = make_response(view(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+
+            resp.set_etag(etag)
+            if last_modified is not None:
+                resp.last_modified = last_modified
+            resp.cache_control.private = True
+            resp.cache_control.no_cache = True
+            resp.vary.add('Cookie')
+            return resp
+        return wrap
+    return decorator
+
+
+def init_app(app):
+    """Give responses without a caching policy of their own the default one."""
+
+    @app.after_request
+    def default_cache_control(resp):
+        if 'Cache-Control' not in resp.headers:
+            resp.headers['Cache-Control'] = DEFAULT_CACHE_CONTROL
+        return resp
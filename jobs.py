@@ -0,0 +1,383 @@
+"""Durable background jobs, queued in the application database.
+
+Routes call `jobs.enqueue(name, payload)` before they commit: the job is
+a row in `jobs` written in the request's own transaction, so it exists
+exactly when the change that needs it does. No broker is involved; the
+workers poll the table.
+
+    flask jobs-worker [--threads 4] [--processes 1]
+
+Tasks are plain functions registered with `@jobs.task(name)` and called
+with the payload as keyword arguments inside an app context; their
+session is committed when they return.
+
+Delivery is at least once. A claimed job is hidden from other workers
+for JOBS_VISIBILITY_TIMEOUT seconds, and its worker renews that lease
+every third of the timeout while the task runs, so long tasks keep it;
+if the worker dies or stalls, the job is claimed again and a late result
+from the first worker is ignored.
+A failing job is retried after JOBS_RETRY_BASE * 2**(attempt - 1)
+seconds (at most JOBS_RETRY_MAX, jittered) until it has been tried
+max_attempts times, then stays `failed` with its last error. Jobs with an
+idempotency key are only enqueued once per key.
+
+Finished jobs are kept JOBS_RETENTION seconds; /_stats/jobs reports
+queue depth and how long recent jobs waited and ran.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+import traceback
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import db, Job
+
+MAX_ATTEMPTS = 5
+VISIBILITY_TIMEOUT = 300
+RETRY_BASE = 10
+RETRY_MAX = 3600
+POLL_INTERVAL = 1.0
+RETENTION = 86400
+STATS_WINDOW = 1000
+
+# unclaimed jobs looked at per claim; others may be taken concurrently
+CLAIM_CANDIDATES = 10
+
+jobs_table = Job.__table__
+
+
+class Task(namedtuple('Task', 'name fn max_attempts')):
+    """A registered job handler."""
+
+    __slots__ = ()
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * pct / 100))], 3)
+
+
+class JobQueue:
+    """The task registry plus enqueueing, claiming and running jobs."""
+
+    def __init__(self):
+        self.app = None
+        self.tasks = {}
+        self.visibility_timeout = VISIBILITY_TIMEOUT
+        self.retry_base = RETRY_BASE
+        self.retry_max = RETRY_MAX
+        self.retention = RETENTION
+
+    def init_app(self, app):
+        """Read JOBS_VISIBILITY_TIMEOUT, JOBS_RETRY_BASE/MAX and JOBS_RETENTION."""
+
+        self.app = app
+        self.visibility_timeout = app.config.setdefault('JOBS_VISIBILITY_TIMEOUT',
+                                                        VISIBILITY_TIMEOUT)
+        self.retry_base = app.config.setdefault('JOBS_RETRY_BASE', RETRY_BASE)
+        self.retry_max = app.config.setdefault('JOBS_RETRY_MAX', RETRY_MAX)
+        self.retention = app.config.setdefault('JOBS_RETENTION', RETENTION)
+
+    def task(self, name, max_attempts=MAX_ATTEMPTS):
+        """Register the decorated function as the handler for jobs called `name`."""
+
+        def register(fn):
+            self.tasks[name] = Task(name, fn, max_attempts)
+            return fn
+
+        return register
+
+    # ---- producers
+
+    def enqueue(self, name, payload=None, key=None, delay=0):
+        """Add a job to the current session's transaction; the caller commits.
+
+        With `key`, a job that was already enqueued under that key wins
+        and this does nothing. Returns whether a job was added.
+        """
+
+        task = self.tasks[name]
+        now = datetime.utcnow()
+        values = dict(name=name, payload=json.dumps(payload or {}), idempotency_key=key,
+                      status='queued', attempts=0, max_attempts=task.max_attempts,
+                      created_at=now, run_at=now + timedelta(seconds=delay))
+
+        if key is None:
+            statement = jobs_table.insert()
+        elif db.engine.dialect.name == 'postgresql':
+            statement = pg_insert(jobs_table).on_conflict_do_nothing()
+        else:
+            statement = jobs_table.insert().prefix_with('OR IGNORE')
+
+        return db.session.execute(statement.values(**values)).rowcount == 1
+
+    # ---- consumers
+
+    def _engine(self):
+        return db.get_engine(self.app)
+
+    def claim(self):
+        """Take the next due job for this worker, or None.
+
+        Each candidate is taken with a compare-and-set on its attempt
+        count, so two workers never both win it; on Postgres the
+        candidates are also row-locked with SKIP LOCKED.
+        """
+
+        now = datetime.utcnow()
+        due = or_(and_(jobs_table.c.status == 'queued', jobs_table.c.run_at <= now),
+                  and_(jobs_table.c.status == 'running', jobs_table.c.locked_until <= now))
+
+        with self._engine().begin() as conn:
+            candidates = conn.execute(select([jobs_table.c.id, jobs_table.c.attempts])
+                                      .where(due)
+                                      .order_by(jobs_table.c.run_at, jobs_table.c.id)
+                                      .limit(CLAIM_CANDIDATES)
+                                      .with_for_update(skip_locked=True)).fetchall()
+
+            for job_id, attempts in candidates:
+                claimed = conn.execute(
+                    jobs_table.update()
+                    .where(and_(jobs_table.c.id == job_id, jobs_table.c.attempts == attempts, due))
+                    .values(status='running', attempts=attempts + 1, started_at=now,
+                            locked_until=now + timedelta(seconds=self.visibility_timeout)))
+                if claimed.rowcount == 1:
+                    return conn.execute(select([jobs_table])
+                                        .where(jobs_table.c.id == job_id)).first()
+        return None
+
+    def execute(self, job):
+        """Run a claimed job and record the outcome."""
+
+        task = self.tasks.get(job.name)
+        try:
+            if task is None:
+                raise LookupError(f"no task registered as {job.name!r}")
+            if job.attempts > job.max_attempts:
+                raise TimeoutError(f"gave up after {job.max_attempts} attempts timed out")
+
+            with self._lease(job), self.app.app_context():
+                try:
+                    task.fn(**json.loads(job.payload))
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise
+
+        except Exception:
+            self.app.logger.exception("job %s (%s) failed", job.id, job.name)
+            self._finish(job, error=traceback.format_exc(limit=5))
+            return False
+
+        self._finish(job)
+        return True
+
+    @contextmanager
+    def _lease(self, job):
+        """Keep extending a claimed job's visibility timeout inside the block."""
+
+        stopping = threading.Event()
+        heartbeat = threading.Thread(target=self._renew, args=(job, stopping),
+                                     name=f'jobs-lease-{job.id}', daemon=True)
+        heartbeat.start()
+        try:
+            yield
+        finally:
+            stopping.set()
+            heartbeat.join()
+
+    def _renew(self, job, stopping):
+        while not stopping.wait(self.visibility_timeout / 3):
+            try:
+                with self._engine().begin() as conn:
+                    renewed = conn.execute(
+                        jobs_table.update()
+                        .where(and_(jobs_table.c.id == job.id,
+                                    jobs_table.c.attempts == job.attempts,
+                                    jobs_table.c.status == 'running'))
+                        .values(locked_until=datetime.utcnow()
+                                + timedelta(seconds=self.visibility_timeout))).rowcount
+            except Exception:
+                self.app.logger.exception("renewing the lease of job %s failed", job.id)
+                continue
+            if not renewed:
+                # another worker has it now; its result will win
+                return
+
+    def backoff(self, attempts):
+        """Seconds to wait before retrying a job that failed `attempts` times."""
+
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1)
+
+    def _finish(self, job, error=None):
+        now = datetime.utcnow()
+        if error is None:
+            values = dict(status='done', finished_at=now, locked_until=None)
+        elif job.attempts >= job.max_attempts:
+            values = dict(status='failed', finished_at=now, locked_until=None, last_error=error)
+        else:
+            values = dict(status='queued', locked_until=None, last_error=error,
+                          run_at=now + timedelta(seconds=self.backoff(job.attempts)))
+
+        # only if nobody re-claimed it after our visibility timeout ran out
+        with self._engine().begin() as conn:
+            conn.execute(jobs_table.update()
+                         .where(and_(jobs_table.c.id == job.id,
+                                     jobs_table.c.attempts == job.attempts,
+                                     jobs_table.c.status == 'running'))
+                         .values(**values))
+
+    def work(self, limit=None):
+        """Run due jobs until there are none (or `limit` ran); returns how many ran."""
+
+        ran = 0
+        while limit is None or ran < limit:
+            job = self.claim()
+            if job is None:
+                break
+            self.execute(job)
+            ran += 1
+        return ran
+
+    def prune(self):
+        """Delete jobs that finished successfully more than JOBS_RETENTION seconds ago."""
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.retention)
+        with self._engine().begin() as conn:
+            return conn.execute(jobs_table.delete()
+                                .where(and_(jobs_table.c.status == 'done',
+                                            jobs_table.c.finished_at < cutoff))).rowcount
+
+    # ---- monitoring
+
+    def stats(self):
+        """Queue depth by status and task, and wait/run times of recent jobs."""
+
+        now = datetime.utcnow()
+        with self._engine().connect() as conn:
+            depth = {status: count for status, count in conn.execute(
+                select([jobs_table.c.status, func.count()]).group_by(jobs_table.c.status))}
+            queued = {name: count for name, count in conn.execute(
+                select([jobs_table.c.name, func.count()])
+                .where(jobs_table.c.status == 'queued')
+                .group_by(jobs_table.c.name))}
+            oldest = conn.execute(select([func.min(jobs_table.c.run_at)])
+                                  .where(and_(jobs_table.c.status == 'queued',
+                                              jobs_table.c.run_at <= now))).scalar()
+            recent = conn.execute(select([jobs_table.c.run_at, jobs_table.c.started_at,
+                                          jobs_table.c.finished_at])
+                                  .where(jobs_table.c.status == 'done')
+                                  .order_by(jobs_table.c.finished_at.desc())
+                                  .limit(STATS_WINDOW)).fetchall()
+
+        waits = [(started - run_at).total_seconds() for run_at, started, _ in recent]
+        runs = [(finished - started).total_seconds() for _, started, finished in recent]
+        return dict(depth=depth,
+                    queued=queued,
+                    oldest_due_seconds=(now - oldest).total_seconds() if oldest else 0,
+                    recent=len(recent),
+                    wait_p50=_percentile(waits, 50), wait_p95=_percentile(waits, 95),
+                    run_p50=_percentile(runs, 50), run_p95=_percentile(runs, 95))
+
+
+class Worker:
+    """Threads that claim and run jobs until stopped."""
+
+    def __init__(self, queue, threads=1, poll=POLL_INTERVAL):
+        self.queue = queue
+        self.threads = threads
+        self.poll = poll
+        self.stopping = threading.Event()
+        self.last_prune = 0
+
+    def _loop(self):
+        while not self.stopping.is_set():
+            try:
+                job = self.queue.claim()
+            except Exception:
+                self.queue.app.logger.exception("claiming a job failed")
+                job = None
+
+            if job is None:
+                self._maybe_prune()
+                self.stopping.wait(self.poll)
+            else:
+                self.queue.execute(job)
+
+    def _maybe_prune(self):
+        if time.monotonic() - self.last_prune < self.queue.retention / 24:
+            return
+        self.last_prune = time.monotonic()
+        try:
+            self.queue.prune()
+        except Exception:
+            self.queue.app.logger.exception("pruning finished jobs failed")
+
+    def start(self):
+        self.pool = [threading.Thread(target=self._loop, name=f'jobs-{n}', daemon=True)
+                     for n in range(self.threads)]
+        for thread in self.pool:
+            thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.pool:
+            thread.join()
+
+    def run(self):
+        """Work until interrupted."""
+
+        self.start()
+        try:
+            while any(thread.is_alive() for thread in self.pool):
+                time.sleep(self.poll)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+def run_workers(queue, threads=1, processes=1):
+    """Run jobs in `threads` threads in each of `processes` processes.
+
+    With one process the caller does the work; with more it forks them
+    and only waits.
+    """
+
+    if processes <= 1:
+        Worker(queue, threads).run()
+        return
+
+    children = []
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            # don't share the parent's pooled connections
+            db.get_engine(queue.app).dispose()
+            Worker(queue, threads).run()
+            os._exit(0)
+        children.append(pid)
+
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+
+jobs = JobQueue()
@@ -0,0 +1,109 @@
+"""Write-behind aggregation of Message.like_count.
+
+Updating a message's counter in the same transaction as every like makes
+a viral warble's row the hottest lock in the database. Instead, the like
+routes record +1/-1 here after they commit; deltas for the same message
+are merged in memory and written in batches every LIKE_COUNT_FLUSH_INTERVAL
+seconds (or as soon as LIKE_COUNT_FLUSH_SIZE messages are pending) by a
+background thread, one UPDATE per distinct delta.
+
+Buffered deltas die with the process, so counts can drift after a crash;
+`flask reconcile-like-counts` recomputes them exactly from `likes`.
+"""
+
+import atexit
+import os
+import threading
+from collections import defaultdict
+
+from cache import entity_cache
+from models import db, Message
+
+FLUSH_INTERVAL = 1.0
+FLUSH_SIZE = 1000
+
+
+class LikeCountBuffer:
+    """Pending like_count deltas for this process, flushed on a timer."""
+
+    def __init__(self, interval=FLUSH_INTERVAL, size=FLUSH_SIZE):
+        self.interval = interval
+        self.size = size
+        self.app = None
+        self.pending = defaultdict(int)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.flushes = 0
+
+    def init_app(self, app):
+        """Read LIKE_COUNT_FLUSH_INTERVAL/SIZE; interval 0 writes every delta right away."""
+
+        self.app = app
+        self.interval = app.config.setdefault('LIKE_COUNT_FLUSH_INTERVAL', FLUSH_INTERVAL)
+        self.size = app.config.setdefault('LIKE_COUNT_FLUSH_SIZE', FLUSH_SIZE)
+        atexit.register(self.flush)
+
+    def add(self, message_id, delta):
+        """Buffer `delta` for a message whose like has been committed."""
+
+        with self.lock:
+            self.pending[message_id] += delta
+            full = len(self.pending) >= self.size
+
+        if not self.interval:
+            self.flush()
+            return
+
+        self._ensure_thread()
+        if full:
+            self.wakeup.set()
+
+    def _ensure_thread(self):
+        # started lazily so that each forked worker gets its own
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name='like-counts', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("flushing like counts failed")
+
+    def flush(self):
+        """Write the merged pending deltas in one transaction."""
+
+        with self.lock:
+            deltas, self.pending = self.pending, defaultdict(int)
+        if not any(deltas.values()):
+            return
+
+        try:
+            with db.get_engine(self.app).begin() as connection:
+                Message.bump_like_counts(connection, deltas)
+        except Exception:
+            # put them back to retry on the next flush
+            with self.lock:
+                for message_id, delta in deltas.items():
+                    self.pending[message_id] += delta
+            raise
+
+        entity_cache.invalidate_message(*deltas)
+        self.flushes += 1
+
+    def clear(self):
+        with self.lock:
+            self.pending.clear()
+
+
+like_counts = LikeCountBuffer()
@@ -0,0 +1,257 @@
+"""Live timeline updates: a pub/sub broker behind /messages/stream (SSE).
+
+`messages_add` publishes every new message, pre-rendered once, to its
+author's channel; each open homepage holds a Subscription to the authors
+its user follows and streams what arrives as Server-Sent Events.
+
+Subscriptions live in the worker serving the stream. Delivery between
+workers goes through a pluggable backend: LocalBackend hands events
+straight to this process's broker (one worker, tests), RedisBackend
+relays them over Redis pub/sub so every worker sees every event.
+
+Each subscription has a bounded queue. A client that can't keep up is
+cut off with a `resync` event rather than letting its queue grow; the
+page then offers a refresh. Idle streams get a comment line every
+LIVE_HEARTBEAT seconds so proxies don't time them out.
+
+An open stream holds one of its worker's request threads (or greenlets)
+for as long as the page is open, so streaming needs a threaded or async
+server (gunicorn --threads N, or gevent workers). LIVE_SERVER_THREADS is
+that per-process concurrency; at most half of it streams, leaving the
+rest for page requests, unless LIVE_MAX_SUBSCRIBERS says otherwise. With
+the default of one thread, streaming is off: /messages/stream answers
+503 and pages simply don't update live.
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+
+QUEUE_SIZE = 100
+HEARTBEAT = 15
+SERVER_THREADS = 1
+RESUBSCRIBE_DELAY = 1
+MAX_RESUBSCRIBE_DELAY = 30
+
+
+def max_subscribers_for(server_threads):
+    """How many streams a worker with `server_threads` request threads may hold."""
+
+    return server_threads // 2
+
+
+class TooManySubscribers(Exception):
+    """This worker already streams to LIVE_MAX_SUBSCRIBERS clients."""
+
+
+class Subscription:
+    """One open stream: the authors it follows and its pending events."""
+
+    def __init__(self, user_id, author_ids, size=QUEUE_SIZE):
+        self.user_id = user_id
+        self.author_ids = set(author_ids)
+        self.queue = queue.Queue(maxsize=size)
+        self.dropped = False
+
+    def offer(self, event):
+        """Queue `event`; a full queue marks the subscriber as too slow."""
+
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped = True
+
+    def events(self, heartbeat=HEARTBEAT):
+        """SSE text for this subscription, until it is dropped."""
+
+        while not self.dropped:
+            try:
+                event = self.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+            yield f"id: {event['id']}\nevent: message\ndata: {json.dumps(event)}\n\n"
+
+        yield "event: resync\ndata: {}\n\n"
+
+
+class LocalBackend:
+    """Delivers events to this process only."""
+
+    def start(self, dispatch):
+        self.dispatch = dispatch
+
+    def publish(self, kind, data):
+        self.dispatch(kind, data)
+
+
+class RedisBackend:
+    """Relays events between workers over one Redis pub/sub channel.
+
+    `client` has the redis-py API. A daemon thread per worker listens
+    and hands everything it receives to the local broker. An event that
+    can't be decoded or delivered is logged and skipped; when the
+    connection drops, the thread logs it and resubscribes, waiting
+    RESUBSCRIBE_DELAY seconds, doubling up to MAX_RESUBSCRIBE_DELAY while
+    Redis stays unreachable. Events published meanwhile are lost, as
+    with any pub/sub outage; pages catch up on their next load.
+    """
+
+    def __init__(self, client, channel="live", logger=None):
+        self.client = client
+        self.channel = channel
+        self.logger = logger or logging.getLogger(__name__)
+        self.retry_delay = RESUBSCRIBE_DELAY
+        self.max_retry_delay = MAX_RESUBSCRIBE_DELAY
+
+    def subscribe(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        return pubsub
+
+    def start(self, dispatch):
+        pubsub = self.subscribe()
+        threading.Thread(target=self.listen, args=(pubsub, dispatch),
+                         name='live-events', daemon=True).start()
+
+    def listen(self, pubsub, dispatch):
+        """Relay from `pubsub` to `dispatch`, resubscribing when it fails."""
+
+        delay = self.retry_delay
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self.subscribe()
+                for item in pubsub.listen():
+                    delay = self.retry_delay
+                    self.relay(item, dispatch)
+            except Exception:
+                self.logger.exception("live events: lost the Redis subscription, "
+                                      "resubscribing in %ss", delay)
+                self.close(pubsub)
+                pubsub = None
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    def relay(self, item, dispatch):
+        try:
+            kind, data = json.loads(item['data'])
+            dispatch(kind, data)
+        except Exception:
+            self.logger.exception("live events: skipping %r", item.get('data'))
+
+    def close(self, pubsub):
+        if pubsub is None:
+            return
+        try:
+            pubsub.close()
+        except Exception:
+            pass
+
+    def publish(self, kind, data):
+        self.client.publish(self.channel, json.dumps([kind, data]))
+
+
+class Broker:
+    """Routes published messages and follow changes to local subscriptions."""
+
+    def __init__(self, backend=None):
+        self.queue_size = QUEUE_SIZE
+        self.heartbeat = HEARTBEAT
+        self.max_subscribers = max_subscribers_for(SERVER_THREADS)
+        self.by_author = defaultdict(set)
+        self.by_user = defaultdict(set)
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.use(backend or LocalBackend())
+
+    def init_app(self, app):
+        """Read LIVE_QUEUE_SIZE/HEARTBEAT/SERVER_THREADS/MAX_SUBSCRIBERS; LIVE_REDIS_URL selects Redis."""
+
+        self.queue_size = app.config.setdefault('LIVE_QUEUE_SIZE', QUEUE_SIZE)
+        self.heartbeat = app.config.setdefault('LIVE_HEARTBEAT', HEARTBEAT)
+        threads = app.config.setdefault('LIVE_SERVER_THREADS', SERVER_THREADS)
+        self.max_subscribers = app.config.setdefault('LIVE_MAX_SUBSCRIBERS',
+                                                     max_subscribers_for(threads))
+        redis_url = app.config.get('LIVE_REDIS_URL')
+
+        if redis_url:
+            import redis
+            self.use(RedisBackend(redis.Redis.from_url(redis_url), logger=app.logger))
+        else:
+            self.use(LocalBackend())
+
+    def use(self, backend):
+        self.backend = backend
+        backend.start(self.dispatch)
+
+    # ---- subscribers
+
+    def subscribe(self, user_id, author_ids):
+        with self.lock:
+            if len(self) >= self.max_subscribers:
+                raise TooManySubscribers()
+            sub = Subscription(user_id, author_ids, self.queue_size)
+            self.by_user[user_id].add(sub)
+            for author_id in sub.author_ids:
+                self.by_author[author_id].add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.by_user[sub.user_id].discard(sub)
+            if not self.by_user[sub.user_id]:
+                del self.by_user[sub.user_id]
+            for author_id in sub.author_ids:
+                self.by_author[author_id].discard(sub)
+                if not self.by_author[author_id]:
+                    del self.by_author[author_id]
+
+    def __len__(self):
+        return sum(len(subs) for subs in self.by_user.values())
+
+    # ---- publishing
+
+    def publish_message(self, author_id, message_id, html):
+        """Send a freshly committed message to everyone streaming its author."""
+
+        self.backend.publish('message', dict(author_id=author_id, id=message_id, html=html))
+
+    def publish_follow(self, user_id, author_id, following):
+        """Let `user_id`'s open streams start or stop receiving `author_id`."""
+
+        self.backend.publish('follow', dict(user_id=user_id, author_id=author_id,
+                                            following=following))
+
+    def dispatch(self, kind, data):
+        """Deliver an event from the backend to the local subscriptions."""
+
+        with self.lock:
+            if kind == 'message':
+                for sub in self.by_author.get(data['author_id'], ()):
+                    was_dropped = sub.dropped
+                    sub.offer(data)
+                    if sub.dropped and not was_dropped:
+                        self.dropped += 1
+
+            elif kind == 'follow':
+                for sub in self.by_user.get(data['user_id'], ()):
+                    if data['following']:
+                        sub.author_ids.add(data['author_id'])
+                        self.by_author[data['author_id']].add(sub)
+                    else:
+                        sub.author_ids.discard(data['author_id'])
+                        subs = self.by_author.get(data['author_id'])
+                        if subs is not None:
+                            subs.discard(sub)
+                            if not subs:
+                                del self.by_author[data['author_id']]
+
+    def stats(self):
+        return dict(subscribers=len(self), authors=len(self.by_author), dropped=self.dropped)
+
+
+broker = Broker()
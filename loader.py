@@ -0,0 +1,338 @@
+"""Streaming bulk loader for the generator's users, messages and follows CSVs.
+
+Used by seed.py. Unlike a single bulk_insert_mappings per file, it:
+
+- streams each CSV in chunks, committing one chunk per transaction;
+- uses Postgres COPY when the database is Postgres, batched executemany
+  otherwise;
+- drops secondary indexes (and, on Postgres, foreign keys) before loading
+  and builds them once at the end;
+- checks constraints as it goes (unique usernames and emails; messages
+  and follows must point at users already loaded; no repeated follows)
+  and skips bad rows, writing them to <table>.rejects.csv next to the
+  input;
+- records progress in a `load_progress` table in the same transaction as
+  each chunk, so an interrupted load can be resumed where it stopped.
+
+Rows of users.csv and messages.csv get their line number as id unless the
+file has an `id` column, so a resumed load assigns the same ids.
+
+A fresh load builds the schema with the migrations, so it gets the same
+tables as a migrated database (on Postgres, partitioned messages). It
+needs an app context for that, see seed.py.
+"""
+
+import csv
+import io
+import os
+import time
+from contextlib import ExitStack
+from datetime import datetime
+
+from flask_migrate import upgrade
+from sqlalchemy import MetaData, inspect, select, text
+from sqlalchemy.schema import AddConstraint
+
+from models import db, User, Message, Follows
+
+CHUNK_SIZE = 10000
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# table, csv file, model
+FILES = [
+    ('users', 'users.csv', User),
+    ('messages', 'messages.csv', Message),
+    ('follows', 'follows.csv', Follows),
+]
+
+
+def is_postgres(engine):
+    return engine.dialect.name == 'postgresql'
+
+
+class Loader:
+    """Load the CSVs in `directory` into the database bound to `engine`."""
+
+    def __init__(self, engine, directory='generator', chunk_size=CHUNK_SIZE, out=print):
+        self.engine = engine
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.out = out
+        self.user_ids = set()
+        # usernames and emails taken, of the current chunk's
+        self.usernames = set()
+        self.emails = set()
+        # (followed, follower) pairs of the current chunk
+        self.follows = set()
+        self.follower = None
+
+    # ---- schema
+
+    def reset_schema(self):
+        """Fresh migrated tables with no secondary indexes or foreign keys yet."""
+
+        self._drop_tables()
+        upgrade(directory=MIGRATIONS)
+        with self.engine.begin() as conn:
+            self._drop_indexes(conn)
+            if is_postgres(self.engine):
+                self._drop_foreign_keys(conn)
+            conn.execute(text("CREATE TABLE IF NOT EXISTS load_progress "
+                              "(table_name VARCHAR(64) PRIMARY KEY, rows_done INTEGER NOT NULL)"))
+            conn.execute(text("DELETE FROM load_progress"))
+
+    def _drop_tables(self):
+        """Drop every table, including those the models don't know (partitions)."""
+
+        with self.engine.begin() as conn:
+            if is_postgres(self.engine):
+                for name in inspect(conn).get_table_names():
+                    conn.execute(text(f'DROP TABLE IF EXISTS "{name}" CASCADE'))
+            else:
+                meta = MetaData()
+                meta.reflect(bind=conn)
+                meta.drop_all(bind=conn)
+
+    def _drop_indexes(self, conn):
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(conn)
+        conn.execute(text("DROP INDEX IF EXISTS ix_users_username_trgm"))
+        conn.execute(text("DROP INDEX IF EXISTS ix_users_username_prefix"))
+
+    def _drop_foreign_keys(self, conn):
+        inspector = inspect(conn)
+        for table in db.metadata.sorted_tables:
+            for fk in inspector.get_foreign_keys(table.name):
+                conn.execute(text(f'ALTER TABLE {table.name} DROP CONSTRAINT "{fk["name"]}"'))
+
+    def _index_steps(self):
+        """(name, ddl callable) for everything reset_schema() left out."""
+
+        steps = []
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                steps.append((f"index:{index.name}", index.create))
+
+        if is_postgres(self.engine):
+            for table in db.metadata.sorted_tables:
+                for number, fk in enumerate(table.foreign_key_constraints):
+                    steps.append((f"fk:{table.name}:{number}",
+                                  lambda conn, fk=fk: conn.execute(AddConstraint(fk))))
+
+            steps.append(("index:ix_users_username_trgm", lambda conn: conn.execute(text(
+                "CREATE INDEX ix_users_username_trgm "
+                "ON users USING gin (lower(username) gin_trgm_ops)"))))
+            steps.append(("index:ix_users_username_prefix", lambda conn: conn.execute(text(
+                'CREATE INDEX ix_users_username_prefix ON users (lower(username) COLLATE "C")'))))
+
+            for table in ('users', 'messages'):
+                steps.append((f"sequence:{table}", lambda conn, table=table: conn.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f"coalesce((SELECT max(id) FROM {table}), 0) + 1, false)"))))
+
+        return steps
+
+    def build_indexes(self):
+        """Create what reset_schema() left out, then compute the user counters.
+
+        Each step commits with its own progress row, so a resumed load
+        skips the steps that already ran.
+        """
+
+        start = time.perf_counter()
+        for name, step in self._index_steps():
+            if self.rows_done(name):
+                continue
+            with self.engine.begin() as conn:
+                step(conn)
+                self._save_progress(conn, name, 1)
+            self.out(f"built {name}")
+
+        self.out(f"indexes and constraints built in {time.perf_counter() - start:.1f}s")
+
+        User.repair_counts()
+        db.session.commit()
+        self.out("user counters computed")
+
+    # ---- progress
+
+    def rows_done(self, table):
+        with self.engine.connect() as conn:
+            return conn.execute(text("SELECT rows_done FROM load_progress WHERE table_name = :t"),
+                                t=table).scalar() or 0
+
+    def _save_progress(self, conn, table, rows_done):
+        updated = conn.execute(text("UPDATE load_progress SET rows_done = :n WHERE table_name = :t"),
+                               n=rows_done, t=table).rowcount
+        if not updated:
+            conn.execute(text("INSERT INTO load_progress (table_name, rows_done) VALUES (:t, :n)"),
+                         t=table, n=rows_done)
+
+    # ---- rows
+
+    def _taken(self, rows):
+        """The usernames and emails of `rows` that are already in the database."""
+
+        rows = list(rows)
+        users = User.__table__
+        with self.engine.connect() as conn:
+            usernames = {username for (username,) in conn.execute(
+                select([users.c.username])
+                .where(users.c.username.in_({row['username'] for row in rows})))}
+            emails = {email for (email,) in conn.execute(
+                select([users.c.email])
+                .where(users.c.email.in_({row['email'] for row in rows})))}
+        return usernames, emails
+
+    def _start_chunk(self, model, chunk):
+        """Reset what _convert() checks a chunk's rows against."""
+
+        if model is User:
+            self.usernames, self.emails = self._taken(row for line, row in chunk)
+        elif model is Follows:
+            # follows.csv is sharded by follower, so a pair can only repeat
+            # within a chunk or across into the next from the same follower
+            self.follows = {pair for pair in self.follows if pair[1] == self.follower}
+
+    def _convert(self, model, row, line):
+        """CSV strings -> column values for `model`; None if the row is rejected."""
+
+        if model is User:
+            row.setdefault('id', line)
+            row['id'] = int(row['id'])
+            if row['username'] in self.usernames or row['email'] in self.emails:
+                return None
+            self.usernames.add(row['username'])
+            self.emails.add(row['email'])
+            return row
+
+        if model is Message:
+            row.setdefault('id', line)
+            row['id'] = int(row['id'])
+            row['user_id'] = int(row['user_id'])
+            row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+            return row if row['user_id'] in self.user_ids else None
+
+        row['user_being_followed_id'] = int(row['user_being_followed_id'])
+        row['user_following_id'] = int(row['user_following_id'])
+        pair = (row['user_being_followed_id'], row['user_following_id'])
+        valid = (row['user_being_followed_id'] in self.user_ids
+                 and row['user_following_id'] in self.user_ids
+                 and pair not in self.follows)
+        if not valid:
+            return None
+        self.follows.add(pair)
+        self.follower = row['user_following_id']
+        return row
+
+    def _chunks(self, reader, skip):
+        """Yield (first_line, rows) chunks of the CSV, skipping `skip` rows."""
+
+        chunk, first = [], skip + 1
+        for line, row in enumerate(reader, start=1):
+            if line <= skip:
+                continue
+            chunk.append((line, row))
+            if len(chunk) == self.chunk_size:
+                yield first, chunk
+                chunk, first = [], line + 1
+        if chunk:
+            yield first, chunk
+
+    def _insert(self, conn, model, rows):
+        if not rows:
+            return
+        table = model.__table__
+        columns = [column.name for column in table.columns if column.name in rows[0]]
+
+        if is_postgres(self.engine):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in rows:
+                writer.writerow(['' if row[c] is None else row[c] for c in columns])
+            buffer.seek(0)
+            cursor = conn.connection.cursor()
+            cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN "
+                               f"WITH (FORMAT csv)", buffer)
+        else:
+            conn.execute(table.insert(), [{c: row[c] for c in columns} for row in rows])
+
+    def _load_users(self):
+        """Ids of the users already in the database, for validating a resumed load.
+
+        Usernames and emails are checked against the database chunk by
+        chunk instead, see _taken().
+        """
+
+        with self.engine.connect() as conn:
+            self.user_ids.update(user_id for (user_id,) in conn.execute(
+                text("SELECT id FROM users")))
+
+    def load_file(self, table, filename, model):
+        """Stream one CSV into its table, resuming after rows already loaded.
+
+        Rejected rows go to <table>.rejects.csv, which is only created once
+        there is a reject; a resumed load appends to the interrupted one's.
+        """
+
+        path = os.path.join(self.directory, filename)
+        done = self.rows_done(table)
+        loaded = rejected = 0
+        start = time.perf_counter()
+        rejects_path = os.path.join(self.directory, f"{table}.rejects.csv")
+        if not done and os.path.exists(rejects_path):
+            os.remove(rejects_path)
+
+        with open(path, newline='') as source, ExitStack() as stack:
+            reader = csv.DictReader(source)
+            reject_writer = None
+
+            for first, chunk in self._chunks(reader, done):
+                self._start_chunk(model, chunk)
+                rows, bad = [], []
+                for line, row in chunk:
+                    raw = dict(row)
+                    converted = self._convert(model, row, line)
+                    if converted is None:
+                        bad.append(raw)
+                    else:
+                        rows.append(converted)
+
+                with self.engine.begin() as conn:
+                    self._insert(conn, model, rows)
+                    self._save_progress(conn, table, first + len(chunk) - 1)
+
+                # written once the chunk is committed, so a resumed load
+                # doesn't reject the same rows twice
+                if bad and reject_writer is None:
+                    new = not os.path.exists(rejects_path)
+                    rejects = stack.enter_context(open(rejects_path, 'a', newline=''))
+                    reject_writer = csv.DictWriter(rejects, fieldnames=reader.fieldnames,
+                                                   extrasaction='ignore')
+                    if new:
+                        reject_writer.writeheader()
+                if bad:
+                    reject_writer.writerows(bad)
+                    rejected += len(bad)
+
+                if model is User:
+                    self.user_ids.update(row['id'] for row in rows)
+
+                loaded += len(rows)
+                elapsed = time.perf_counter() - start
+                self.out(f"{table}: {first + len(chunk) - 1} rows read, {loaded} loaded, "
+                         f"{rejected} rejected, {loaded / elapsed:,.0f} rows/s")
+
+    def run(self, resume=False):
+        """Load everything; with `resume`, continue an interrupted load."""
+
+        if resume:
+            self._load_users()
+        else:
+            self.reset_schema()
+
+        for table, filename, model in FILES:
+            self.load_file(table, filename, model)
+
+        self.build_indexes()
@@ -0,0 +1,187 @@
+"""Always-on request and SQL instrumentation, exported for Prometheus.
+
+SQLAlchemy engine events count and time every statement run while a
+request is being handled; Flask's request signals turn that into
+per-endpoint histograms when the request finishes. Statements are also
+grouped by shape (the SQL text with bound parameters, IN lists collapsed),
+and a request that runs one shape METRICS_N_PLUS_ONE_THRESHOLD times or
+more is counted and logged as a likely N+1.
+
+Everything is exposed at /metrics in the Prometheus text format. The
+numbers are per worker process, like /_stats/cache.
+
+/metrics and the /_stats pages are only served to requests that carry
+STATS_TOKEN as a bearer token (`Authorization: Bearer <token>`, which
+Prometheus sends with `authorization` in its scrape config). Without a
+STATS_TOKEN they are refused to everyone.
+"""
+
+import hmac
+import re
+import time
+from collections import Counter
+from functools import wraps
+
+from flask import (abort, current_app, g, has_request_context, request,
+                   request_started, request_finished)
+from prometheus_client import CollectorRegistry, Counter as PromCounter, Histogram
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from sqlalchemy import event
+
+N_PLUS_ONE_THRESHOLD = 5
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+def stats_required(view):
+    """Refuse `view` (403) unless the request bears the STATS_TOKEN."""
+
+    @wraps(view)
+    def wrap(*args, **kwargs):
+        token = current_app.config.get('STATS_TOKEN')
+        scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+        if (not token or scheme.lower() != 'bearer'
+                or not hmac.compare_digest(given.encode(), token.encode())):
+            abort(403)
+        return view(*args, **kwargs)
+    return wrap
+
+
+IN_LIST = re.compile(r"\((?:\s*(?:\?|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|:\w+)\s*\)")
+
+
+def statement_shape(statement):
+    """The SQL text with IN lists collapsed, so `IN (?, ?)` and `IN (?, ?, ?)` match."""
+
+    return IN_LIST.sub("(?...)", statement)
+
+
+class RequestStats:
+    """SQL activity of the request being handled."""
+
+    __slots__ = ('statements', 'seconds', 'shapes', 'started')
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+        self.started = None
+
+
+class Instrumentation:
+    """Hooks the engine and the request signals and keeps the histograms."""
+
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        labels = ['endpoint', 'method']
+
+        self.request_seconds = Histogram(
+            'warbler_request_duration_seconds', "Time to handle a request.",
+            labels + ['status'], buckets=LATENCY_BUCKETS, registry=self.registry)
+        self.sql_statements = Histogram(
+            'warbler_request_sql_statements', "SQL statements run by a request.",
+            labels, buckets=STATEMENT_BUCKETS, registry=self.registry)
+        self.sql_seconds = Histogram(
+            'warbler_request_sql_duration_seconds', "Time a request spent in SQL.",
+            labels, buckets=LATENCY_BUCKETS, registry=self.registry)
+        self.repeated_statements = Histogram(
+            'warbler_request_repeated_statements',
+            "Runs of the most repeated statement shape in a request.",
+            labels, buckets=STATEMENT_BUCKETS, registry=self.registry)
+        self.n_plus_one = PromCounter(
+            'warbler_request_n_plus_one', "Requests that repeated a statement shape "
+            "at least METRICS_N_PLUS_ONE_THRESHOLD times.",
+            labels, registry=self.registry)
+
+        self.threshold = N_PLUS_ONE_THRESHOLD
+        self.logger = None
+
+    def init_app(self, app, engine):
+        """Start recording for `app` and the statements run on `engine`."""
+
+        self.threshold = app.config.setdefault('METRICS_N_PLUS_ONE_THRESHOLD',
+                                               N_PLUS_ONE_THRESHOLD)
+        self.logger = app.logger
+
+        self.watch(engine)
+
+        request_started.connect(self._request_started, app)
+        request_finished.connect(self._request_finished, app)
+
+        app.config.setdefault('STATS_TOKEN', None)
+        app.add_url_rule('/metrics', 'metrics', stats_required(self.view))
+
+    # ---- engine events
+
+    def watch(self, engine):
+        """Record the statements run on another engine (e.g. a replica)."""
+
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+
+    # the start time lives on the statement's execution context, not the
+    # pooled connection, so a failed statement can't leave it behind for
+    # the next one run outside a request
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None and has_request_context() and 'sql_stats' in g:
+            context.metrics_started = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, 'metrics_started', None)
+        if started is None:
+            return
+        del context.metrics_started
+        if not (has_request_context() and 'sql_stats' in g):
+            return
+        elapsed = time.perf_counter() - started
+
+        stats = g.sql_stats
+        stats.statements += 1
+        stats.seconds += elapsed
+        stats.shapes[statement] += 1
+
+    def _handle_error(self, exception_context):
+        context = exception_context.execution_context
+        if context is not None and hasattr(context, 'metrics_started'):
+            del context.metrics_started
+
+    # ---- request signals
+
+    def _request_started(self, sender, **extra):
+        g.sql_stats = RequestStats()
+        g.sql_stats.started = time.perf_counter()
+
+    def _request_finished(self, sender, response, **extra):
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return
+
+        endpoint = request.endpoint or 'unmatched'
+        method = request.method
+        self.request_seconds.labels(endpoint, method, response.status_code).observe(
+            time.perf_counter() - stats.started)
+        self.sql_statements.labels(endpoint, method).observe(stats.statements)
+        self.sql_seconds.labels(endpoint, method).observe(stats.seconds)
+
+        shapes = Counter()
+        for statement, count in stats.shapes.items():
+            shapes[statement_shape(statement)] += count
+        shape, repeats = shapes.most_common(1)[0] if shapes else (None, 0)
+        self.repeated_statements.labels(endpoint, method).observe(repeats)
+
+        if repeats >= self.threshold:
+            self.n_plus_one.labels(endpoint, method).inc()
+            self.logger.warning("possible N+1 in %s %s: %d x %s",
+                                method, endpoint, repeats, shape)
+
+    # ---- export
+
+    def view(self):
+        """The metrics in the Prometheus text exposition format."""
+
+        return generate_latest(self.registry), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,40 @@
+"""username search indexes
+
+Built concurrently on Postgres so the users table stays writable.
+
+Revision ID: 5b7e913c0f42
+Revises: 8e4d2c6a9b31
+Create Date: 2026-10-18 09:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e913c0f42'
+down_revision = '8e4d2c6a9b31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        with op.get_context().autocommit_block():
+            op.create_index('ix_users_username_lower', 'users', [sa.text('lower(username)')],
+                            postgresql_concurrently=True)
+            op.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_trgm "
+                       "ON users USING gin (lower(username) gin_trgm_ops)")
+    else:
+        op.create_index('ix_users_username_lower', 'users', [sa.text('lower(username)')])
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_trgm")
+            op.drop_index('ix_users_username_lower', table_name='users',
+                          postgresql_concurrently=True)
+    else:
+        op.drop_index('ix_users_username_lower', table_name='users')
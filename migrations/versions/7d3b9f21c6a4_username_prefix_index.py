@@ -0,0 +1,34 @@
+"""username prefix index
+
+Short search terms and autocomplete read usernames by prefix. On
+Postgres the lower(username) index sorts by the database collation, in
+which the prefix alone gives no upper bound for the scan; this index
+sorts by code point (COLLATE "C"), so a prefix is one bounded range.
+SQLite's lower(username) index already compares by code point.
+
+Revision ID: 7d3b9f21c6a4
+Revises: c5f19e3b8a47
+Create Date: 2026-10-18 21:10:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '7d3b9f21c6a4'
+down_revision = 'c5f19e3b8a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_prefix '
+                       'ON users (lower(username) COLLATE "C")')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_prefix")
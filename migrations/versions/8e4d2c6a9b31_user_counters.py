@@ -0,0 +1,39 @@
+"""denormalized user counters
+
+Revision ID: 8e4d2c6a9b31
+Revises: 3c1f0a2b7d10
+Create Date: 2026-10-18 09:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e4d2c6a9b31'
+down_revision = '3c1f0a2b7d10'
+branch_labels = None
+depends_on = None
+
+COUNTERS = {
+    'messages_count': "SELECT count(*) FROM messages WHERE messages.user_id = users.id",
+    'followers_count': "SELECT count(*) FROM follows WHERE follows.user_being_followed_id = users.id",
+    'following_count': "SELECT count(*) FROM follows WHERE follows.user_following_id = users.id",
+    'likes_count': "SELECT count(*) FROM likes WHERE likes.user_id = users.id",
+}
+
+
+def upgrade():
+    for column in COUNTERS:
+        op.add_column('users', sa.Column(column, sa.Integer(), nullable=False,
+                                         server_default='0'))
+
+    # same as `flask repair-counts`
+    for column, count in COUNTERS.items():
+        op.execute(f"UPDATE users SET {column} = ({count})")
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        for column in COUNTERS:
+            batch_op.drop_column(column)
@@ -0,0 +1,34 @@
+"""who to follow recommendations
+
+Revision ID: 9a7d2e04c6b8
+Revises: e81c4f9a2d53
+Create Date: 2026-10-18 17:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a7d2e04c6b8'
+down_revision = 'e81c4f9a2d53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'recommendations',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('rank', sa.Integer(), nullable=False),
+        sa.Column('candidate_id', sa.Integer(), nullable=False),
+        sa.Column('score', sa.Float(), nullable=False),
+        sa.Column('mutuals', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(['candidate_id'], ['users.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('user_id', 'rank'),
+    )
+
+
+def downgrade():
+    op.drop_table('recommendations')
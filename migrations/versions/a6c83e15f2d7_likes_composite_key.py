@@ -0,0 +1,91 @@
+"""key likes by (user_id, message_id)
+
+The surrogate id and the unique constraint on message_id (which let only
+one user ever like a message) are dropped; the (user_id, message_id)
+index becomes the primary key, and message_id gets its own index for
+per-message lookups and cascades.
+
+Revision ID: a6c83e15f2d7
+Revises: d92a4f7e1c58
+Create Date: 2026-10-18 12:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6c83e15f2d7'
+down_revision = 'd92a4f7e1c58'
+branch_labels = None
+depends_on = None
+
+
+def _likes(*extra):
+    """The likes table as it stands, for batch mode to copy from.
+
+    Given explicitly because the unique constraint on message_id has no
+    name outside Postgres, so batch mode couldn't drop a reflected one.
+    """
+
+    meta = sa.MetaData()
+    sa.Table('users', meta, sa.Column('id', sa.Integer(), primary_key=True))
+    sa.Table('messages', meta, sa.Column('id', sa.Integer(), primary_key=True))
+    return sa.Table(
+        'likes', meta,
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('message_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='cascade'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='cascade'),
+        *extra
+    )
+
+
+def upgrade():
+    op.execute("DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL")
+    op.drop_index('ix_likes_user_id_message_id', table_name='likes')
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_constraint('likes_message_id_key', 'likes', type_='unique')
+        op.drop_constraint('likes_pkey', 'likes', type_='primary')
+        op.drop_column('likes', 'id')
+        op.alter_column('likes', 'user_id', nullable=False)
+        op.alter_column('likes', 'message_id', nullable=False)
+        op.create_primary_key('likes_pkey', 'likes', ['user_id', 'message_id'])
+        with op.get_context().autocommit_block():
+            op.create_index('ix_likes_message_id', 'likes', ['message_id'],
+                            postgresql_concurrently=True)
+    else:
+        old = _likes(sa.Column('id', sa.Integer(), primary_key=True))
+        with op.batch_alter_table('likes', copy_from=old, recreate='always') as batch_op:
+            batch_op.drop_column('id')
+            batch_op.create_primary_key('likes_pkey', ['user_id', 'message_id'])
+        op.create_index('ix_likes_message_id', 'likes', ['message_id'])
+
+
+def downgrade():
+    # only one like per message fits the old schema: keep the first
+    op.execute("DELETE FROM likes WHERE EXISTS (SELECT 1 FROM likes b "
+               "WHERE b.message_id = likes.message_id AND b.user_id < likes.user_id)")
+
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.drop_index('ix_likes_message_id', table_name='likes',
+                          postgresql_concurrently=True)
+        op.drop_constraint('likes_pkey', 'likes', type_='primary')
+        op.execute("ALTER TABLE likes ADD COLUMN id SERIAL")
+        op.create_primary_key('likes_pkey', 'likes', ['id'])
+        op.alter_column('likes', 'user_id', nullable=True)
+        op.alter_column('likes', 'message_id', nullable=True)
+        op.create_unique_constraint('likes_message_id_key', 'likes', ['message_id'])
+    else:
+        op.drop_index('ix_likes_message_id', table_name='likes')
+        # copied without its composite key, which is replaced by id
+        with op.batch_alter_table('likes', copy_from=_likes(), recreate='always') as batch_op:
+            # NULLs become row ids in an INTEGER PRIMARY KEY
+            batch_op.add_column(sa.Column('id', sa.Integer(), primary_key=True))
+            batch_op.alter_column('user_id', nullable=True)
+            batch_op.alter_column('message_id', nullable=True)
+            batch_op.create_unique_constraint('likes_message_id_key', ['message_id'])
+
+    op.create_index('ix_likes_user_id_message_id', 'likes', ['user_id', 'message_id'])
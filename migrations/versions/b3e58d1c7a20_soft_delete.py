@@ -0,0 +1,41 @@
+"""soft delete and background purges
+
+Revision ID: b3e58d1c7a20
+Revises: f4b1d07a93e6
+Create Date: 2026-10-18 15:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e58d1c7a20'
+down_revision = 'f4b1d07a93e6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+    op.add_column('messages', sa.Column('deleted_at', sa.DateTime(), nullable=True))
+
+    op.create_table(
+        'purges',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.Text(), nullable=False),
+        sa.Column('target_id', sa.Integer(), nullable=False),
+        sa.Column('requested_at', sa.DateTime(), nullable=False),
+        sa.Column('rows_deleted', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade():
+    op.drop_table('purges')
+
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_column('deleted_at')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('deleted_at')
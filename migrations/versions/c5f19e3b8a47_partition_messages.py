@@ -0,0 +1,146 @@
+"""monthly message partitions and the message archive
+
+On Postgres `messages` becomes a table range-partitioned by month on
+timestamp. The existing table is attached as its first partition,
+messages_legacy, holding everything before next month; it is archived
+as a whole once that is past the retention (see partitions.py). The key
+of a partitioned table must include the partition column, so the likes
+foreign key to messages.id is dropped.
+
+ATTACH PARTITION would otherwise do two long jobs while holding the
+lock taken by the rename: scan the legacy table to check its bound, and
+build the parent's (id, timestamp) key index over it. Both are done
+beforehand without blocking writes: the bound as a CHECK constraint
+added NOT VALID and validated in its own transaction, the index with
+CREATE UNIQUE INDEX CONCURRENTLY, turned into a constraint that ATTACH
+adopts as the legacy partition's part of the key.
+
+messages_legacy is one partition, so pre-migration history isn't pruned
+by month. Retention doesn't wait for it to expire as a whole: rollover
+moves its messages older than the retention to the archive in batches
+(see partitions.py), so by the time it is dropped little is left in it.
+
+Deploy risk: the Postgres path is covered by test_partitions.py against
+the Postgres test database, but has not been rehearsed on production
+sized data. Do that on a copy of production first.
+
+Revision ID: c5f19e3b8a47
+Revises: 9a7d2e04c6b8
+Create Date: 2026-10-18 18:40:00.000000
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5f19e3b8a47'
+down_revision = '9a7d2e04c6b8'
+branch_labels = None
+depends_on = None
+
+PARTITIONS_AHEAD = 3
+
+COLUMNS = "id, text, timestamp, user_id, like_count"
+
+
+def month_start(when, months=0):
+    index = when.year * 12 + when.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def upgrade():
+    op.create_table(
+        'messages_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('text', sa.String(length=140), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('like_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_messages_archive_user_id_timestamp', 'messages_archive',
+                    ['user_id', 'timestamp', 'id'])
+
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    newest = op.get_bind().execute(sa.text("SELECT max(timestamp) FROM messages")).scalar()
+    now = datetime.utcnow()
+    legacy_end = month_start(max(now, newest or now), 1)
+
+    with op.get_context().autocommit_block():
+        # left behind if an earlier attempt failed after this block
+        op.execute("ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_legacy_bound")
+        op.execute(f"ALTER TABLE messages ADD CONSTRAINT messages_legacy_bound "
+                   f"CHECK (timestamp < '{legacy_end}') NOT VALID")
+        op.execute("ALTER TABLE messages VALIDATE CONSTRAINT messages_legacy_bound")
+
+        # the partitioned key's index, for ATTACH to adopt instead of building
+        op.execute("ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_legacy_id_timestamp_key")
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS messages_legacy_id_timestamp_key")
+        op.execute("CREATE UNIQUE INDEX CONCURRENTLY messages_legacy_id_timestamp_key "
+                   "ON messages (id, timestamp)")
+        op.execute("ALTER TABLE messages ADD CONSTRAINT messages_legacy_id_timestamp_key "
+                   "UNIQUE USING INDEX messages_legacy_id_timestamp_key")
+
+    op.drop_constraint('likes_message_id_fkey', 'likes', type_='foreignkey')
+
+    op.execute("ALTER TABLE messages RENAME TO messages_legacy")
+    op.execute("ALTER TABLE messages_legacy RENAME CONSTRAINT messages_pkey TO messages_legacy_pkey")
+    op.execute("ALTER INDEX ix_messages_user_id_timestamp "
+               "RENAME TO messages_legacy_user_id_timestamp_idx")
+
+    op.execute("""
+        CREATE TABLE messages (
+            id integer NOT NULL DEFAULT nextval('messages_id_seq'),
+            text varchar(140) NOT NULL,
+            timestamp timestamp without time zone NOT NULL,
+            user_id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            like_count integer NOT NULL DEFAULT 0,
+            deleted_at timestamp without time zone,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """)
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+    op.create_index('ix_messages_user_id_timestamp', 'messages', ['user_id', 'timestamp', 'id'])
+
+    # the validated CHECK and NOT NULL imply the bound and the key index
+    # exists, so this neither scans nor builds
+    op.execute(f"ALTER TABLE messages ATTACH PARTITION messages_legacy "
+               f"FOR VALUES FROM (MINVALUE) TO ('{legacy_end}')")
+    op.execute("ALTER TABLE messages_legacy DROP CONSTRAINT messages_legacy_bound")
+
+    start = legacy_end
+    while start < month_start(now, PARTITIONS_AHEAD + 1):
+        end = month_start(start, 1)
+        op.execute(f"CREATE TABLE messages_p{start:%Y_%m} PARTITION OF messages "
+                   f"FOR VALUES FROM ('{start}') TO ('{end}')")
+        start = end
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        # back to one plain table with every partition's rows
+        op.execute("CREATE TABLE messages_plain (LIKE messages INCLUDING DEFAULTS)")
+        op.execute("INSERT INTO messages_plain SELECT * FROM messages")
+        op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages_plain.id")
+        op.execute("DROP TABLE messages")
+        op.execute("ALTER TABLE messages_plain RENAME TO messages")
+        op.create_primary_key('messages_pkey', 'messages', ['id'])
+        op.create_foreign_key('messages_user_id_fkey', 'messages', 'users',
+                              ['user_id'], ['id'], ondelete='CASCADE')
+        op.create_index('ix_messages_user_id_timestamp', 'messages',
+                        ['user_id', 'timestamp', 'id'])
+
+    op.execute(f"INSERT INTO messages ({COLUMNS}) SELECT {COLUMNS} FROM messages_archive")
+    op.drop_index('ix_messages_archive_user_id_timestamp', table_name='messages_archive')
+    op.drop_table('messages_archive')
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DELETE FROM likes WHERE message_id NOT IN (SELECT id FROM messages)")
+        op.create_foreign_key('likes_message_id_fkey', 'likes', 'messages',
+                              ['message_id'], ['id'], ondelete='cascade')
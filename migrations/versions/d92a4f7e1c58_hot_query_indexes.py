@@ -0,0 +1,47 @@
+"""indexes for the hot query patterns
+
+- messages by author, newest first: (user_id, timestamp, id)
+- follows by follower, the second column of the primary key
+- likes by user
+
+Built concurrently on Postgres so the tables stay writable.
+
+Revision ID: d92a4f7e1c58
+Revises: 5b7e913c0f42
+Create Date: 2026-10-18 09:30:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd92a4f7e1c58'
+down_revision = '5b7e913c0f42'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_messages_user_id_timestamp', 'messages', ['user_id', 'timestamp', 'id']),
+    ('ix_follows_user_following_id', 'follows', ['user_following_id', 'user_being_followed_id']),
+    ('ix_likes_user_id_message_id', 'likes', ['user_id', 'message_id']),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.create_index(name, table, columns, postgresql_concurrently=True)
+    else:
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.drop_index(name, table_name=table, postgresql_concurrently=True)
+    else:
+        for name, table, columns in INDEXES:
+            op.drop_index(name, table_name=table)
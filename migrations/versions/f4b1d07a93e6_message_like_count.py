@@ -0,0 +1,30 @@
+"""per-message like counts
+
+Revision ID: f4b1d07a93e6
+Revises: a6c83e15f2d7
+Create Date: 2026-10-18 12:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4b1d07a93e6'
+down_revision = 'a6c83e15f2d7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('messages', sa.Column('like_count', sa.Integer(), nullable=False,
+                                        server_default='0'))
+
+    # same as `flask reconcile-like-counts`
+    op.execute("UPDATE messages SET like_count = "
+               "(SELECT count(*) FROM likes WHERE likes.message_id = messages.id)")
+
+
+def downgrade():
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_column('like_count')
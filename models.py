@@ -2,11 +2,16 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hasher
+from replicas import RoutingSQLAlchemy
+
+# reads may go to a replica, see replicas.py
+db = RoutingSQLAlchemy()
+
+MAX_MESSAGE_LENGTH = 140
 
 
 class Follows(db.Model):
@@ -14,6 +19,12 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # the primary key covers "who follows X"; this covers "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -26,29 +37,117 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? (single EXISTS lookup)"""
+
+        query = cls.query.filter_by(user_being_followed_id=followed_id,
+                                    user_following_id=follower_id)
+        return db.session.query(query.exists()).scalar()
+
+    @classmethod
+    def followed_among(cls, follower_id, user_ids):
+        """Which of `user_ids` does `follower_id` follow? One query, returns a set."""
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(cls.user_being_followed_id)
+                .filter(cls.user_following_id == follower_id,
+                        cls.user_being_followed_id.in_(user_ids)))
+        return {user_id for (user_id,) in rows}
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True,
-        autoincrement = True
+    # the primary key covers "what did X like"; this covers "who liked message Y"
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
+    # no foreign key: a partitioned `messages` can't be referenced by id
+    # alone, and likes outlive a message's move to `messages_archive`;
+    # purge.py deletes the likes of deleted messages itself
     message_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
     )
 
+    @classmethod
+    def add(cls, user_id, message_ids):
+        """Like `message_ids` as `user_id`; returns the ids that were not already liked.
+
+        A single INSERT ... ON CONFLICT DO NOTHING RETURNING on Postgres, so
+        repeating it is harmless and concurrent likes don't race. Other
+        databases look up the existing likes first.
+        """
+
+        if not message_ids:
+            return []
+
+        if db.engine.dialect.name == 'postgresql':
+            statement = (pg_insert(cls.__table__)
+                         .values([dict(user_id=user_id, message_id=message_id)
+                                  for message_id in message_ids])
+                         .on_conflict_do_nothing()
+                         .returning(cls.message_id))
+            return [message_id for (message_id,) in db.session.execute(statement)]
+
+        liked = cls.message_ids_liked_by(user_id, message_ids)
+        added = [message_id for message_id in message_ids if message_id not in liked]
+        if added:
+            db.session.execute(cls.__table__.insert().prefix_with('OR IGNORE').values(
+                [dict(user_id=user_id, message_id=message_id) for message_id in added]))
+        return added
+
+    @classmethod
+    def remove(cls, user_id, message_ids):
+        """Unlike `message_ids` as `user_id`; returns the ids that were liked.
+
+        A single DELETE ... RETURNING on Postgres.
+        """
+
+        if not message_ids:
+            return []
+
+        statement = cls.__table__.delete().where(
+            (cls.user_id == user_id) & cls.message_id.in_(message_ids))
+
+        if db.engine.dialect.name == 'postgresql':
+            return [message_id for (message_id,)
+                    in db.session.execute(statement.returning(cls.message_id))]
+
+        removed = sorted(cls.message_ids_liked_by(user_id, message_ids))
+        if removed:
+            db.session.execute(statement)
+        return removed
+
+    @classmethod
+    def message_ids_liked_by(cls, user_id, message_ids):
+        """Which of `message_ids` has `user_id` liked?
+
+        One query restricted to the given ids, so the cost does not grow
+        with the size of the user's like history. Returns a set.
+        """
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(cls.message_id)
+                .filter(cls.user_id == user_id, cls.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
+
     def serialize(self):
         """Serialize our object like to dictionary for json"""
         return {
@@ -102,6 +201,42 @@ class User(db.Model):
         nullable=False,
     )
 
+    # denormalized counters, kept in step by the write paths below;
+    # User.repair_counts() recomputes them from the base tables
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # set when the account is deleted; purge.py removes the rows later
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -120,7 +255,10 @@ class User(db.Model):
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        primaryjoin="Likes.user_id == User.id",
+        secondaryjoin="Likes.message_id == Message.id",
+        foreign_keys="[Likes.user_id, Likes.message_id]",
     )
 
     def __repr__(self):
@@ -129,14 +267,113 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(follower_id=self.id, followed_id=other_user.id)
+
+    def following_among(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        One indexed query against `follows` for a whole page of users,
+        instead of calling is_following once per user. Returns a set.
+        """
+
+        return Follows.followed_among(self.id, user_ids)
+
+    @classmethod
+    def visible(cls):
+        """Query of the users that have not been deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+    @classmethod
+    def following_of(cls, user_id):
+        """Users that `user_id` follows."""
+
+        return (cls.visible()
+                .join(Follows, Follows.user_being_followed_id == cls.id)
+                .filter(Follows.user_following_id == user_id)
+                .all())
+
+    @classmethod
+    def followers_of(cls, user_id):
+        """Users following `user_id`."""
+
+        return (cls.visible()
+                .join(Follows, Follows.user_following_id == cls.id)
+                .filter(Follows.user_being_followed_id == user_id)
+                .all())
+
+    @classmethod
+    def bump_counts(cls, user_ids, **deltas):
+        """Atomically add `deltas` to counter columns, e.g. likes_count=1.
+
+        `user_ids` is a single id, a list of ids or a query of ids. Runs as
+        an UPDATE inside the current transaction, so the counters commit
+        (or roll back) together with the change they count.
+        """
+
+        if isinstance(user_ids, int):
+            query = cls.query.filter(cls.id == user_ids)
+        else:
+            query = cls.query.filter(cls.id.in_(user_ids))
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+        query.update(values, synchronize_session=False)
+
+    @classmethod
+    def repair_counts(cls):
+        """Recompute every counter column from the base tables in bulk."""
+
+        # archived messages still count towards a profile's total
+        counts = {
+            cls.messages_count: select([func.count(Message.id)])
+                                .where((Message.user_id == cls.id)
+                                       & Message.deleted_at.is_(None)).as_scalar()
+                                + select([func.count(MessageArchive.id)])
+                                .where(MessageArchive.user_id == cls.id).as_scalar(),
+            cls.followers_count: select([func.count()])
+                                 .where(Follows.user_being_followed_id == cls.id).as_scalar(),
+            cls.following_count: select([func.count()])
+                                 .where(Follows.user_following_id == cls.id).as_scalar(),
+            cls.likes_count: select([func.count()])
+                             .where(Likes.user_id == cls.id).as_scalar(),
+        }
+        cls.query.update(counts, synchronize_session=False)
+
+    def follow(self, other_user):
+        """Start following `other_user` and update both users' counters."""
+
+        self.following.append(other_user)
+        User.bump_counts(self.id, following_count=1)
+        User.bump_counts(other_user.id, followers_count=1)
+
+    def unfollow(self, other_user):
+        """Stop following `other_user` and update both users' counters."""
+
+        self.following.remove(other_user)
+        User.bump_counts(self.id, following_count=-1)
+        User.bump_counts(other_user.id, followers_count=-1)
+
+    def add_message(self, msg):
+        """Post `msg` as this user."""
+
+        self.messages.append(msg)
+        User.bump_counts(self.id, messages_count=1)
+
+    def soft_delete(self):
+        """Hide this account and everything it wrote; purge.py deletes the rows.
+
+        Other users' counters are corrected as the purge removes the
+        follows and likes they count.
+        """
+
+        self.deleted_at = datetime.utcnow()
+        db.session.add(Purge(kind='user', target_id=self.id))
 
     @classmethod
     def signup(cls, username, email, password, image_url='', header_image_url='', bio='', location=''):
@@ -145,7 +382,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -169,37 +406,78 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A hash made at an outdated cost is replaced on success; the caller
+        commits it along with the rest of the request.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.visible().filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
 
 
+# Username search (see search.py): a lower(username) expression index
+# everywhere, plus on Postgres a trigram GIN index for substring search
+# and a code point ordered one for prefixes.
+
+db.Index('ix_users_username_lower', func.lower(User.username))
+
+event.listen(
+    User.__table__,
+    'before_create',
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect='postgresql')
+)
+
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL("CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+        "ON users USING gin (lower(username) gin_trgm_ops)").execute_if(dialect='postgresql')
+)
+
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL('CREATE INDEX IF NOT EXISTS ix_users_username_prefix '
+        'ON users (lower(username) COLLATE "C")').execute_if(dialect='postgresql')
+)
+
+
 class Message(db.Model):
-    """An individual message ("warble")."""
+    """An individual message ("warble").
+
+    On Postgres the migrated table is range-partitioned by month on
+    timestamp (its key is (id, timestamp)); see partitions.py.
+    """
 
     __tablename__ = 'messages'
 
+    # profile feeds and timelines filter on user_id and page on (timestamp, id)
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
     )
 
     text = db.Column(
-        db.String(140),
+        db.String(MAX_MESSAGE_LENGTH),
         nullable=False,
     )
 
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -208,16 +486,278 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # maintained by likecounts.py (write-behind) and repair_like_counts()
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # set when the message is deleted; purge.py removes the rows later
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     user = db.relationship('User')
 
+    @classmethod
+    def visible(cls):
+        """Query of messages that are not deleted and whose author is not deleted."""
+
+        return (cls.query
+                .join(User, cls.user_id == User.id)
+                .filter(cls.deleted_at.is_(None), User.deleted_at.is_(None)))
+
+    @classmethod
+    def bump_like_counts(cls, connection, deltas):
+        """Apply {message_id: delta} to like_count, one UPDATE per distinct delta.
+
+        Runs on `connection` rather than the session, so the write-behind
+        flush never touches a request's transaction.
+        """
+
+        by_delta = {}
+        for message_id, delta in deltas.items():
+            if delta:
+                by_delta.setdefault(delta, []).append(message_id)
+
+        for delta, message_ids in by_delta.items():
+            connection.execute(cls.__table__.update()
+                               .where(cls.id.in_(message_ids))
+                               .values(like_count=cls.like_count + delta))
+
+    @classmethod
+    def repair_like_counts(cls, first_id=None, last_id=None):
+        """Recompute like_count from the likes table, optionally for an id range."""
+
+        query = cls.query
+        if first_id is not None:
+            query = query.filter(cls.id >= first_id)
+        if last_id is not None:
+            query = query.filter(cls.id <= last_id)
+
+        count = select([func.count()]).where(Likes.message_id == cls.id).as_scalar()
+        return query.update({cls.like_count: count}, synchronize_session=False)
+
+    def soft_delete(self):
+        """Hide this message; purge.py deletes it and its likes later."""
+
+        self.deleted_at = datetime.utcnow()
+        User.bump_counts(self.user_id, messages_count=-1)
+        db.session.add(Purge(kind='message', target_id=self.id))
+
     def serialize(self):
         """Serialize our object message to dictionary for json"""
         return {
+            "id": self.id,
             "text": self.text,
-            "user_id": self.user_id
+            "timestamp": self.timestamp.isoformat() if self.timestamp else None,
+            "user_id": self.user_id,
+            "like_count": self.like_count,
         }
 
 
+class MessageArchive(db.Model):
+    """A message moved out of `messages` after MESSAGES_RETENTION_MONTHS.
+
+    Read-only: it can still be shown on its own page but is no longer in
+    timelines. Deleted messages aren't archived.
+    """
+
+    __tablename__ = 'messages_archive'
+
+    __table_args__ = (
+        db.Index('ix_messages_archive_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    text = db.Column(
+        db.String(MAX_MESSAGE_LENGTH),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+
+class Recommendation(db.Model):
+    """An account suggested to a user, written by recommendations.py."""
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # 1 is the best suggestion
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    candidate_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # how many of the user's followees follow the candidate
+    mutuals = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class Purge(db.Model):
+    """A soft-deleted user or message whose rows purge.py has yet to remove."""
+
+    __tablename__ = 'purges'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # 'user' or 'message'
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    target_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+
+class Job(db.Model):
+    """A unit of deferred work for jobs.py."""
+
+    __tablename__ = 'jobs'
+
+    # workers look for due jobs by status and time
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # the registered task to run
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # JSON keyword arguments for the task
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # enqueueing twice with the same key adds only one job
+    idempotency_key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    # queued, running, done or failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # not to be started before this (retries back off by moving it)
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # a running job whose worker hasn't finished it by then is run again
+    locked_until = db.Column(
+        db.DateTime,
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
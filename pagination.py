@@ -0,0 +1,86 @@
+"""Keyset (cursor) pagination for message feeds.
+
+Pages are keyed on (Message.timestamp, Message.id) instead of OFFSET, so
+page 50 costs the same as page 1. Cursors are opaque to the client.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from models import Message
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(msg):
+    """Opaque cursor pointing just after `msg`."""
+
+    raw = f"{msg.timestamp.isoformat()}|{msg.id}"
+    return urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (timestamp, id); None for no cursor.
+
+    Raises ValueError for a malformed cursor.
+    """
+
+    if not cursor:
+        return None
+    try:
+        timestamp, message_id = urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (TypeError, UnicodeDecodeError, ValueError) as exc:
+        raise ValueError(f"Bad cursor: {cursor!r}") from exc
+
+
+def page_size(value, default=PAGE_SIZE):
+    """Page size from a query string value, clamped to MAX_PAGE_SIZE."""
+
+    try:
+        return max(1, min(int(value), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return default
+
+
+def newest_first(query, before=None):
+    """Order a Message query newest first, starting after `before`."""
+
+    if before:
+        timestamp, message_id = before
+        query = query.filter(or_(Message.timestamp < timestamp,
+                                 and_(Message.timestamp == timestamp,
+                                      Message.id < message_id)))
+    return query.order_by(Message.timestamp.desc(), Message.id.desc())
+
+
+def newest_page(query, limit, before=None, recent=None):
+    """Up to `limit` rows of a Message query, newest first, starting after `before`.
+
+    With `recent` (a timedelta), rows up to that long before the cursor
+    (or now) are read first and older ones only to fill a short page, so
+    a time-partitioned `messages` is mostly read from its newest
+    partitions.
+    """
+
+    if recent is None:
+        return newest_first(query, before).limit(limit).all()
+
+    since = (before[0] if before else datetime.utcnow()) - recent
+    rows = newest_first(query.filter(Message.timestamp >= since), before).limit(limit).all()
+    if len(rows) < limit:
+        rows += (newest_first(query.filter(Message.timestamp < since), before)
+                 .limit(limit - len(rows))
+                 .all())
+    return rows
+
+
+def next_cursor(messages, limit):
+    """Cursor for the page after `messages`, or None on the last page."""
+
+    if len(messages) < limit:
+        return None
+    return encode_cursor(messages[-1])
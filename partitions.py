@@ -0,0 +1,273 @@
+"""Monthly partitions of `messages`, and archival of old messages.
+
+On Postgres the migrated `messages` table is range-partitioned on
+timestamp, one partition per calendar month (messages_p2026_10, ...), so
+index and vacuum work follow recent history rather than all of it, and a
+query bounded in time only touches the partitions it needs.
+
+    flask rollover-messages
+
+(also a jobs.py task; run it at least once a month) creates partitions
+for the next MESSAGES_PARTITIONS_AHEAD months and archives every
+partition that ended MESSAGES_RETENTION_MONTHS or more ago. So that
+`messages` is only locked for a moment, that takes three transactions:
+the partition's messages are copied to `messages_archive` while it is
+still attached; it is detached; then changes made to it during the copy
+(likes, deletions) are carried over, it is exported to
+<dir>/<partition>.csv.gz if MESSAGES_ARCHIVE_DIR is set, and dropped. A
+partition left detached by an interrupted run is finished by the next.
+
+A partition that is only partly past the retention (messages_legacy,
+which holds everything from before the migration) has its expired
+messages moved to the archive in batches of MESSAGES_ARCHIVE_BATCH, as
+for a plain table below.
+
+Where `messages` is a plain table (SQLite, or a database made with
+db.create_all()) there is nothing to create; messages older than the
+retention are moved to the archive in batches of MESSAGES_ARCHIVE_BATCH
+instead.
+
+Deleted messages aren't archived. Feeds look at the last
+MESSAGES_RECENT_DAYS first (see feed.py), so Postgres prunes most pages
+to the newest one or two partitions. Archived messages drop out of feeds,
+but /messages/<id> still finds them.
+"""
+
+import csv
+import gzip
+import os
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, text
+
+from models import db, Message, MessageArchive
+
+PARTITIONS_AHEAD = 3
+RETENTION_MONTHS = 12
+RECENT_DAYS = 30
+ARCHIVE_BATCH = 1000
+# how long DETACH may queue for its lock, blocking everything behind it
+DETACH_LOCK_TIMEOUT = '5s'
+
+messages = Message.__table__
+archive = MessageArchive.__table__
+ARCHIVED_COLUMNS = [column.name for column in archive.c]
+
+# pg_get_expr() of a range partition's bound
+BOUNDS = re.compile(r"FROM \((.+)\) TO \((.+)\)")
+
+
+def month_start(when, months=0):
+    """Midnight on the first day of `when`'s month, `months` months later."""
+
+    index = when.year * 12 + when.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(start):
+    return f"messages_p{start:%Y_%m}"
+
+
+def parse_bound(value):
+    """A partition bound as a datetime; None for MINVALUE or MAXVALUE."""
+
+    value = value.strip("'")
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.fromisoformat(value)
+
+
+class MessagePartitions:
+    """Creates upcoming partitions of `messages` and archives expired ones."""
+
+    def __init__(self):
+        self.app = None
+        self.ahead = PARTITIONS_AHEAD
+        self.retention = RETENTION_MONTHS
+        self.recent = timedelta(days=RECENT_DAYS)
+        self.batch_size = ARCHIVE_BATCH
+        self.archive_dir = None
+
+    def init_app(self, app):
+        """Read MESSAGES_PARTITIONS_AHEAD, MESSAGES_RETENTION_MONTHS,
+        MESSAGES_RECENT_DAYS, MESSAGES_ARCHIVE_BATCH and MESSAGES_ARCHIVE_DIR."""
+
+        self.app = app
+        self.ahead = app.config.setdefault('MESSAGES_PARTITIONS_AHEAD', PARTITIONS_AHEAD)
+        self.retention = app.config.setdefault('MESSAGES_RETENTION_MONTHS', RETENTION_MONTHS)
+        self.recent = timedelta(days=app.config.setdefault('MESSAGES_RECENT_DAYS', RECENT_DAYS))
+        self.batch_size = app.config.setdefault('MESSAGES_ARCHIVE_BATCH', ARCHIVE_BATCH)
+        self.archive_dir = app.config.setdefault('MESSAGES_ARCHIVE_DIR', None)
+
+    def _engine(self):
+        return db.get_engine(self.app)
+
+    def partitioned(self, conn):
+        """Whether `messages` is a partitioned table here."""
+
+        if conn.dialect.name != 'postgresql':
+            return False
+        return conn.execute(text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+                                 "WHERE partrelid = to_regclass('messages'))")).scalar()
+
+    def partitions(self, conn):
+        """(name, start, end) of each partition, oldest first; open bounds are None."""
+
+        found = []
+        for name, bounds in conn.execute(text(
+                "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+                "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = 'messages'::regclass")):
+            match = BOUNDS.search(bounds)
+            if match:
+                found.append((name, parse_bound(match.group(1)), parse_bound(match.group(2))))
+        return sorted(found, key=lambda partition: partition[2] or datetime.max)
+
+    def rollover(self, now=None):
+        """Create upcoming partitions and archive expired messages.
+
+        Returns the partitions created and archived and how many
+        messages went to the archive.
+        """
+
+        now = now or datetime.utcnow()
+        cutoff = month_start(now, -self.retention)
+
+        with self._engine().connect() as conn:
+            partitioned = self.partitioned(conn)
+        if not partitioned:
+            return dict(created=[], archived=[], messages=self.move_before(cutoff))
+
+        created = self.create_ahead(now)
+        archived, moved = self.archive_before(cutoff)
+        # what's left before the cutoff is in a partition that straddles it
+        moved += self.move_before(cutoff)
+        return dict(created=created, archived=archived, messages=moved)
+
+    def create_ahead(self, now):
+        """Create the partitions from this month to MESSAGES_PARTITIONS_AHEAD ahead."""
+
+        created = []
+        with self._engine().begin() as conn:
+            taken = [(start, end) for _, start, end in self.partitions(conn)]
+            for months in range(self.ahead + 1):
+                start, end = month_start(now, months), month_start(now, months + 1)
+                if any((lower is None or lower < end) and (upper is None or upper > start)
+                       for lower, upper in taken):
+                    continue
+                name = partition_name(start)
+                conn.execute(text(f"CREATE TABLE {name} PARTITION OF messages "
+                                  f"FOR VALUES FROM ('{start}') TO ('{end}')"))
+                created.append(name)
+        return created
+
+    def detached(self, conn):
+        """Names of partitions detached for archiving but not yet dropped."""
+
+        return [name for (name,) in conn.execute(text(
+            "SELECT relname FROM pg_class WHERE relkind = 'r' AND NOT relispartition "
+            "AND obj_description(oid, 'pg_class') = 'archiving'"))]
+
+    def archive_before(self, cutoff):
+        """Archive the partitions that end at or before `cutoff`; see the module docstring."""
+
+        with self._engine().connect() as conn:
+            leftover = self.detached(conn)
+            expired = [name for name, _, end in self.partitions(conn)
+                       if end is not None and end <= cutoff]
+
+        moved = 0
+        for name in leftover:
+            moved += self._finish(name)
+        for name in expired:
+            self._copy(name)
+            self._detach(name)
+            moved += self._finish(name)
+        return leftover + expired, moved
+
+    def _copy(self, name):
+        """Copy partition `name`'s messages to the archive; it stays attached."""
+
+        columns = ', '.join(ARCHIVED_COLUMNS)
+        with self._engine().begin() as conn:
+            # an interrupted run may have copied some already
+            conn.execute(text(
+                f"INSERT INTO messages_archive ({columns}) "
+                f"SELECT {columns} FROM {name} WHERE deleted_at IS NULL "
+                f"ON CONFLICT (id) DO UPDATE SET like_count = EXCLUDED.like_count"))
+
+    def _detach(self, name):
+        """Detach partition `name`, marking it for _finish(); a short transaction."""
+
+        with self._engine().begin() as conn:
+            conn.execute(text(f"SET LOCAL lock_timeout = '{DETACH_LOCK_TIMEOUT}'"))
+            conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+            conn.execute(text(f"COMMENT ON TABLE {name} IS 'archiving'"))
+
+    def _finish(self, name):
+        """Bring the archive up to date with detached partition `name`, export and drop it.
+
+        Returns how many of its messages are archived. Messages purged
+        since the copy took their archived copy with them (see purge.py).
+        """
+
+        with self._engine().begin() as conn:
+            conn.execute(text(
+                f"UPDATE messages_archive a SET like_count = p.like_count FROM {name} p "
+                f"WHERE a.id = p.id AND a.like_count <> p.like_count"))
+            conn.execute(text(
+                f"DELETE FROM messages_archive a USING {name} p "
+                f"WHERE a.id = p.id AND p.deleted_at IS NOT NULL"))
+            if self.archive_dir:
+                self.export(conn, name)
+            moved = conn.execute(text(
+                f"SELECT count(*) FROM {name} WHERE deleted_at IS NULL")).scalar()
+            conn.execute(text(f"DROP TABLE {name}"))
+        return moved
+
+    def export(self, conn, name):
+        """Write the messages of partition `name` to MESSAGES_ARCHIVE_DIR as gzipped CSV."""
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"{name}.csv.gz")
+        result = conn.execution_options(stream_results=True).execute(text(
+            f"SELECT {', '.join(ARCHIVED_COLUMNS)} FROM {name} "
+            f"WHERE deleted_at IS NULL ORDER BY id"))
+
+        with gzip.open(path, 'wt', newline='') as out:
+            writer = csv.writer(out)
+            writer.writerow(ARCHIVED_COLUMNS)
+            writer.writerows(result)
+        return path
+
+    def move_before(self, cutoff):
+        """Move messages older than `cutoff` to the archive in batches.
+
+        All of them from a plain `messages` table; from a partitioned one,
+        those in a partition that straddles the cutoff.
+        """
+
+        moved = 0
+        while True:
+            with self._engine().begin() as conn:
+                rows = conn.execute(select([messages])
+                                    .where(messages.c.timestamp < cutoff)
+                                    .order_by(messages.c.id)
+                                    .limit(self.batch_size)
+                                    .with_for_update()).fetchall()
+                if not rows:
+                    return moved
+
+                kept = [{column: row[column] for column in ARCHIVED_COLUMNS}
+                        for row in rows if row.deleted_at is None]
+                if kept:
+                    conn.execute(archive.insert(), kept)
+                # the timestamp bound lets a partitioned table prune
+                conn.execute(messages.delete()
+                             .where(messages.c.id.in_([row.id for row in rows]))
+                             .where(messages.c.timestamp < cutoff))
+            moved += len(kept)
+
+
+partitions = MessagePartitions()
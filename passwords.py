@@ -0,0 +1,99 @@
+"""Password hashing off the request thread.
+
+bcrypt is deliberately slow (hundreds of ms at cost 12) and releases the
+GIL while it works, so hashes run on a small bounded thread pool: at most
+PASSWORD_HASH_THREADS hashes burn CPU at once, at most
+PASSWORD_HASH_QUEUE more wait for a thread, and anything beyond that is
+turned away with PasswordHasherBusy instead of piling up and starving the
+worker pool during a login burst.
+
+Hashes made at a different cost than PASSWORD_HASH_ROUNDS are upgraded on
+the next successful login (see User.authenticate).
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask_bcrypt import Bcrypt
+
+HASH_ROUNDS = 12
+HASH_THREADS = 4
+HASH_QUEUE = 32
+HASH_TIMEOUT = 10
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are queued; try again later."""
+
+
+class PasswordHasher:
+    """bcrypt on a bounded executor with admission control."""
+
+    def __init__(self, rounds=HASH_ROUNDS, threads=HASH_THREADS, queue=HASH_QUEUE,
+                 timeout=HASH_TIMEOUT):
+        self.bcrypt = Bcrypt()
+        self.executor = None
+        self.configure(rounds, threads, queue, timeout)
+
+    def configure(self, rounds=HASH_ROUNDS, threads=HASH_THREADS, queue=HASH_QUEUE,
+                  timeout=HASH_TIMEOUT):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+        self.rounds = rounds
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=threads,
+                                           thread_name_prefix='password-hash')
+        self.slots = threading.BoundedSemaphore(threads + queue)
+        self.rejected = 0
+
+    def init_app(self, app):
+        """Read PASSWORD_HASH_ROUNDS/THREADS/QUEUE/TIMEOUT from the app config."""
+
+        self.configure(
+            rounds=app.config.setdefault('PASSWORD_HASH_ROUNDS', HASH_ROUNDS),
+            threads=app.config.setdefault('PASSWORD_HASH_THREADS', HASH_THREADS),
+            queue=app.config.setdefault('PASSWORD_HASH_QUEUE', HASH_QUEUE),
+            timeout=app.config.setdefault('PASSWORD_HASH_TIMEOUT', HASH_TIMEOUT),
+        )
+
+    def _run(self, fn, *args):
+        """Run `fn` on the pool and wait for it, or refuse if the pool is full."""
+
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PasswordHasherBusy()
+
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordHasherBusy()
+
+    def hash(self, password):
+        """bcrypt hash of `password` at the configured cost, as text."""
+
+        hashed = self._run(self.bcrypt.generate_password_hash, password, self.rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        return self._run(self.bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a different cost than the configured one?"""
+
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+hasher = PasswordHasher()
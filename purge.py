@@ -0,0 +1,279 @@
+"""Background removal of soft-deleted accounts and messages.
+
+Deleting inside the request meant loading and cascading every message,
+follow and like of an account while holding their locks. Now the routes
+only set `deleted_at` (which every read path filters on) and record a
+Purge; this module then deletes the dependent rows in batches of at most
+PURGE_BATCH_SIZE, one short transaction each, correcting other users'
+counters and messages' like counts for exactly the rows it removed.
+
+An account goes in this order: its likes, likes of its messages and
+archived messages, its follows in both directions, its messages and
+archived messages, suggestions to and of it, the user row. A message:
+its likes, the message row, then its archived copy, made if its
+partition was being archived as it was deleted. Each Purge row records rows_deleted as it
+goes and finished_at at the end; an interrupted purge resumes where it
+stopped.
+
+A daemon thread per worker picks up purges every PURGE_INTERVAL seconds
+or as soon as a route schedules one; PURGE_INTERVAL = 0 purges right away
+in the request (tests). `flask purge-deleted` finishes any that are left.
+"""
+
+import os
+import threading
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime
+
+from sqlalchemy import select, tuple_
+
+from cache import entity_cache
+from fragments import fragments
+from models import db, User, Message, MessageArchive, Follows, Likes, Purge, Recommendation
+
+BATCH_SIZE = 1000
+INTERVAL = 5
+
+users = User.__table__
+messages = Message.__table__
+archived_messages = MessageArchive.__table__
+follows = Follows.__table__
+likes = Likes.__table__
+purges = Purge.__table__
+recommendations = Recommendation.__table__
+
+
+class Batch(namedtuple('Batch', 'rows stale_users stale_messages')):
+    """What one purge step deleted and which cached entries it outdated."""
+
+    __slots__ = ()
+
+
+def delete_batch(conn, table, condition, limit):
+    """Delete up to `limit` rows of `table` matching `condition`; returns them.
+
+    DELETE ... RETURNING on Postgres, so rows another transaction removed
+    first are not returned (and not counted twice). Other databases read
+    the batch and then delete it.
+    """
+
+    key = list(table.primary_key.columns)
+    batch = select(key).where(condition).order_by(*key).limit(limit)
+    statement = table.delete().where(tuple_(*key).in_(batch))
+
+    if conn.dialect.name == 'postgresql':
+        return conn.execute(statement.returning(*table.c)).fetchall()
+
+    rows = conn.execute(select([table]).where(condition).order_by(*key).limit(limit)).fetchall()
+    if rows:
+        conn.execute(statement)
+    return rows
+
+
+def bump_user_counts(conn, column, deltas):
+    """Add {user_id: delta} to a users counter column, one UPDATE per distinct delta."""
+
+    by_delta = defaultdict(list)
+    for user_id, delta in deltas.items():
+        by_delta[delta].append(user_id)
+
+    for delta, user_ids in by_delta.items():
+        conn.execute(users.update()
+                     .where(users.c.id.in_(user_ids))
+                     .values({column: users.c[column] + delta}))
+
+
+# ---- steps: each deletes one batch and returns a Batch
+
+def likes_by_user(conn, user_id, limit):
+    rows = delete_batch(conn, likes, likes.c.user_id == user_id, limit)
+    liked = Counter(row.message_id for row in rows)
+    Message.bump_like_counts(conn, {message_id: -n for message_id, n in liked.items()})
+    return Batch(len(rows), (), liked)
+
+
+def likes_of(conn, message_ids, limit):
+    rows = delete_batch(conn, likes, likes.c.message_id.in_(message_ids), limit)
+    likers = Counter(row.user_id for row in rows)
+    bump_user_counts(conn, 'likes_count', {user_id: -n for user_id, n in likers.items()})
+    return Batch(len(rows), likers, ())
+
+
+def likes_of_user_messages(conn, user_id, limit):
+    return likes_of(conn, select([messages.c.id]).where(messages.c.user_id == user_id), limit)
+
+
+def likes_of_user_archived_messages(conn, user_id, limit):
+    return likes_of(conn, select([archived_messages.c.id])
+                    .where(archived_messages.c.user_id == user_id), limit)
+
+
+def follows_by_user(conn, user_id, limit):
+    rows = delete_batch(conn, follows, follows.c.user_following_id == user_id, limit)
+    followed = [row.user_being_followed_id for row in rows]
+    bump_user_counts(conn, 'followers_count', dict.fromkeys(followed, -1))
+    return Batch(len(rows), followed, ())
+
+
+def followers_of_user(conn, user_id, limit):
+    rows = delete_batch(conn, follows, follows.c.user_being_followed_id == user_id, limit)
+    followers = [row.user_following_id for row in rows]
+    bump_user_counts(conn, 'following_count', dict.fromkeys(followers, -1))
+    return Batch(len(rows), followers, ())
+
+
+def messages_of_user(conn, user_id, limit):
+    rows = delete_batch(conn, messages, messages.c.user_id == user_id, limit)
+    return Batch(len(rows), (), [row.id for row in rows])
+
+
+def archived_messages_of_user(conn, user_id, limit):
+    rows = delete_batch(conn, archived_messages, archived_messages.c.user_id == user_id, limit)
+    return Batch(len(rows), (), [row.id for row in rows])
+
+
+def recommendations_of_user(conn, user_id, limit):
+    rows = delete_batch(conn, recommendations,
+                        (recommendations.c.user_id == user_id)
+                        | (recommendations.c.candidate_id == user_id), limit)
+    return Batch(len(rows), (), ())
+
+
+def user_row(conn, user_id, limit):
+    rows = delete_batch(conn, users, users.c.id == user_id, limit)
+    return Batch(len(rows), [user_id], ())
+
+
+def likes_of_message(conn, message_id, limit):
+    return likes_of(conn, [message_id], limit)
+
+
+def message_row(conn, message_id, limit):
+    rows = delete_batch(conn, messages, messages.c.id == message_id, limit)
+    return Batch(len(rows), (), [message_id])
+
+
+def archived_message_row(conn, message_id, limit):
+    rows = delete_batch(conn, archived_messages, archived_messages.c.id == message_id, limit)
+    return Batch(len(rows), (), [message_id])
+
+
+STEPS = {
+    'user': [likes_by_user, likes_of_user_messages, likes_of_user_archived_messages,
+             follows_by_user, followers_of_user, messages_of_user, archived_messages_of_user,
+             recommendations_of_user, user_row],
+    'message': [likes_of_message, message_row, archived_message_row],
+}
+
+
+class Purger:
+    """Works through unfinished Purges in bounded batches."""
+
+    def __init__(self, batch_size=BATCH_SIZE, interval=INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.app = None
+        self.lock = threading.Lock()
+        self.running = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def init_app(self, app):
+        """Read PURGE_BATCH_SIZE and PURGE_INTERVAL (0: purge in the request)."""
+
+        self.app = app
+        self.batch_size = app.config.setdefault('PURGE_BATCH_SIZE', BATCH_SIZE)
+        self.interval = app.config.setdefault('PURGE_INTERVAL', INTERVAL)
+
+    def schedule(self):
+        """Start on newly committed purges."""
+
+        if not self.interval:
+            self.run()
+            return
+        self._ensure_thread()
+        self.wakeup.set()
+
+    def _ensure_thread(self):
+        # started lazily so that each forked worker gets its own
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name='purge', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval or None)
+            self.wakeup.clear()
+            try:
+                self.run()
+            except Exception:
+                self.app.logger.exception("purging deleted rows failed")
+
+    def pending(self):
+        """Ids of the unfinished purges, oldest first."""
+
+        with db.get_engine(self.app).connect() as conn:
+            return [purge_id for (purge_id,) in conn.execute(
+                select([purges.c.id]).where(purges.c.finished_at.is_(None))
+                .order_by(purges.c.id))]
+
+    def run(self, progress=None):
+        """Finish every pending purge; `progress(purge_id, rows)` is called per batch.
+
+        One run at a time per process; between processes the purge row's
+        lock keeps two workers off the same purge (Postgres only).
+        """
+
+        finished = 0
+        with self.running:
+            for purge_id in self.pending():
+                while True:
+                    rows = self.step(purge_id)
+                    if rows is None:
+                        break
+                    if progress:
+                        progress(purge_id, rows)
+                    if not rows:
+                        finished += 1
+                        break
+        return finished
+
+    def step(self, purge_id):
+        """Delete one batch for a purge, in its own transaction.
+
+        Returns the number of rows deleted, 0 when the purge has just
+        finished, or None if another worker holds it or it is already done.
+        """
+
+        with db.get_engine(self.app).begin() as conn:
+            purge = conn.execute(select([purges])
+                                 .where((purges.c.id == purge_id)
+                                        & purges.c.finished_at.is_(None))
+                                 .with_for_update(skip_locked=True)).first()
+            if purge is None:
+                return None
+
+            batch = Batch(0, (), ())
+            for step in STEPS[purge.kind]:
+                batch = step(conn, purge.target_id, self.batch_size)
+                if batch.rows:
+                    break
+
+            conn.execute(purges.update()
+                         .where(purges.c.id == purge_id)
+                         .values(rows_deleted=purges.c.rows_deleted + batch.rows,
+                                 finished_at=None if batch.rows else datetime.utcnow()))
+
+        entity_cache.invalidate_user(*batch.stale_users)
+        entity_cache.invalidate_message(*batch.stale_messages)
+        fragments.invalidate_message(*batch.stale_messages)
+        return batch.rows
+
+
+purger = Purger()
@@ -0,0 +1,169 @@
+"""Who-to-follow suggestions, computed offline from the follow graph.
+
+`flask recommend-follows` (also a jobs.py task) reads `follows` into a
+SciPy CSR adjacency matrix A, with A[i, j] = 1 when user i follows user j,
+and scores second-degree candidates for every user at once:
+
+    score = A @ A + RECOMMEND_FOLLOWS_YOU_WEIGHT * A.T
+
+(A @ A)[i, k] counts the people i follows who follow k (the "mutuals"),
+and A.T[i, k] is 1 when k already follows i. Accounts i follows, i itself
+and deleted users are dropped, and the best RECOMMENDATIONS_PER_USER per
+user are written to `recommendations`.
+
+Users are processed RECOMMEND_BLOCK_ROWS at a time, so memory is bounded
+by one block's product rather than all of A @ A, and each block's rows
+are replaced in their own transaction. The home sidebar reads the table
+through `who_to_follow`, skipping anyone followed since the last run.
+"""
+
+import time
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+
+from models import db, User, Follows, Recommendation
+
+PER_USER = 10
+BLOCK_ROWS = 2000
+FOLLOWS_YOU_WEIGHT = 0.5
+FETCH_SIZE = 100000
+SHOWN = 5
+
+users = User.__table__
+follows = Follows.__table__
+recommendations = Recommendation.__table__
+
+
+def adjacency(ids, followers, followed):
+    """CSR follow matrix over the sorted user `ids`.
+
+    Edges are given as two id arrays; edges touching an id that isn't in
+    `ids` (a deleted user) are left out.
+    """
+
+    n = len(ids)
+    if not n or not len(followers):
+        return sparse.csr_matrix((n, n), dtype=np.int32)
+
+    rows = np.searchsorted(ids, followers)
+    cols = np.searchsorted(ids, followed)
+    keep = ((ids[np.minimum(rows, n - 1)] == followers)
+            & (ids[np.minimum(cols, n - 1)] == followed))
+    data = np.ones(int(keep.sum()), dtype=np.int32)
+    return sparse.csr_matrix((data, (rows[keep], cols[keep])), shape=(n, n))
+
+
+def load_graph(conn):
+    """(ids, A): the ids of users that aren't deleted and their follow matrix."""
+
+    ids = np.array([user_id for (user_id,) in conn.execute(
+        select([users.c.id]).where(users.c.deleted_at.is_(None)).order_by(users.c.id))],
+        dtype=np.int64)
+
+    result = conn.execution_options(stream_results=True).execute(
+        select([follows.c.user_following_id, follows.c.user_being_followed_id]))
+    chunks = []
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        chunks.append(np.array([tuple(row) for row in rows], dtype=np.int64))
+
+    edges = np.concatenate(chunks) if chunks else np.empty((0, 2), dtype=np.int64)
+    return ids, adjacency(ids, edges[:, 0], edges[:, 1])
+
+
+def recommend(A, per_user=PER_USER, block_rows=BLOCK_ROWS, follows_you_weight=FOLLOWS_YOU_WEIGHT):
+    """Top candidates for every row of A, a block of rows at a time.
+
+    Yields (start, stop, users, candidates, scores, mutuals, ranks) per
+    block, as arrays of matrix indices sorted by user and rank (from 0).
+    Ties are broken by the lower candidate index.
+    """
+
+    n = A.shape[0]
+    followers = A.T.tocsr()
+
+    for start in range(0, n, block_rows):
+        stop = min(n, start + block_rows)
+        block = A[start:stop]
+
+        mutuals = (block @ A).tocsr()
+        scores = (mutuals + follows_you_weight * followers[start:stop]).tocsr()
+        # zero out accounts they already follow
+        scores = (scores - scores.multiply(block)).tocoo()
+
+        keep = (scores.data > 0) & (scores.col != scores.row + start)
+        row, col, score = scores.row[keep], scores.col[keep], scores.data[keep]
+
+        order = np.lexsort((col, -score, row))
+        row, col, score = row[order], col[order], score[order]
+        rank = np.arange(len(row)) - np.searchsorted(row, row)
+        top = rank < per_user
+        row, col, score, rank = row[top], col[top], score[top], rank[top]
+
+        mutual = np.asarray(mutuals[row, col]).ravel() if len(row) else np.empty(0, np.int64)
+        yield start, stop, row + start, col, score, mutual, rank
+
+
+def refresh(engine, per_user=PER_USER, block_rows=BLOCK_ROWS,
+            follows_you_weight=FOLLOWS_YOU_WEIGHT):
+    """Recompute the recommendations table; returns counts and timings."""
+
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        ids, A = load_graph(conn)
+    loaded = time.perf_counter()
+
+    written = 0
+    if not len(ids):
+        with engine.begin() as conn:
+            conn.execute(recommendations.delete())
+
+    for start, stop, row, col, score, mutual, rank in recommend(A, per_user, block_rows,
+                                                                follows_you_weight):
+        # this block owns the ids after the previous block's last one
+        owned = []
+        if start:
+            owned.append(recommendations.c.user_id > int(ids[start - 1]))
+        if stop < len(ids):
+            owned.append(recommendations.c.user_id <= int(ids[stop - 1]))
+
+        rows = [dict(user_id=user_id, rank=rank + 1, candidate_id=candidate_id,
+                     score=score, mutuals=mutuals)
+                for user_id, rank, candidate_id, score, mutuals
+                in zip(ids[row].tolist(), rank.tolist(), ids[col].tolist(),
+                       score.tolist(), mutual.tolist())]
+
+        stale = recommendations.delete()
+        for condition in owned:
+            stale = stale.where(condition)
+
+        with engine.begin() as conn:
+            conn.execute(stale)
+            if rows:
+                conn.execute(recommendations.insert(), rows)
+        written += len(rows)
+
+    return dict(users=len(ids), edges=int(A.nnz), recommendations=written,
+                load_seconds=round(loaded - started, 3),
+                total_seconds=round(time.perf_counter() - started, 3))
+
+
+def who_to_follow(user_id, limit=SHOWN):
+    """(id, username, image_url, mutuals) of the best current suggestions for `user_id`."""
+
+    followed = (select([follows.c.user_being_followed_id])
+                .where(follows.c.user_following_id == user_id))
+
+    return (db.session
+            .query(User.id, User.username, User.image_url, Recommendation.mutuals)
+            .join(Recommendation, Recommendation.candidate_id == User.id)
+            .filter(Recommendation.user_id == user_id,
+                    User.deleted_at.is_(None),
+                    ~User.id.in_(followed))
+            .order_by(Recommendation.rank)
+            .limit(limit)
+            .all())
@@ -0,0 +1,169 @@
+"""Read/write routing between the primary database and its replicas.
+
+models.db hands out RoutingSessions. Inside a GET or HEAD request their
+SELECTs go to a replica from SQLALCHEMY_REPLICA_URIS, round-robin over
+the healthy ones, one replica per request. Flushes, INSERT/UPDATE/DELETE
+statements and everything outside a request use the primary
+(SQLALCHEMY_DATABASE_URI).
+
+Replicas lag, so a user who has just written is pinned to the primary:
+a successful POST/PUT/PATCH/DELETE stamps their session, and their reads
+use the primary for the next REPLICA_STICKY_SECONDS. Read-through caches
+fill from the primary as well (`replicas.primary()`), since a stale row
+there would outlive the lag.
+
+A replica is checked with `SELECT 1` at most every REPLICA_CHECK_INTERVAL
+seconds and skipped while that fails or after a query on it lost its
+connection. With no healthy replica, reads fall back to the primary.
+"""
+
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.sql.expression import SelectBase
+
+STICKY_SECONDS = 5
+CHECK_INTERVAL = 5
+
+STICKY_KEY = 'primary_until'
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class Replica:
+    """One replica's engine and the result of its last health check."""
+
+    def __init__(self, url, engine_options=None):
+        self.url = url
+        self.engine = create_engine(url, **(engine_options or {}))
+        self.healthy = True
+        self.checked = 0
+        event.listen(self.engine, 'handle_error', self._handle_error)
+
+    def _handle_error(self, context):
+        if context.is_disconnect:
+            self.healthy = False
+            self.checked = time.monotonic()
+
+    def check(self, interval):
+        """Whether to read from this replica, re-checking it every `interval` seconds."""
+
+        now = time.monotonic()
+        if now - self.checked < interval:
+            return self.healthy
+
+        self.checked = now
+        try:
+            with self.engine.connect() as conn:
+                conn.execute("SELECT 1")
+            self.healthy = True
+        except Exception:
+            self.healthy = False
+        return self.healthy
+
+
+class ReplicaSet:
+    """The configured replicas and the per-request routing decision."""
+
+    def __init__(self):
+        self.replicas = []
+        self.cycle = itertools.cycle(self.replicas)
+        self.lock = threading.Lock()
+        self.sticky_seconds = STICKY_SECONDS
+        self.check_interval = CHECK_INTERVAL
+
+    def init_app(self, app):
+        """Read SQLALCHEMY_REPLICA_URIS and REPLICA_STICKY_SECONDS/CHECK_INTERVAL."""
+
+        self.sticky_seconds = app.config.setdefault('REPLICA_STICKY_SECONDS', STICKY_SECONDS)
+        self.check_interval = app.config.setdefault('REPLICA_CHECK_INTERVAL', CHECK_INTERVAL)
+        self.configure(app.config.setdefault('SQLALCHEMY_REPLICA_URIS', []),
+                       app.config.get('SQLALCHEMY_ENGINE_OPTIONS'))
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def configure(self, urls, engine_options=None):
+        """Replace the replicas with engines for `urls` (none: always use the primary)."""
+
+        for replica in self.replicas:
+            replica.engine.dispose()
+        self.replicas = [Replica(url, engine_options) for url in urls]
+        self.cycle = itertools.cycle(self.replicas)
+
+    @property
+    def engines(self):
+        return [replica.engine for replica in self.replicas]
+
+    def pick(self):
+        """The next healthy replica's engine, or None."""
+
+        with self.lock:
+            order = [next(self.cycle) for _ in self.replicas]
+        for replica in order:
+            if replica.check(self.check_interval):
+                return replica.engine
+        return None
+
+    # ---- routing
+
+    def _before_request(self):
+        g.read_replica = (bool(self.replicas)
+                          and request.method in READ_METHODS
+                          and session.get(STICKY_KEY, 0) < time.time())
+
+    def _after_request(self, response):
+        if self.replicas and request.method not in READ_METHODS and response.status_code < 400:
+            session[STICKY_KEY] = time.time() + self.sticky_seconds
+        return response
+
+    def read_engine(self):
+        """The replica engine for this request's reads, or None for the primary."""
+
+        if not has_request_context() or not g.get('read_replica'):
+            return None
+
+        engine = g.get('replica_engine')
+        if engine is None:
+            engine = g.replica_engine = self.pick()
+            if engine is None:
+                g.read_replica = False
+        return engine
+
+    @contextmanager
+    def primary(self):
+        """Read from the primary inside the block."""
+
+        reading = has_request_context() and g.get('read_replica')
+        if reading:
+            g.read_replica = False
+        try:
+            yield
+        finally:
+            if reading:
+                g.read_replica = True
+
+
+replicas = ReplicaSet()
+
+
+class RoutingSession(SignallingSession):
+    """Sends this request's SELECTs to a replica when ReplicaSet says so."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and isinstance(clause, SelectBase):
+            engine = replicas.read_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """flask_sqlalchemy.SQLAlchemy with RoutingSessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,130 @@
+"""Username search and autocomplete for the /users pages.
+
+On Postgres both are served by a trigram GIN index on lower(username)
+(see models.py). SQLite, used for local test databases, falls back to the
+plain lower(username) expression index: prefix lookups use it as a range
+scan, substring search scans the table.
+
+Search terms shorter than a trigram can't use the GIN index, so they
+only match username prefixes. Prefixes are a range of lower(username)
+in code point order, read off an index in that order: COLLATE "C" on
+Postgres, SQLite's default.
+"""
+
+from sqlalchemy import and_, case, func
+
+from models import db, User
+
+USERS_PAGE_SIZE = 24
+MAX_SEARCH_PAGES = 40
+AUTOCOMPLETE_SIZE = 8
+MIN_SUBSTRING_LENGTH = 3
+
+
+def _is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _escape_like(term):
+    """Escape LIKE wildcards in user input."""
+
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _lower_username():
+    return func.lower(User.username)
+
+
+def _prefix_key():
+    """lower(username) in code point order, as prefix lookups compare it."""
+
+    if _is_postgres():
+        return _lower_username().collate('C')
+    return _lower_username()
+
+
+def _after_prefix(prefix):
+    """The least string above every string starting with `prefix`.
+
+    None when there is none (an empty prefix, or one of only the last
+    code point).
+    """
+
+    prefix = prefix.rstrip('\U0010ffff')
+    if not prefix:
+        return None
+    last = ord(prefix[-1]) + 1
+    if 0xd800 <= last <= 0xdfff:
+        # surrogates can't be stored; the next storable code point
+        last = 0xe000
+    return prefix[:-1] + chr(last)
+
+
+def _starts_with(prefix):
+    """Filter for lower(username) starting with `prefix` (already lowercased).
+
+    A range scan on the prefix index, bounded on both sides.
+    """
+
+    name = _prefix_key()
+    upper = _after_prefix(prefix)
+    if upper is None:
+        return name >= prefix
+    return and_(name >= prefix, name < upper)
+
+
+def browse_users(after=None, per_page=USERS_PAGE_SIZE):
+    """A page of all users in id order, starting after user id `after`."""
+
+    query = User.visible()
+    if after:
+        query = query.filter(User.id > after)
+    return query.order_by(User.id).limit(per_page).all()
+
+
+def search_users(term, page=1, per_page=USERS_PAGE_SIZE):
+    """Users whose username contains `term`, best matches first.
+
+    Returns (users, has_next). Prefix matches rank above substring
+    matches; Postgres then ranks by trigram similarity, SQLite by length.
+    Terms under MIN_SUBSTRING_LENGTH match prefixes only, by username.
+    """
+
+    term = term.strip().lower()
+    page = max(1, min(page, MAX_SEARCH_PAGES))
+    name = _lower_username()
+
+    if len(term) < MIN_SUBSTRING_LENGTH:
+        query = User.visible().filter(_starts_with(term)).order_by(_prefix_key())
+    else:
+        escaped = _escape_like(term)
+        prefix_first = case([(name.like(f"{escaped}%", escape='\\'), 0)], else_=1)
+        if _is_postgres():
+            closeness = func.similarity(name, term).desc()
+        else:
+            closeness = func.length(User.username)
+
+        query = (User
+                 .visible()
+                 .filter(name.like(f"%{escaped}%", escape='\\'))
+                 .order_by(prefix_first, closeness, User.username))
+
+    users = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+
+    has_next = len(users) > per_page and page < MAX_SEARCH_PAGES
+    return users[:per_page], has_next
+
+
+def autocomplete_users(prefix, limit=AUTOCOMPLETE_SIZE):
+    """(id, username, image_url) rows for usernames starting with `prefix`."""
+
+    prefix = prefix.strip().lower()
+    if not prefix:
+        return []
+
+    return (db.session
+            .query(User.id, User.username, User.image_url)
+            .filter(_starts_with(prefix), User.deleted_at.is_(None))
+            .order_by(_prefix_key())
+            .limit(limit)
+            .all())
@@ -1,20 +1,22 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+    python seed.py                  # drop everything and load generator/*.csv
+    python seed.py --resume         # continue a load that was interrupted
+    python seed.py --dir data --chunk-size 50000
 
+See loader.py for how the load is streamed.
+"""
 
-db.drop_all()
-db.create_all()
+import argparse
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+from app import app, db
+from loader import Loader, CHUNK_SIZE
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+parser = argparse.ArgumentParser(description="Load users.csv, messages.csv and follows.csv.")
+parser.add_argument('--dir', default='generator', help="directory with the CSV files")
+parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+parser.add_argument('--resume', action='store_true', help="continue an interrupted load")
+args = parser.parse_args()
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
-
-db.session.commit()
+with app.app_context():
+    Loader(db.engine, directory=args.dir, chunk_size=args.chunk_size).run(resume=args.resume)
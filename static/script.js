@@ -1,55 +1,155 @@
-/* Send request to the server to add liked message to database */
-async function likeWarble(like,message_id) {
-    const response = await axios.post(`/users/add_like/${message_id}`, 
-      {
-        userId: like.userId,
-        messageId: like.messageId
-      }
-    );
-    return response.data.like;
+/* Like/unlike toggles are queued and sent together to /users/likes, so
+   quick clicks cost one request and only the final state of each message
+   is applied */
+const pendingLikes = {};
+let likesTimer = null;
+
+function takePendingLikes(){
+    const likes = Object.assign({}, pendingLikes);
+    for (let id in pendingLikes) delete pendingLikes[id];
+    return likes;
 }
 
-/* Send request to the server to remove liked message from database */
-async function deleteLike(message_id){
-    const response = await axios.delete(`/users/add_like/${message_id}`);
-    return response.data;
+async function flushLikes(){
+    clearTimeout(likesTimer);
+    const likes = takePendingLikes();
+    if ($.isEmptyObject(likes)) return;
+    try {
+        await axios.post('/users/likes', {likes});
+    } catch (err) {
+        /* put the buttons back the way the server still has them */
+        for (let id in likes) {
+            $(`button.thumbup[data-id="${id}"]`).each(function(){
+                showLike($(this), !likes[id]);
+            });
+        }
+    }
+}
+
+/* Show a like button as liked or not, adjusting its count */
+function showLike($button, liked){
+    if ($button.hasClass("btn-primary") === liked) return;
+    $button.toggleClass("btn-primary", liked).toggleClass("btn-secondary", !liked);
+    const $count = $button.find('.like-count');
+    const count = (parseInt($count.text()) || 0) + (liked ? 1 : -1);
+    $count.text(count > 0 ? count : '');
 }
 
 /* Will toggle between like message and not*/
-$("button.thumbup").on("click",async function(evt){
+$(document).on("click","button.thumbup",function(evt){
     evt.preventDefault();
     const id = $(this).data('id');
-    const $arr = $(this).closest("form").siblings();
-    const $userId = getID($arr[1].href);
-    const $messId = getID($arr[0].href);
-    $(this).toggleClass("btn-secondary btn-primary");
-    if($(this).hasClass("btn-primary")){
-        await likeWarble({$userId,$messId},$messId);
-    } else {
-        if(window.location.pathname === '/messages/liked'){
-            $(this).closest('.list-group-item').remove()
-        }
-        await deleteLike($messId);
+    const liked = !$(this).hasClass("btn-primary");
+    showLike($(this), liked);
+    if(!liked && window.location.pathname === '/messages/liked'){
+        $(this).closest('.list-group-item').remove()
     }
+    pendingLikes[id] = liked;
+    clearTimeout(likesTimer);
+    likesTimer = setTimeout(flushLikes, 300);
 });
 
-/* Will create a new message in the modal window*/
+/* Don't lose queued toggles when the user navigates away */
+window.addEventListener('pagehide', function(){
+    const likes = takePendingLikes();
+    if ($.isEmptyObject(likes)) return;
+    navigator.sendBeacon('/users/likes',
+        new Blob([JSON.stringify({likes})], {type: 'application/json'}));
+});
+
+/* Will create a new message in the modal window and put it at the top
+   of #messages, without reloading the page */
 $(document).ready(function() {
     $('#add_form').on('click',"#add_me", async function(evt) {
         evt.preventDefault();
-        const msg = $('#AddNewModal').find('.form-control').val();
-        const data = await axios.post(`/messages/new`, {text: msg});
-        console.log(data)
-        if (data.status == 201) {
+        const $form = $('#add_form');
+        const $errors = $form.find('.form-errors').empty();
+        try {
+            const response = await axios.post(`/messages/new`, {
+                text: $form.find('.form-control').val(),
+                csrf_token: $form.find('[name=csrf_token]').val()
+            });
+            $('#messages').prepend(response.data.html);
+            $form.find('.form-control').val('');
             $('#AddNewModal').modal('hide');
-            location.reload();
+        } catch (err) {
+            const errors = (err.response && err.response.data.errors)
+                || {text: ["Could not post your message, please try again."]};
+            for (let field in errors) {
+                for (let error of errors[field]) {
+                    $errors.append($('<span class="text-danger">').text(error));
+                }
+            }
         }
     });
 });
 
-/* Function to get values for user/message ids */
-function getID(arr){
-    const str = arr.lastIndexOf('/')+1;
-    const end = arr.length;
-    return arr.slice(str,end);
-}
\ No newline at end of file
+/* Infinite scroll: load the next page of #messages when the user nears the bottom */
+let loadingMore = false;
+
+async function loadMoreMessages(){
+    const $messages = $('#messages');
+    const next = $messages.data('next');
+    if (!next || loadingMore) return;
+    loadingMore = true;
+    try {
+        const response = await axios.get(next);
+        $messages.append(response.data.html);
+        $messages.data('next', response.data.next);
+    } finally {
+        loadingMore = false;
+    }
+}
+
+$(window).on('scroll', function(){
+    if ($(window).scrollTop() + $(window).height() >= $(document).height() - 300) {
+        loadMoreMessages();
+    }
+});
+
+/* Search box autocomplete: suggest usernames as the user types */
+let autocompleteTimer = null;
+
+$('#search').on('input', function(){
+    clearTimeout(autocompleteTimer);
+    const q = $(this).val().trim();
+    const $suggestions = $('#search-suggestions');
+    if (!q) {
+        $suggestions.empty();
+        return;
+    }
+    autocompleteTimer = setTimeout(async function(){
+        const response = await axios.get('/users/autocomplete', {params: {q}});
+        $suggestions.empty();
+        for (let user of response.data.users) {
+            const $item = $('<a class="list-group-item list-group-item-action">')
+                .attr('href', `/users/${user.id}`)
+                .append($('<img class="suggestion-image">').attr('src', user.image_url))
+                .append($('<span>').text(`@${user.username}`));
+            $suggestions.append($item);
+        }
+    }, 150);
+});
+/* Live timeline: new warbles from followed users arrive over /messages/stream
+   and go on top of the homepage's #messages. After a `resync` the server has
+   dropped events for us, so stop listening and offer a reload instead. */
+$(document).ready(function() {
+    if (window.location.pathname !== '/' || !$('#messages').length || !window.EventSource) return;
+    const stream = new EventSource('/messages/stream');
+
+    stream.addEventListener('message', function(evt){
+        const data = JSON.parse(evt.data);
+        if ($(`button.thumbup[data-id="${data.id}"]`).length) return;
+        $('#messages').prepend(data.html);
+    });
+
+    stream.addEventListener('resync', function(){
+        stream.close();
+        if ($('#messages .live-resync').length) return;
+        $('#messages').prepend(
+            '<li class="list-group-item text-center live-resync">' +
+            '<a href="/">There are new warbles, refresh to see them</a></li>');
+    });
+
+    window.addEventListener('pagehide', function(){ stream.close(); });
+});
@@ -0,0 +1,136 @@
+"""Entity cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+from unittest import TestCase
+
+import fakeredis
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from cache import entity_cache, EntityCache, LRUBackend, RedisBackend
+
+db.create_all()
+
+
+class LRUBackendTestCase(TestCase):
+    """Test the in-process backend on its own."""
+
+    def test_evicts_least_recently_used(self):
+        backend = LRUBackend(maxsize=2)
+        backend.set("a", 1)
+        backend.set("b", 2)
+        backend.get("a")
+        backend.set("c", 3)
+
+        self.assertEqual(backend.get("a"), 1)
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.evictions, 1)
+
+    def test_expires(self):
+        backend = LRUBackend(ttl=-1)
+        backend.set("a", 1)
+
+        self.assertIsNone(backend.get("a"))
+
+
+class RedisBackendTestCase(TestCase):
+    """Test the shared backend against fakeredis."""
+
+    def setUp(self):
+        self.client = fakeredis.FakeRedis()
+        self.backend = RedisBackend(self.client, ttl=60)
+
+    def test_set_get_delete(self):
+        self.backend.set("a", {"n": 1})
+
+        self.assertEqual(self.backend.get("a"), {"n": 1})
+        self.assertEqual(self.client.ttl("entity:a"), 60)
+        self.backend.delete("a")
+        self.assertIsNone(self.backend.get("a"))
+
+    def test_clear_keeps_other_keys(self):
+        self.client.set("other", "x")
+        self.backend.set("a", 1)
+        self.backend.set("b", 2)
+        self.assertEqual(len(self.backend), 2)
+
+        self.backend.clear()
+
+        self.assertEqual(len(self.backend), 0)
+        self.assertEqual(self.client.get("other"), b"x")
+
+    def test_workers_share_entries(self):
+        server = fakeredis.FakeServer()
+        one = RedisBackend(fakeredis.FakeRedis(server=server))
+        two = RedisBackend(fakeredis.FakeRedis(server=server))
+
+        one.set("a", 1)
+        self.assertEqual(two.get("a"), 1)
+        two.delete("a")
+        self.assertIsNone(one.get("a"))
+
+
+class EntityCacheTestCase(TestCase):
+    """Test read-through lookups against the database."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        entity_cache.clear()
+
+        self.user = User.signup("cached", "cached@test.com", "password")
+        db.session.commit()
+        self.msg = Message(text="a warble", user_id=self.user.id)
+        db.session.add(self.msg)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        entity_cache.clear()
+
+    def test_user_read_through(self):
+        self.assertEqual(entity_cache.user(self.user.id).username, "cached")
+        self.assertEqual(entity_cache.user(self.user.id).username, "cached")
+        self.assertIsNone(entity_cache.user(12345))
+
+        stats = entity_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+
+    def test_invalidate_user(self):
+        entity_cache.user(self.user.id)
+        self.user.username = "renamed"
+        db.session.commit()
+
+        self.assertEqual(entity_cache.user(self.user.id).username, "cached")
+        entity_cache.invalidate_user(self.user.id)
+        self.assertEqual(entity_cache.user(self.user.id).username, "renamed")
+
+    def test_message_follows_author_edits(self):
+        self.assertEqual(entity_cache.message(self.msg.id).user.username, "cached")
+
+        self.user.username = "renamed"
+        db.session.commit()
+        entity_cache.invalidate_user(self.user.id)
+
+        self.assertEqual(entity_cache.message(self.msg.id).user.username, "renamed")
+
+    def test_redis_read_through(self):
+        cache = EntityCache(RedisBackend(fakeredis.FakeRedis()))
+
+        self.assertEqual(cache.user(self.user.id).username, "cached")
+        self.assertEqual(cache.message(self.msg.id).text, "a warble")
+
+        self.user.username = "renamed"
+        db.session.commit()
+        self.assertEqual(cache.user(self.user.id).username, "cached")
+        cache.invalidate_user(self.user.id)
+        self.assertEqual(cache.user(self.user.id).username, "renamed")
+        self.assertEqual(cache.message(self.msg.id).user.username, "renamed")
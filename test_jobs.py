@@ -0,0 +1,168 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Job
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from jobs import jobs, Worker
+
+db.create_all()
+
+calls = []
+
+
+@jobs.task('test-record')
+def record(value=None):
+    calls.append(value)
+
+
+@jobs.task('test-slow', max_attempts=1)
+def slow(seconds):
+    time.sleep(seconds)
+    calls.append('slow')
+
+
+@jobs.task('test-fail', max_attempts=3)
+def fail():
+    calls.append('fail')
+    raise ValueError("nope")
+
+
+class JobQueueTestCase(TestCase):
+    """Test enqueueing, claiming, retries and the stats view."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        calls.clear()
+        self.retry_base = jobs.retry_base
+        self.visibility_timeout = jobs.visibility_timeout
+
+    def tearDown(self):
+        jobs.retry_base = self.retry_base
+        jobs.visibility_timeout = self.visibility_timeout
+        db.session.rollback()
+
+    def job(self):
+        db.session.expire_all()
+        return Job.query.one()
+
+    def test_enqueued_job_runs_after_commit(self):
+        with app.test_request_context():
+            self.assertTrue(jobs.enqueue('test-record', {'value': 7}))
+            db.session.rollback()
+            jobs.enqueue('test-record', {'value': 8})
+            db.session.commit()
+
+        self.assertEqual(jobs.work(), 1)
+        self.assertEqual(calls, [8])
+        self.assertEqual(self.job().status, 'done')
+        self.assertEqual(jobs.work(), 0)
+
+    def test_idempotency_key(self):
+        self.assertTrue(jobs.enqueue('test-record', {'value': 1}, key='once'))
+        self.assertFalse(jobs.enqueue('test-record', {'value': 2}, key='once'))
+        db.session.commit()
+
+        jobs.work()
+        self.assertEqual(calls, [1])
+
+    def test_retries_with_backoff_then_fails(self):
+        jobs.enqueue('test-fail')
+        db.session.commit()
+
+        jobs.work()
+        job = self.job()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertGreater(job.run_at, datetime.utcnow())
+        self.assertIn("ValueError: nope", job.last_error)
+
+        jobs.retry_base = 0
+        Job.query.update({Job.run_at: datetime.utcnow()})
+        db.session.commit()
+        jobs.work()
+        job = self.job()
+        self.assertEqual((job.status, job.attempts), ('failed', 3))
+        self.assertEqual(calls, ['fail'] * 3)
+
+    def test_delayed_job_waits(self):
+        jobs.enqueue('test-record', delay=60)
+        db.session.commit()
+
+        self.assertEqual(jobs.work(), 0)
+
+    def test_visibility_timeout(self):
+        jobs.enqueue('test-record', {'value': 'x'})
+        db.session.commit()
+
+        first = jobs.claim()
+        self.assertIsNone(jobs.claim())
+
+        # the first worker stalls past its timeout; another picks the job up
+        Job.query.update({Job.locked_until: datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+        second = jobs.claim()
+        self.assertEqual((second.id, second.attempts), (first.id, 2))
+
+        jobs.execute(second)
+        # the stalled worker's late failure doesn't undo the result
+        jobs._finish(first, error="late")
+        self.assertEqual(self.job().status, 'done')
+        self.assertEqual(calls, ['x'])
+
+    def test_lease_is_renewed_while_running(self):
+        jobs.visibility_timeout = 0.3
+        jobs.enqueue('test-slow', {'seconds': 1})
+        db.session.commit()
+
+        job = jobs.claim()
+        runner = threading.Thread(target=jobs.execute, args=(job,))
+        runner.start()
+        time.sleep(0.6)
+        self.assertIsNone(jobs.claim())
+        runner.join()
+
+        self.assertEqual((self.job().status, calls), ('done', ['slow']))
+
+    def test_worker_threads(self):
+        for value in range(5):
+            jobs.enqueue('test-record', {'value': value})
+        db.session.commit()
+
+        worker = Worker(jobs, threads=2, poll=0.05)
+        worker.start()
+        deadline = time.monotonic() + 10
+        while len(calls) < 5 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        worker.stop()
+
+        self.assertEqual(sorted(calls), list(range(5)))
+
+    def test_stats_view(self):
+        jobs.enqueue('test-record')
+        jobs.enqueue('test-record')
+        db.session.commit()
+        jobs.work(limit=1)
+
+        token = app.config['STATS_TOKEN']
+        app.config['STATS_TOKEN'] = "scrape-me"
+        try:
+            stats = app.test_client().get(
+                '/_stats/jobs', headers={'Authorization': "Bearer scrape-me"}).get_json()
+        finally:
+            app.config['STATS_TOKEN'] = token
+        self.assertEqual(stats['depth'], {'done': 1, 'queued': 1})
+        self.assertEqual(stats['queued'], {'test-record': 1})
+        self.assertEqual(stats['recent'], 1)
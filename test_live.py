@@ -0,0 +1,226 @@
+"""Live timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+
+import json
+import os
+import queue
+from unittest import TestCase
+
+import fakeredis
+import redis
+
+from models import db, User, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from cache import entity_cache
+from live import Broker, RedisBackend, TooManySubscribers, broker, max_subscribers_for
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def parse(chunk):
+    """The (event, data) of one SSE message."""
+
+    fields = dict(line.split(': ', 1) for line in chunk.strip().splitlines())
+    return fields.get('event'), json.loads(fields.get('data', 'null'))
+
+
+class BrokerTestCase(TestCase):
+    """Test routing, follow changes and slow subscribers."""
+
+    def setUp(self):
+        self.broker = Broker()
+        self.broker.queue_size = 2
+        self.broker.max_subscribers = 10
+
+    def test_routes_by_author(self):
+        sub = self.broker.subscribe(1, [2, 3])
+        other = self.broker.subscribe(4, [5])
+
+        self.broker.publish_message(2, 10, "<li>10</li>")
+        self.broker.publish_message(5, 11, "<li>11</li>")
+
+        self.assertEqual(sub.queue.get_nowait()['id'], 10)
+        self.assertTrue(sub.queue.empty())
+        self.assertEqual(other.queue.get_nowait()['id'], 11)
+
+    def test_follow_changes_open_subscriptions(self):
+        sub = self.broker.subscribe(1, [2])
+
+        self.broker.publish_follow(1, 3, True)
+        self.broker.publish_follow(1, 2, False)
+        self.broker.publish_message(2, 10, "")
+        self.broker.publish_message(3, 11, "")
+
+        self.assertEqual(sub.queue.get_nowait()['id'], 11)
+        self.assertTrue(sub.queue.empty())
+        self.assertNotIn(2, self.broker.by_author)
+
+    def test_slow_subscriber_is_told_to_resync(self):
+        sub = self.broker.subscribe(1, [2])
+
+        for message_id in range(3):
+            self.broker.publish_message(2, message_id, "")
+
+        self.assertTrue(sub.dropped)
+        self.assertEqual(self.broker.stats()['dropped'], 1)
+        self.assertEqual(list(sub.events(heartbeat=0.01)), ["event: resync\ndata: {}\n\n"])
+
+    def test_unsubscribe_and_limit(self):
+        self.broker.max_subscribers = 1
+        sub = self.broker.subscribe(1, [2])
+
+        with self.assertRaises(TooManySubscribers):
+            self.broker.subscribe(3, [2])
+
+        self.broker.unsubscribe(sub)
+        self.assertEqual(len(self.broker), 0)
+        self.assertEqual(dict(self.broker.by_author), {})
+
+    def test_limit_follows_server_threads(self):
+        self.assertEqual(max_subscribers_for(1), 0)
+        self.assertEqual(max_subscribers_for(64), 32)
+        self.assertEqual(Broker().max_subscribers, 0)
+
+    def test_redis_relays_between_workers(self):
+        server = fakeredis.FakeServer()
+        one = Broker(RedisBackend(fakeredis.FakeRedis(server=server)))
+        two = Broker(RedisBackend(fakeredis.FakeRedis(server=server)))
+        two.max_subscribers = 1
+        sub = two.subscribe(1, [2])
+
+        one.publish_follow(1, 3, True)
+        one.publish_message(3, 10, "<li>10</li>")
+
+        self.assertEqual(sub.queue.get(timeout=5), dict(author_id=3, id=10, html="<li>10</li>"))
+        self.assertIn(3, two.by_author)
+        self.assertNotIn(3, one.by_author)
+
+    def test_redis_listener_survives_errors(self):
+        """A bad payload is skipped and a dropped connection is resubscribed"""
+
+        server = fakeredis.FakeServer()
+        client = fakeredis.FakeRedis(server=server)
+        publisher = fakeredis.FakeRedis(server=server)
+        backend = RedisBackend(client)
+        backend.retry_delay = 0.01
+
+        connect = client.pubsub
+
+        def dropping_pubsub(**kwargs):
+            pubsub = connect(**kwargs)
+            if not hasattr(client, 'dropped'):
+                client.dropped = True
+
+                def listen():
+                    yield from ()
+                    raise redis.ConnectionError("Connection reset by peer")
+
+                pubsub.listen = listen
+            return pubsub
+
+        client.pubsub = dropping_pubsub
+
+        with self.assertLogs('live', level='ERROR') as logs:
+            two = Broker(backend)
+            two.max_subscribers = 1
+            sub = two.subscribe(1, [2])
+
+            # until the listener is back on the channel, publishes are lost
+            for attempt in range(100):
+                publisher.publish("live", "not json")
+                publisher.publish("live", json.dumps(["message", dict(author_id=2, id=10, html="")]))
+                try:
+                    event = sub.queue.get(timeout=0.05)
+                    break
+                except queue.Empty:
+                    continue
+
+        self.assertEqual(event["id"], 10)
+        output = "\n".join(logs.output)
+        self.assertIn("lost the Redis subscription", output)
+        self.assertIn("skipping", output)
+
+
+class StreamViewTestCase(TestCase):
+    """Test /messages/stream and publishing from the message and follow views."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        entity_cache.clear()
+
+        self.reader = User.signup("reader", "reader@test.com", "password", None)
+        self.author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        self.reader_id, self.author_id = self.reader.id, self.author.id
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.reader_id))
+        db.session.commit()
+
+        self.heartbeat = broker.heartbeat
+        self.max_subscribers = broker.max_subscribers
+        broker.heartbeat = 0.05
+        broker.max_subscribers = 10
+
+    def tearDown(self):
+        broker.heartbeat = self.heartbeat
+        broker.max_subscribers = self.max_subscribers
+        db.session.rollback()
+
+    def client_as(self, user_id):
+        c = app.test_client()
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return c
+
+    def test_stream_requires_login(self):
+        resp = app.test_client().get('/messages/stream', follow_redirects=True)
+        self.assertIn(b"Access unauthorized", resp.data)
+
+    def test_single_threaded_server_does_not_stream(self):
+        broker.max_subscribers = max_subscribers_for(1)
+
+        resp = self.client_as(self.reader_id).get('/messages/stream')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(len(broker), 0)
+
+    def test_streams_new_messages_from_followed_users(self):
+        resp = self.client_as(self.reader_id).get('/messages/stream', buffered=False)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+
+        chunks = iter(resp.response)
+        self.assertTrue(next(chunks).startswith(b"retry:"))
+        self.assertEqual(len(broker), 1)
+
+        self.client_as(self.author_id).post('/messages/new', data={"text": "live one"})
+        event, data = parse(next(chunks).decode())
+
+        self.assertEqual(event, 'message')
+        self.assertEqual(data['author_id'], self.author_id)
+        self.assertIn("live one", data['html'])
+        self.assertEqual(next(chunks), b": heartbeat\n\n")
+
+        resp.close()
+        self.assertEqual(len(broker), 0)
+
+    def test_unfollow_stops_the_stream(self):
+        resp = self.client_as(self.reader_id).get('/messages/stream', buffered=False)
+        chunks = iter(resp.response)
+        next(chunks)
+
+        reader = self.client_as(self.reader_id)
+        reader.post(f'/users/stop-following/{self.author_id}')
+        self.client_as(self.author_id).post('/messages/new', data={"text": "not for you"})
+
+        self.assertEqual(next(chunks), b": heartbeat\n\n")
+        resp.close()
@@ -8,7 +8,9 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from sqlalchemy import event
+
+from models import db, connect_db, Message, User, Likes, Follows
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +23,11 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from cache import entity_cache
+from fragments import fragments
+from likecounts import like_counts
+from purge import purger
+from timelines import timelines
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -32,6 +39,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Purge deleted messages before the request returns, not in a thread
+
+purger.interval = 0
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -41,6 +52,10 @@ class MessageViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        entity_cache.clear()
+        fragments.clear()
+        like_counts.clear()
+        timelines.store.clear()
 
         self.client = app.test_client()
 
@@ -97,7 +112,274 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
+    def count_statements(self, url):
+        """Number of SQL statements executed while serving `url`."""
+
+        statements = []
+
+        def before_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_execute)
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.uid1
+                resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_execute)
+
+        return len(statements)
+
+    def test_like_state_query_count(self):
+        """Rendering like buttons costs the same whatever the like history"""
+
+        for i in range(5):
+            db.session.add(Message(text=f"warble {i}", user_id=self.uid2))
+
+        testuser3 = User.signup(username="testuser3",
+                                email="test3@test.com",
+                                password="testuser3")
+        db.session.commit()
+        uid3 = testuser3.id
+
+        def like_more(n):
+            for i in range(n):
+                msg = Message(text=f"liked {i}", user_id=uid3)
+                db.session.add(msg)
+                db.session.flush()
+                db.session.add(Likes(user_id=self.uid1, message_id=msg.id))
+            db.session.commit()
+            db.session.expire_all()
+
+        like_more(1)
+        # warm the home timeline and the entity cache so both runs read from them
+        self.count_statements("/")
+        self.count_statements(f"/users/{self.uid2}")
+        home_few = self.count_statements("/")
+        profile_few = self.count_statements(f"/users/{self.uid2}")
+
+        like_more(30)
+        self.assertEqual(self.count_statements("/"), home_few)
+        self.assertEqual(self.count_statements(f"/users/{self.uid2}"), profile_few)
+
+    def test_timeline_authors_are_not_lazy_loaded(self):
+        """One query for messages and their authors, however many authors"""
+
+        def post_from_new_authors(start, n):
+            for i in range(start, start + n):
+                author = User.signup(username=f"author{i}",
+                                     email=f"author{i}@test.com",
+                                     password="password")
+                db.session.commit()
+                db.session.add(Follows(user_being_followed_id=author.id,
+                                       user_following_id=self.uid1))
+                db.session.add(Message(text=f"warble {i}", user_id=author.id))
+                db.session.commit()
+            timelines.store.clear()
+            # rebuild the timeline so the measured request reads it from the store
+            self.count_statements("/")
+
+        post_from_new_authors(0, 2)
+        few = self.count_statements("/")
+        few_profile = self.count_statements(f"/users/{self.uid1}")
+
+        post_from_new_authors(2, 10)
+        self.assertEqual(self.count_statements("/"), few)
+        self.assertEqual(self.count_statements(f"/users/{self.uid1}"), few_profile)
+
+    def test_homepage_conditional_get(self):
+        """The homepage is a 304 until someone the user follows posts"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+            etag = c.get("/").headers["ETag"]
+            self.assertEqual(c.get("/", headers={"If-None-Match": etag}).status_code, 304)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+            c.post("/messages/new", json={"text": "news"})
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+            resp = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("news", resp.get_data(as_text=True))
+
+    def test_message_items_are_cached_per_viewer_variant(self):
+        """Timeline items are rendered once, per like state, and dropped on delete"""
+
+        msg = Message(text="popular", user_id=self.uid2)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            c.get("/")
+            self.assertEqual((fragments.hits, fragments.misses), (0, 1))
+            c.get(f"/users/{self.uid2}")
+            self.assertEqual((fragments.hits, fragments.misses), (1, 1))
+
+            c.post(f"/users/add_like/{msg_id}")
+            html = c.get("/").get_data(as_text=True)
+            self.assertEqual(fragments.misses, 2)
+            self.assertIn("btn-primary thumbup", html)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+            c.post(f"/messages/{msg_id}/delete")
+
+        self.assertIsNone(fragments.backend.get(msg_id))
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_like_is_idempotent_and_per_user(self):
+        """Two users can like one message; repeated likes/unlikes change nothing"""
+
+        msg = Message(text="likeable", user_id=self.uid2)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+        testuser3 = User.signup(username="testuser3", email="test3@test.com",
+                                password="testuser3")
+        db.session.commit()
+        uid3 = testuser3.id
 
+        with self.client as c:
+            self.login(c, self.uid1)
+            self.assertEqual(c.post(f"/users/add_like/{msg_id}").status_code, 201)
+            self.assertEqual(c.post(f"/users/add_like/{msg_id}").status_code, 200)
+            self.assertEqual(c.post("/users/add_like/99999").status_code, 404)
+
+        with self.client as c:
+            self.login(c, uid3)
+            self.assertEqual(c.post(f"/users/add_like/{msg_id}").status_code, 201)
+            c.delete(f"/users/add_like/{msg_id}")
+            c.delete(f"/users/add_like/{msg_id}")
+
+        likes = db.session.query(Likes.user_id).filter(Likes.message_id == msg_id).all()
+        self.assertEqual(likes, [(self.uid1,)])
+        self.assertEqual(User.query.get(self.uid1).likes_count, 1)
+        self.assertEqual(User.query.get(uid3).likes_count, 0)
+
+    def test_batch_likes(self):
+        """Queued toggles are applied in one request, ignoring unknown messages"""
+
+        ids = []
+        for i in range(3):
+            msg = Message(text=f"warble {i}", user_id=self.uid2)
+            db.session.add(msg)
+            db.session.commit()
+            ids.append(msg.id)
+        db.session.add(Likes(user_id=self.uid1, message_id=ids[2]))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.uid1)
+            resp = c.post("/users/likes", json={"likes": {
+                str(ids[0]): True, str(ids[1]): True, str(ids[2]): False, "99999": True}})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["liked"], ids[:2])
+            self.assertEqual(resp.json["missing"], [99999])
+
+            self.assertEqual(c.post("/users/likes", json={"likes": ["nope"]}).status_code, 400)
+
+        liked = Likes.message_ids_liked_by(self.uid1, ids)
+        self.assertEqual(liked, set(ids[:2]))
+
+    def test_like_counts_are_written_behind(self):
+        """Likes are counted per message in batches and shown on the timeline"""
+
+        msg = Message(text="viral", user_id=self.uid2)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            self.login(c, self.uid1)
+            c.post("/users/likes", json={"likes": {str(msg_id): True}})
+            c.post(f"/users/add_like/{msg_id}")
+
+            like_counts.flush()
+            self.assertEqual(Message.query.get(msg_id).like_count, 1)
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn('<span class="like-count">1</span>', html)
+
+        Message.query.filter_by(id=msg_id).update({Message.like_count: 7})
+        Message.repair_like_counts()
+        db.session.commit()
+        self.assertEqual(Message.query.get(msg_id).like_count, 1)
+
+    def test_profile_revalidates_on_others_likes(self):
+        """Someone else liking a message on a profile changes its ETag"""
+
+        msg = Message(text="likeable", user_id=self.uid2)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            self.login(c, self.uid2)
+            etag = c.get(f"/users/{self.uid2}").headers["ETag"]
+
+            self.login(c, self.uid1)
+            c.post(f"/users/add_like/{msg_id}")
+            like_counts.flush()
+
+            self.login(c, self.uid2)
+            resp = c.get(f"/users/{self.uid2}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<i class="fa fa-thumbs-up"></i> 1', resp.get_data(as_text=True))
+
+    def test_home_revalidates_on_others_likes(self):
+        """Someone else liking a message on the homepage changes its ETag"""
+
+        fan = User.signup(username="fan", email="fan@test.com", password="password")
+        db.session.commit()
+        fan_id = fan.id
+
+        with self.client as c:
+            self.login(c, self.uid2)
+            msg_id = c.post("/messages/new", json={"text": "likeable"}).json["message"]["id"]
+
+            self.login(c, self.uid1)
+            etag = c.get("/").headers["ETag"]
+
+            self.login(c, fan_id)
+            c.post(f"/users/add_like/{msg_id}")
+            like_counts.flush()
+
+            self.login(c, self.uid1)
+            resp = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<span class="like-count">1</span>', resp.get_data(as_text=True))
+
+    def test_add_message_json(self):
+        """Posting from the modal returns the rendered item; errors come back as JSON"""
+
+        with self.client as c:
+            self.login(c, self.uid1)
 
+            resp = c.post("/messages/new", json={"text": "Hello"})
+            self.assertEqual(resp.status_code, 201)
+            self.assertEqual(resp.json["message"]["text"], "Hello")
+            self.assertIn("Hello", resp.json["html"])
+            self.assertIn('<li class="list-group-item">', resp.json["html"])
 
+            resp = c.post("/messages/new", json={"text": "x" * 141})
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("text", resp.json["errors"])
 
+        self.assertEqual(Message.query.count(), 1)
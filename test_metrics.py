@@ -0,0 +1,113 @@
+"""Request instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+from unittest import TestCase
+
+from flask import Response, request_started, request_finished
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import StaticPool
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from cache import entity_cache
+from metrics import instrumentation, statement_shape
+
+db.create_all()
+
+
+def sample(name, **labels):
+    return instrumentation.registry.get_sample_value(name, labels) or 0
+
+
+class MetricsTestCase(TestCase):
+    """Test SQL counting, N+1 detection and the /metrics endpoint."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        entity_cache.clear()
+
+        for i in range(6):
+            db.session.add(User(email=f"u{i}@test.com", username=f"u{i}", password="x"))
+        db.session.commit()
+
+        self.client = app.test_client()
+        self.stats_token = app.config['STATS_TOKEN']
+        app.config['STATS_TOKEN'] = "scrape-me"
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['STATS_TOKEN'] = self.stats_token
+
+    def test_statement_shape(self):
+        self.assertEqual(statement_shape("SELECT 1 WHERE id IN (?, ?, ?)"),
+                         statement_shape("SELECT 1 WHERE id IN (?, ?)"))
+        self.assertEqual(statement_shape("SELECT 1 WHERE id IN (%(id_1)s, %(id_2)s)"),
+                         "SELECT 1 WHERE id IN (?...)")
+
+    def test_counts_statements_per_endpoint(self):
+        before = sample('warbler_request_sql_statements_count',
+                        endpoint='list_users', method='GET')
+
+        resp = self.client.get('/users')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(sample('warbler_request_sql_statements_count',
+                                endpoint='list_users', method='GET'), before + 1)
+        self.assertGreater(sample('warbler_request_sql_statements_sum',
+                                  endpoint='list_users', method='GET'), 0)
+
+    def test_flags_repeated_statements(self):
+        before = sample('warbler_request_n_plus_one_total', endpoint='unmatched', method='GET')
+
+        with app.test_request_context('/nowhere'):
+            request_started.send(app)
+            for user_id in range(1, 7):
+                db.session.query(User.username).filter(User.id == user_id).first()
+            request_finished.send(app, response=Response())
+
+        self.assertEqual(sample('warbler_request_n_plus_one_total',
+                                endpoint='unmatched', method='GET'), before + 1)
+
+    def test_failed_statement_leaves_no_timer_on_the_connection(self):
+        engine = create_engine('sqlite://', poolclass=StaticPool)
+        instrumentation.watch(engine)
+
+        with app.test_request_context('/nowhere'):
+            request_started.send(app)
+            with self.assertRaises(OperationalError):
+                engine.execute("SELECT * FROM no_such_table")
+            request_finished.send(app, response=Response())
+
+        # the same pooled connection, outside any request
+        self.assertEqual(engine.execute("SELECT 1").scalar(), 1)
+
+    def test_metrics_endpoint(self):
+        self.client.get('/users')
+        resp = self.client.get('/metrics', headers={'Authorization': "Bearer scrape-me"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('text/plain', resp.content_type)
+        self.assertIn(b'warbler_request_duration_seconds_bucket{endpoint="list_users"',
+                      resp.data)
+
+    def test_stats_need_the_token(self):
+        for url in ('/metrics', '/_stats/cache', '/_stats/jobs'):
+            self.assertEqual(self.client.get(url).status_code, 403)
+            self.assertEqual(self.client.get(url, headers={'Authorization': "Bearer nope"})
+                             .status_code, 403)
+            self.assertEqual(self.client.get(url, headers={'Authorization': "Bearer scrape-me"})
+                             .status_code, 200)
+
+        app.config['STATS_TOKEN'] = None
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': "Bearer "})
+                         .status_code, 403)
@@ -0,0 +1,307 @@
+"""Message partition rollover and archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+import csv
+import gzip
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase, skipUnless
+
+from flask_migrate import downgrade, upgrade
+from sqlalchemy import MetaData, text
+
+from models import db, User, Message, MessageArchive, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from cache import entity_cache
+from fragments import fragments
+from partitions import partitions, month_start, parse_bound
+from purge import purger
+import feed
+from pagination import decode_cursor, encode_cursor
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NOW = datetime(2026, 10, 18, 12, 0)
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+BEFORE_PARTITIONS = '9a7d2e04c6b8'
+
+
+def postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def reset_database():
+    """Drop everything, including tables the models don't know (partitions)."""
+
+    db.session.remove()
+    if postgres():
+        db.engine.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+    else:
+        meta = MetaData()
+        meta.reflect(bind=db.engine)
+        meta.drop_all(bind=db.engine)
+
+
+class MonthsTestCase(TestCase):
+    """Test the partition bound helpers."""
+
+    def test_month_start(self):
+        self.assertEqual(month_start(NOW), datetime(2026, 10, 1))
+        self.assertEqual(month_start(NOW, 3), datetime(2027, 1, 1))
+        self.assertEqual(month_start(NOW, -12), datetime(2025, 10, 1))
+
+    def test_parse_bound(self):
+        self.assertEqual(parse_bound("'2026-11-01 00:00:00'"), datetime(2026, 11, 1))
+        self.assertIsNone(parse_bound("MINVALUE"))
+
+
+class ArchiveTestCase(TestCase):
+    """Test archiving from a plain messages table and reading archived messages."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        entity_cache.clear()
+        fragments.clear()
+
+        self.batch_size = partitions.batch_size
+        self.interval = purger.interval
+        purger.interval = 0
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.commit()
+
+        def message(text, days):
+            return Message(text=text, user_id=self.author.id,
+                           timestamp=NOW - timedelta(days=days))
+
+        self.old = [message(f"old {i}", 400 + i) for i in range(3)]
+        self.deleted = message("deleted", 500)
+        self.deleted.deleted_at = NOW
+        self.recent = message("recent", 10)
+        db.session.add_all(self.old + [self.deleted, self.recent])
+        db.session.commit()
+        db.session.add(Likes(user_id=self.fan.id, message_id=self.old[0].id))
+        db.session.commit()
+
+        self.old_ids = [msg.id for msg in self.old]
+        self.author_id, self.fan_id = self.author.id, self.fan.id
+
+    def tearDown(self):
+        partitions.batch_size = self.batch_size
+        purger.interval = self.interval
+        db.session.rollback()
+
+    def test_rollover_moves_expired_messages(self):
+        partitions.batch_size = 2
+
+        done = partitions.rollover(NOW)
+
+        self.assertEqual(done, dict(created=[], archived=[], messages=3))
+        self.assertEqual([msg.text for msg in Message.query], ["recent"])
+        self.assertEqual(sorted(msg.id for msg in MessageArchive.query), self.old_ids)
+        # likes stay with the archived message
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(partitions.rollover(NOW)['messages'], 0)
+
+    def test_archived_message_is_still_shown(self):
+        partitions.rollover(NOW)
+
+        c = app.test_client()
+        resp = c.get(f"/messages/{self.old_ids[0]}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("old 0", resp.get_data(as_text=True))
+
+        profile = c.get(f"/users/{self.author_id}").get_data(as_text=True)
+        self.assertIn("recent", profile)
+        self.assertNotIn("old 0", profile)
+
+    def test_archived_messages_count_towards_the_profile(self):
+        partitions.rollover(NOW)
+        User.repair_counts()
+        db.session.commit()
+
+        self.assertEqual(User.query.get(self.author_id).messages_count, 4)
+
+    def test_purging_an_account_removes_its_archive(self):
+        partitions.rollover(NOW)
+
+        c = app.test_client()
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+        c.post("/users/delete")
+
+        self.assertEqual(MessageArchive.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(c.get(f"/messages/{self.old_ids[0]}").status_code, 404)
+
+    def test_purging_a_message_removes_its_archived_copy(self):
+        # as if its partition was being archived while it was deleted
+        recent_id = self.recent.id
+        db.session.add(MessageArchive(id=recent_id, text="recent", timestamp=self.recent.timestamp,
+                                      user_id=self.author_id))
+        self.recent.soft_delete()
+        db.session.commit()
+
+        purger.run()
+
+        self.assertIsNone(Message.query.get(recent_id))
+        self.assertIsNone(MessageArchive.query.get(recent_id))
+
+
+class RecentWindowTestCase(TestCase):
+    """Test that feeds read recent messages first without losing older ones."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.recent = partitions.recent
+        partitions.recent = timedelta(days=30)
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        now = datetime.utcnow()
+        db.session.add_all([Message(text=f"warble {days}", user_id=self.author.id,
+                                    timestamp=now - timedelta(days=days))
+                            for days in (1, 2, 40, 90)])
+        db.session.commit()
+
+    def tearDown(self):
+        partitions.recent = self.recent
+        db.session.rollback()
+
+    def test_short_page_reaches_older_messages(self):
+        page = feed.by_user(self.author.id, 3)
+
+        self.assertEqual([msg.text for msg in page], ["warble 1", "warble 2", "warble 40"])
+
+    def test_cursor_past_the_window(self):
+        first = feed.by_user(self.author.id, 3)
+        rest = feed.by_user(self.author.id, 3, decode_cursor(encode_cursor(first[-1])))
+
+        self.assertEqual([msg.text for msg in rest], ["warble 90"])
+
+
+class MigrationTestCase(TestCase):
+    """Test the partitioning migration both ways, and rollover after it.
+
+    On Postgres this is the partitioned path; on SQLite, the plain one.
+    """
+
+    def setUp(self):
+        reset_database()
+        self.archive_dir = partitions.archive_dir
+        self.now = datetime.utcnow()
+
+        with app.app_context():
+            upgrade(MIGRATIONS, BEFORE_PARTITIONS)
+
+        db.engine.execute(text("INSERT INTO users (email, username, password) "
+                               "VALUES ('author@test.com', 'author', 'x')"))
+        self.author_id = db.engine.execute(text("SELECT id FROM users")).scalar()
+        for text_, when in (("old", self.now - timedelta(days=400)), ("recent", self.now)):
+            db.engine.execute(text("INSERT INTO messages (text, timestamp, user_id) "
+                                   "VALUES (:text, :when, :user_id)"),
+                              text=text_, when=when, user_id=self.author_id)
+
+        with app.app_context():
+            upgrade(MIGRATIONS, 'c5f19e3b8a47')
+
+    def tearDown(self):
+        partitions.archive_dir = self.archive_dir
+        reset_database()
+        db.create_all()
+
+    def post(self, text_):
+        msg = Message(text=text_, user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        return msg.id
+
+    def texts(self, model):
+        return sorted(msg.text for msg in model.query)
+
+    def test_upgrade_keeps_messages_and_takes_new_ones(self):
+        new_id = self.post("new")
+
+        self.assertEqual(self.texts(Message), ["new", "old", "recent"])
+        self.assertGreater(new_id, max(msg.id for msg in Message.query if msg.text != "new"))
+
+        if postgres():
+            with db.engine.connect() as conn:
+                self.assertTrue(partitions.partitioned(conn))
+                found = partitions.partitions(conn)
+                adopted_by = conn.execute(text(
+                    "SELECT p.relname FROM pg_inherits i JOIN pg_class p ON p.oid = i.inhparent "
+                    "WHERE i.inhrelid = 'messages_legacy_id_timestamp_key'::regclass")).scalar()
+                checks = conn.execute(text(
+                    "SELECT count(*) FROM pg_constraint WHERE conname = 'messages_legacy_bound'"
+                )).scalar()
+
+            self.assertEqual(found[0], ('messages_legacy', None, month_start(self.now, 1)))
+            self.assertEqual([name for name, _, _ in found[1:]],
+                             [f"messages_p{month_start(self.now, months):%Y_%m}"
+                              for months in range(1, 4)])
+            # ATTACH adopted the index built beforehand, and the bound check is gone
+            self.assertEqual(adopted_by, 'messages_pkey')
+            self.assertEqual(checks, 0)
+
+    def test_rollover_catches_up_on_history(self):
+        done = partitions.rollover(self.now)
+
+        self.assertEqual(done['messages'], 1)
+        self.assertEqual(done['archived'], [])
+        self.assertEqual(self.texts(Message), ["recent"])
+        self.assertEqual(self.texts(MessageArchive), ["old"])
+
+    def test_downgrade_restores_one_plain_table(self):
+        partitions.rollover(self.now)
+        db.session.remove()
+
+        with app.app_context():
+            downgrade(MIGRATIONS, BEFORE_PARTITIONS)
+
+        rows = db.engine.execute(text("SELECT text FROM messages ORDER BY text")).fetchall()
+        self.assertEqual([row.text for row in rows], ["old", "recent"])
+        with db.engine.connect() as conn:
+            self.assertFalse(partitions.partitioned(conn))
+
+    @skipUnless(postgres(), "partitions need Postgres")
+    def test_archiving_a_partition_carries_over_changes(self):
+        partitions.archive_dir = tempfile.mkdtemp()
+        recent_id = Message.query.filter_by(text="recent").one().id
+        db.session.commit()
+
+        partitions._copy('messages_legacy')
+        # deleted and liked while the copy was being made
+        db.engine.execute(text("UPDATE messages SET deleted_at = now() WHERE text = 'old'"))
+        db.engine.execute(text("UPDATE messages SET like_count = 3 WHERE id = :id"), id=recent_id)
+        # the run is interrupted after detaching
+        partitions._detach('messages_legacy')
+
+        # a year on, so the legacy partition and the next one expire
+        done = partitions.rollover(month_start(self.now, 14))
+
+        self.assertEqual(done['archived'], ['messages_legacy',
+                                            f"messages_p{month_start(self.now, 1):%Y_%m}"])
+        self.assertEqual(done['messages'], 1)
+        self.assertEqual([(msg.text, msg.like_count) for msg in MessageArchive.query],
+                         [("recent", 3)])
+        with db.engine.connect() as conn:
+            self.assertEqual(partitions.detached(conn), [])
+
+        with gzip.open(os.path.join(partitions.archive_dir, 'messages_legacy.csv.gz'), 'rt') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([row['text'] for row in rows], ["recent"])
@@ -0,0 +1,165 @@
+"""Soft delete and background purge tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_purge.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, Purge
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from cache import entity_cache
+from fragments import fragments
+from likecounts import like_counts
+from purge import purger
+from timelines import timelines
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PurgeTestCase(TestCase):
+    """Test that deleted rows are hidden at once and removed in batches."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        entity_cache.clear()
+        fragments.clear()
+        like_counts.clear()
+        timelines.store.clear()
+
+        self.interval = purger.interval
+        self.batch_size = purger.batch_size
+        # the delete routes purge before they return
+        purger.interval = 0
+
+        self.users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                      for i in range(4)]
+        db.session.commit()
+        self.gone, self.fan, self.friend, self.other = [u.id for u in self.users]
+
+        # `gone` follows and is followed, posts three messages and likes others'
+        db.session.add_all([Follows(user_following_id=self.gone, user_being_followed_id=self.friend),
+                            Follows(user_following_id=self.fan, user_being_followed_id=self.gone),
+                            Follows(user_following_id=self.other, user_being_followed_id=self.gone)])
+        self.messages = [Message(text=f"warble {i}", user_id=self.gone) for i in range(3)]
+        self.friend_msg = Message(text="friendly", user_id=self.friend, like_count=1)
+        db.session.add_all(self.messages + [self.friend_msg])
+        db.session.commit()
+        db.session.add_all([Likes(user_id=self.fan, message_id=msg.id) for msg in self.messages]
+                           + [Likes(user_id=self.gone, message_id=self.friend_msg.id)])
+        db.session.commit()
+        self.message_ids = [msg.id for msg in self.messages]
+        User.repair_counts()
+        db.session.commit()
+
+    def tearDown(self):
+        purger.interval = self.interval
+        purger.batch_size = self.batch_size
+        db.session.rollback()
+
+    def client_as(self, user_id):
+        c = app.test_client()
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return c
+
+    def soft_delete(self, row):
+        """Delete like the routes do, without purging."""
+
+        db.session.merge(row).soft_delete()
+        db.session.commit()
+        entity_cache.clear()
+
+    def counts(self, user_id):
+        db.session.expire_all()
+        user = User.query.get(user_id)
+        return user.messages_count, user.followers_count, user.following_count, user.likes_count
+
+    def test_deleted_user_is_hidden_at_once(self):
+        self.soft_delete(self.users[0])
+
+        c = self.client_as(self.fan)
+        self.assertEqual(c.get(f'/users/{self.gone}').status_code, 404)
+        self.assertNotIn(b"@user0", c.get('/users').data)
+        self.assertNotIn(b"@user0", c.get(f'/users/{self.friend}/followers').data)
+        self.assertNotIn(b"warble 0", c.get("/").data)
+        self.assertEqual(c.get(f'/messages/{self.message_ids[0]}').status_code, 404)
+        self.assertEqual(c.post('/users/likes', json={"likes": {str(self.message_ids[0]): True}})
+                         .get_json()['missing'], [self.message_ids[0]])
+        self.assertEqual(c.post(f'/users/follow/{self.gone}').status_code, 404)
+        self.assertFalse(User.authenticate("user0", "password"))
+
+        # nothing has been removed yet
+        self.assertEqual(Message.query.filter_by(user_id=self.gone).count(), 3)
+        self.assertEqual(Purge.query.filter_by(kind='user', target_id=self.gone).one().finished_at,
+                         None)
+
+    def test_deleted_message_is_hidden_at_once(self):
+        msg_id = self.message_ids[0]
+        self.soft_delete(self.messages[0])
+
+        c = self.client_as(self.fan)
+        self.assertEqual(c.get(f'/messages/{msg_id}').status_code, 404)
+        self.assertNotIn(b"warble 0", c.get(f'/users/{self.gone}').data)
+        self.assertIn(b"warble 1", c.get(f'/users/{self.gone}').data)
+        self.assertEqual(self.counts(self.gone)[0], 2)
+        self.assertEqual(c.post(f'/messages/{msg_id}/delete').status_code, 404)
+
+    def test_only_the_author_can_delete_a_message(self):
+        msg_id = self.message_ids[0]
+
+        resp = self.client_as(self.fan).post(f'/messages/{msg_id}/delete')
+        self.assertEqual(resp.status_code, 404)
+        self.assertIsNone(Message.query.get(msg_id).deleted_at)
+        self.assertEqual(Purge.query.count(), 0)
+
+        self.client_as(self.gone).post(f'/messages/{msg_id}/delete')
+        self.assertIsNone(Message.query.get(msg_id))
+
+    def test_user_purge_runs_in_batches(self):
+        self.soft_delete(self.users[0])
+
+        purger.batch_size = 2
+        batches = []
+        self.assertEqual(purger.run(lambda purge_id, rows: batches.append(rows)), 1)
+
+        # 1 like by, 3 likes of (2 + 1), 1 follow by, 2 followers, 3 messages (2 + 1), the user
+        self.assertEqual(batches, [1, 2, 1, 1, 2, 2, 1, 1, 0])
+        self.assertEqual(Purge.query.one().rows_deleted, sum(batches))
+        self.assertIsNotNone(Purge.query.one().finished_at)
+
+        self.assertIsNone(User.query.get(self.gone))
+        self.assertEqual(Message.query.filter_by(user_id=self.gone).count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+
+        db.session.expire_all()
+        self.assertEqual(Message.query.get(self.friend_msg.id).like_count, 0)
+        self.assertEqual(self.counts(self.fan), (0, 0, 0, 0))
+        self.assertEqual(self.counts(self.friend), (1, 0, 0, 0))
+        self.assertEqual(self.counts(self.other), (0, 0, 0, 0))
+
+        # finished purges are not picked up again
+        self.assertEqual(purger.run(), 0)
+
+    def test_message_purge_corrects_likers(self):
+        self.client_as(self.gone).post(f'/messages/{self.message_ids[0]}/delete')
+
+        self.assertIsNone(Message.query.get(self.message_ids[0]))
+        self.assertEqual(self.counts(self.fan)[3], 2)
+        self.assertEqual(Purge.query.one().rows_deleted, 2)
+
+    def test_delete_user_with_messages(self):
+        resp = self.client_as(self.gone).post('/users/delete')
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNone(User.query.get(self.gone))
+        self.assertEqual(self.counts(self.fan), (0, 0, 0, 0))
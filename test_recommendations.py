@@ -0,0 +1,127 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Follows, Recommendation
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from cache import entity_cache
+import recommendations
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# who follows whom: 1 -> 2, 3;  2 -> 4;  3 -> 4, 5;  5 -> 1;  6 -> 4
+FOLLOWS = [(1, 2), (1, 3), (2, 4), (3, 4), (3, 5), (5, 1), (6, 4)]
+
+
+def suggestions(A, ids, **options):
+    """{user id: [(candidate id, score, mutuals), ...]} from recommend()."""
+
+    result = {}
+    for _, _, row, col, score, mutual, _ in recommendations.recommend(A, **options):
+        for user, candidate, s, m in zip(row, col, score, mutual):
+            result.setdefault(int(ids[user]), []).append((int(ids[candidate]), s, int(m)))
+    return result
+
+
+class RecommendTestCase(TestCase):
+    """Test the matrix computation."""
+
+    def setUp(self):
+        self.ids = np.arange(1, 7)
+        edges = np.array(FOLLOWS)
+        self.A = recommendations.adjacency(self.ids, edges[:, 0], edges[:, 1])
+
+    def test_second_degree_ranked_by_mutuals(self):
+        result = suggestions(self.A, self.ids)
+
+        # 4 is followed by both 2 and 3, 5 by 3 only but 5 follows 1 back
+        self.assertEqual(result[1], [(4, 2.0, 2), (5, 1.5, 1)])
+        # 3 is followed by the one they follow (1) and follows 5 back;
+        # never themselves or someone they already follow
+        self.assertEqual(result[5], [(3, 1.5, 1), (2, 1.0, 1)])
+        # people who follow them but have no mutuals still count
+        self.assertEqual([c for c, _, _ in result[4]], [2, 3, 6])
+        self.assertNotIn(6, result)
+
+    def test_blocks_and_top_k(self):
+        whole = suggestions(self.A, self.ids)
+
+        self.assertEqual(suggestions(self.A, self.ids, block_rows=2), whole)
+        self.assertEqual(suggestions(self.A, self.ids, per_user=1)[1], [(4, 2.0, 2)])
+
+    def test_edges_of_missing_users_are_dropped(self):
+        ids = np.array([1, 2, 4])
+        A = recommendations.adjacency(ids, np.array([1, 2, 3]), np.array([2, 4, 4]))
+
+        self.assertEqual(A.nnz, 2)
+        self.assertEqual(suggestions(A, ids)[1], [(4, 1.0, 1)])
+
+
+class RefreshTestCase(TestCase):
+    """Test the batch job and the home sidebar."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        entity_cache.clear()
+
+        for i in range(1, 7):
+            db.session.add(User(id=i, email=f"u{i}@test.com", username=f"user{i}",
+                                password="x"))
+        db.session.commit()
+        db.session.add_all([Follows(user_following_id=follower, user_being_followed_id=followed)
+                            for follower, followed in FOLLOWS])
+        # a leftover from an earlier run, for someone with no candidates now
+        db.session.add(Recommendation(user_id=6, rank=1, candidate_id=1, score=1, mutuals=1))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_refresh_replaces_the_table(self):
+        stats = recommendations.refresh(db.engine, block_rows=4)
+
+        self.assertEqual((stats['users'], stats['edges']), (6, len(FOLLOWS)))
+        rows = [(r.user_id, r.rank, r.candidate_id, r.mutuals)
+                for r in Recommendation.query.order_by(Recommendation.user_id,
+                                                       Recommendation.rank)]
+        self.assertEqual(rows[:2], [(1, 1, 4, 2), (1, 2, 5, 1)])
+        self.assertNotIn(6, [user_id for user_id, _, _, _ in rows])
+        self.assertEqual(stats['recommendations'], len(rows))
+
+    def test_deleted_users_are_not_suggested(self):
+        User.query.get(4).soft_delete()
+        db.session.commit()
+
+        recommendations.refresh(db.engine)
+
+        self.assertEqual([r.candidate_id for r in Recommendation.query.filter_by(user_id=1)], [5])
+
+    def test_home_sidebar(self):
+        recommendations.refresh(db.engine)
+        c = app.test_client()
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+        html = c.get('/').get_data(as_text=True)
+        self.assertIn("Who to follow", html)
+        self.assertIn("@user4", html)
+        self.assertIn("Followed by 2 you follow", html)
+
+        c.post('/users/follow/4')
+        html = c.get('/').get_data(as_text=True)
+        self.assertNotIn("@user4", html)
+        self.assertIn("@user5", html)
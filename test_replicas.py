@@ -0,0 +1,122 @@
+"""Primary/replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+#
+# The replica is a second database, warbler-test-replica, that these
+# tests fill themselves; it only needs to exist.
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+REPLICA_URL = "postgresql:///warbler-test-replica"
+DOWN_URL = "sqlite:////nonexistent/warbler-replica.db"
+
+from app import app, CURR_USER_KEY
+from cache import entity_cache
+from replicas import replicas
+from timelines import timelines
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test which database reads and writes go to."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        entity_cache.clear()
+
+        self.user = User.signup("primaryuser", "primary@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        replicas.configure([REPLICA_URL])
+        self.replica = replicas.engines[0]
+        db.Model.metadata.drop_all(self.replica)
+        db.Model.metadata.create_all(self.replica)
+        self.replica.execute(User.__table__.insert(), username="replicauser",
+                             email="replica@test.com", password="x")
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        db.session.rollback()
+        db.Model.metadata.drop_all(self.replica)
+        replicas.configure([])
+
+    def test_get_reads_from_replica(self):
+        resp = self.client.get('/users')
+
+        self.assertIn(b"@replicauser", resp.data)
+        self.assertNotIn(b"@primaryuser", resp.data)
+
+    def test_writes_go_to_primary_and_stick(self):
+        resp = self.client.post('/messages/new', data={"text": "on the primary"})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Message.query.one().text, "on the primary")
+
+        # right after a write this user reads their own writes
+        resp = self.client.get('/users')
+        self.assertIn(b"@primaryuser", resp.data)
+        self.assertNotIn(b"@replicauser", resp.data)
+
+        # ...until the window has passed
+        with self.client.session_transaction() as sess:
+            sess['primary_until'] = 0
+        self.assertIn(b"@replicauser", self.client.get('/users').data)
+
+    def test_outside_requests_use_primary(self):
+        with app.app_context():
+            self.assertEqual([u.username for u in User.query.all()], ["primaryuser"])
+
+    def test_cache_fills_from_primary(self):
+        with app.test_request_context('/users'):
+            app.preprocess_request()
+            self.assertEqual(entity_cache.user(self.user_id).username, "primaryuser")
+
+    def test_unhealthy_replica_is_skipped(self):
+        replicas.configure([DOWN_URL, REPLICA_URL])
+
+        for _ in range(2):
+            self.assertIn(b"@replicauser", self.client.get('/users').data)
+        self.assertFalse(replicas.replicas[0].healthy)
+
+    def test_no_healthy_replica_falls_back_to_primary(self):
+        replicas.configure([DOWN_URL])
+
+        self.assertIn(b"@primaryuser", self.client.get('/users').data)
+
+    def test_home_shows_messages_the_replica_lacks(self):
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        author_id = author.id
+        follow = dict(user_following_id=self.user_id, user_being_followed_id=author_id)
+        db.session.add(Follows(**follow))
+        db.session.commit()
+        self.replica.execute(User.__table__.insert(), id=author_id, username="author",
+                             email="author@test.com", password="x")
+        self.replica.execute(Follows.__table__.insert(), **follow)
+        timelines.store.clear()
+
+        etag = self.client.get('/').headers["ETag"]
+
+        # posted on the primary, not replicated yet
+        msg = Message(text="fresh off the primary", user_id=author_id)
+        db.session.add(msg)
+        db.session.commit()
+        timelines.fanout(msg)
+
+        resp = self.client.get('/', headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"fresh off the primary", resp.data)
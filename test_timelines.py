@@ -0,0 +1,284 @@
+"""Home timeline store tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timelines.py
+
+
+import os
+from unittest import TestCase
+
+import fakeredis
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from purge import purger
+from timelines import timelines, MemoryTimelineStore, RedisTimelineStore
+
+db.create_all()
+
+
+class MemoryTimelineStoreTestCase(TestCase):
+    """Test the in-process store on its own."""
+
+    def test_add_is_sorted_and_capped(self):
+        store = MemoryTimelineStore(size=3)
+        store.add(1, [(10.0, 1), (30.0, 3), (20.0, 2)])
+        store.add(1, [(40.0, 4), (20.0, 2)])
+
+        self.assertEqual(store.ids(1, 10), [4, 3, 2])
+
+    def test_remove(self):
+        store = MemoryTimelineStore()
+        store.add(1, [(10.0, 1), (20.0, 2)])
+        store.remove(1, [2])
+
+        self.assertEqual(store.ids(1, 10), [1])
+        self.assertFalse(store.exists(2))
+
+    def test_ttl(self):
+        store = MemoryTimelineStore(ttl=60)
+        store.add(1, [(10.0, 1)])
+        store.push([1, 2], [(20.0, 2)])
+
+        self.assertEqual(store.ids(1, 10), [2, 1])
+        self.assertFalse(store.exists(2))
+
+        store.warmed[1] -= 61
+        self.assertFalse(store.exists(1))
+        self.assertEqual(store.ids(1, 10), [])
+
+    def test_cold_timelines_are_swept_on_write(self):
+        store = MemoryTimelineStore(ttl=60)
+        store.add(1, [(10.0, 1)])
+        store.add(2, [(10.0, 1)])
+        store.warmed[1] -= 61
+
+        store.add(3, [(10.0, 1)])
+        self.assertEqual(list(store.timelines), [2, 3])
+        self.assertEqual(list(store.warmed), [2, 3])
+
+    def test_least_recently_read_is_dropped(self):
+        store = MemoryTimelineStore(max_users=2)
+        store.add(1, [(10.0, 1)])
+        store.add(2, [(10.0, 1)])
+        self.assertTrue(store.exists(1))
+
+        store.add(3, [(10.0, 1)])
+        self.assertTrue(store.exists(1))
+        self.assertFalse(store.exists(2))
+        self.assertTrue(store.exists(3))
+        self.assertEqual(len(store.warmed), 2)
+
+
+class RedisTimelineStoreTestCase(TestCase):
+    """Test the shared store against fakeredis."""
+
+    def setUp(self):
+        self.client = fakeredis.FakeRedis()
+        self.store = RedisTimelineStore(self.client, size=3)
+
+    def test_add_is_sorted_and_capped(self):
+        self.store.add(1, [(10.0, 1), (30.0, 3), (20.0, 2)])
+        self.store.add(1, [(40.0, 4), (20.0, 2)])
+
+        self.assertEqual(self.store.ids(1, 10), [4, 3, 2])
+        self.assertEqual(self.store.count(1), 3)
+
+    def test_empty_timeline_is_warm(self):
+        self.store.add(1, [])
+
+        self.assertTrue(self.store.exists(1))
+        self.assertFalse(self.store.exists(2))
+        self.assertEqual(self.store.ids(1, 10), [])
+
+    def test_ids_before(self):
+        self.store.size = 10
+        self.store.add(1, [(10.0, 1), (20.0, 2), (20.0, 3), (20.0, 4), (30.0, 5)])
+
+        self.assertEqual(self.store.ids(1, 2, before=(20.0, 4)), [3, 2])
+        self.assertEqual(self.store.ids(1, 10, before=(20.0, 2)), [1])
+        self.assertEqual(self.store.ids(1, 10, before=(10.0, 1)), [])
+
+    def test_push_only_to_warm_timelines(self):
+        self.store.add(1, [(10.0, 1)])
+        self.store.push([1, 2], [(20.0, 2)])
+
+        self.assertEqual(self.store.ids(1, 10), [2, 1])
+        self.assertFalse(self.store.exists(2))
+        self.assertEqual(self.store.count(2), 0)
+
+    def test_remove_and_retract(self):
+        self.store.add(1, [(10.0, 1), (20.0, 2), (30.0, 3)])
+        self.store.add(2, [(20.0, 2), (30.0, 3)])
+
+        self.store.remove(1, [1])
+        self.store.retract([1, 2], [3])
+
+        self.assertEqual(self.store.ids(1, 10), [2])
+        self.assertEqual(self.store.ids(2, 10), [2])
+
+    def test_celebrities_and_clear(self):
+        self.client.set("other", "x")
+        self.store.add(1, [(10.0, 1)])
+        self.store.add(2, [(10.0, 1)])
+        self.store.mark_celebrity(5)
+        self.store.mark_celebrity(6)
+        self.store.unmark_celebrity(6)
+        self.assertEqual(self.store.celebrity_ids(), {5})
+
+        self.store.clear(1)
+        self.assertFalse(self.store.exists(1))
+        self.assertTrue(self.store.exists(2))
+
+        self.store.clear()
+        self.assertFalse(self.store.exists(2))
+        self.assertEqual(self.store.celebrity_ids(), set())
+        self.assertEqual(self.client.get("other"), b"x")
+
+
+class TimelinesTestCase(TestCase):
+    """Test fan-out on write against the database."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        timelines.store.clear()
+
+        self.author = User.signup("author", "author@test.com", "password")
+        self.reader = User.signup("reader", "reader@test.com", "password")
+        db.session.commit()
+
+        self.reader.following.append(self.author)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        timelines.store.clear()
+
+    def post(self, text):
+        msg = Message(text=text, user_id=self.author.id)
+        db.session.add(msg)
+        db.session.commit()
+        timelines.fanout(msg)
+        return msg
+
+    def test_cold_timeline_is_rebuilt(self):
+        msg = self.post("first")
+
+        self.assertFalse(timelines.store.exists(self.reader.id))
+        self.assertEqual([m.id for m in timelines.home(self.reader.id)], [msg.id])
+        self.assertTrue(timelines.store.exists(self.reader.id))
+
+    def test_fanout_to_warm_timeline(self):
+        timelines.home(self.reader.id)
+        msg = self.post("hello")
+
+        self.assertEqual(timelines.store.ids(self.reader.id, 10), [msg.id])
+
+    def test_fanout_on_redis(self):
+        store = timelines.store
+        timelines.store = RedisTimelineStore(fakeredis.FakeRedis())
+        try:
+            self.assertEqual(timelines.home(self.reader.id), [])
+            msg = self.post("hello")
+            self.assertEqual(timelines.store.ids(self.reader.id, 10), [msg.id])
+            self.assertEqual([m.id for m in timelines.home(self.reader.id)], [msg.id])
+        finally:
+            timelines.store = store
+
+    def test_celebrities_are_pulled(self):
+        timelines.home(self.reader.id)
+        timelines.max_followers = 0
+        try:
+            msg = self.post("to the masses")
+        finally:
+            timelines.max_followers = app.config['TIMELINE_FANOUT_MAX_FOLLOWERS']
+
+        self.assertEqual(timelines.store.ids(self.reader.id, 10), [])
+        self.assertEqual([m.id for m in timelines.home(self.reader.id)], [msg.id])
+
+    def test_big_accounts_are_not_fanned_out(self):
+        timelines.home(self.reader.id)
+        User.bump_counts(self.author.id, followers_count=timelines.max_followers + 1)
+        db.session.commit()
+        msg = self.post("to the masses")
+
+        self.assertEqual(timelines.store.ids(self.reader.id, 10), [])
+        self.assertIn(self.author.id, timelines.store.celebrity_ids())
+        self.assertEqual([m.id for m in timelines.home(self.reader.id)], [msg.id])
+
+    def test_shrunk_accounts_are_fanned_out_again(self):
+        timelines.home(self.reader.id)
+        User.bump_counts(self.author.id, followers_count=timelines.max_followers + 1)
+        db.session.commit()
+        pulled = self.post("to the masses")
+
+        User.bump_counts(self.author.id, followers_count=-timelines.max_followers)
+        db.session.commit()
+        pushed = self.post("to the few")
+
+        self.assertNotIn(self.author.id, timelines.store.celebrity_ids())
+        self.assertEqual(timelines.store.ids(self.reader.id, 10), [pushed.id, pulled.id])
+        self.assertEqual([m.id for m in timelines.home(self.reader.id)], [pushed.id, pulled.id])
+
+    def test_home_pages_past_the_cap(self):
+        timelines.home(self.reader.id)
+        timelines.store.size = 3
+        try:
+            posted = [self.post(f"warble {i}") for i in range(5)]
+            first = timelines.home(self.reader.id, limit=2)
+            last = first[-1]
+            rest = timelines.home(self.reader.id, limit=10,
+                                  before=(last.timestamp, last.id))
+        finally:
+            timelines.store.size = app.config['TIMELINE_SIZE']
+
+        self.assertEqual([m.id for m in first + rest], [m.id for m in posted[::-1]])
+
+    def test_unfollow_prunes(self):
+        self.post("hello")
+        timelines.home(self.reader.id)
+
+        self.reader.following.remove(self.author)
+        db.session.commit()
+        timelines.unfollow(self.reader.id, self.author.id)
+
+        self.assertEqual(timelines.home(self.reader.id), [])
+
+    def test_missing_messages_are_skipped_and_pruned(self):
+        timelines.home(self.reader.id)
+        posted = [self.post(f"warble {i}") for i in range(5)]
+        posted[3].deleted_at = posted[3].timestamp
+        db.session.commit()
+
+        page = timelines.home(self.reader.id, limit=3)
+
+        self.assertEqual([m.id for m in page], [posted[4].id, posted[2].id, posted[1].id])
+        self.assertNotIn(posted[3].id, timelines.store.ids(self.reader.id, 10))
+
+    def test_homepage_keeps_paging_after_a_delete(self):
+        newest = [self.post(f"warble {i}") for i in range(30)][-1].id
+        author, reader = self.author.id, self.reader.id
+        c = app.test_client()
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = reader
+        self.assertIn("data-next", c.get("/").get_data(as_text=True))
+
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = author
+        interval, purger.interval = purger.interval, 0
+        try:
+            c.post(f"/messages/{newest}/delete")
+        finally:
+            purger.interval = interval
+
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = reader
+        html = c.get("/").get_data(as_text=True)
+        self.assertIn("data-next", html)
+        self.assertEqual(html.count('<li class="list-group-item">'), 20)
+        self.assertNotIn(f'"/messages/{newest}"', html)
@@ -10,6 +10,7 @@ from unittest import TestCase
 from sqlalchemy import exc
 
 from models import db, User, Message, Follows
+from passwords import hasher
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -110,6 +111,44 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.u2.is_followed_by(self.u1))
         self.assertFalse(self.u1.is_followed_by(self.u2))
 
+    def test_following_among(self):
+        self.u1.following.append(self.u2)
+        db.session.commit()
+
+        self.assertEqual(self.u1.following_among([self.uid1, self.uid2, 12345]), {self.uid2})
+        self.assertEqual(self.u2.following_among([self.uid1, self.uid2]), set())
+        self.assertEqual(self.u1.following_among([]), set())
+
+    def test_counters(self):
+        self.u1.follow(self.u2)
+        self.u2.add_message(Message(text="a warble"))
+        db.session.commit()
+
+        self.assertEqual((self.u1.following_count, self.u1.followers_count), (1, 0))
+        self.assertEqual((self.u2.following_count, self.u2.followers_count), (0, 1))
+        self.assertEqual(self.u2.messages_count, 1)
+
+        self.u1.unfollow(self.u2)
+        db.session.commit()
+
+        self.assertEqual(self.u1.following_count, 0)
+        self.assertEqual(self.u2.followers_count, 0)
+
+    def test_repair_counts(self):
+        self.u1.following.append(self.u2)
+        msg = Message(text="a warble", user_id=self.uid2)
+        db.session.add(msg)
+        self.u1.likes.append(msg)
+        db.session.commit()
+
+        User.repair_counts()
+        db.session.commit()
+
+        u1 = User.query.get(self.uid1)
+        u2 = User.query.get(self.uid2)
+        self.assertEqual((u1.following_count, u1.likes_count, u1.messages_count), (1, 1, 0))
+        self.assertEqual((u2.followers_count, u2.likes_count, u2.messages_count), (1, 0, 1))
+
     def test_signup(self):
         user = User.signup('user_test','user@user.ru','123456')
         user.id = 9999
@@ -131,6 +170,15 @@ class UserModelTestCase(TestCase):
 
     def test_invalid_username(self):
         self.assertFalse(User.authenticate("badusername", "password"))
-    
 
+    def test_rehash_on_login(self):
+        """Hashes at an old cost are upgraded by a successful login"""
+        self.u1.password = hasher.bcrypt.generate_password_hash("password", 4).decode('UTF-8')
+        db.session.commit()
+        self.assertTrue(hasher.needs_rehash(self.u1.password))
+
+        u = User.authenticate(self.u1.username, "password")
+        db.session.commit()
 
+        self.assertFalse(hasher.needs_rehash(u.password))
+        self.assertTrue(User.authenticate(self.u1.username, "password"))
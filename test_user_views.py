@@ -8,6 +8,9 @@ from models import db, connect_db, Message, User, Follows
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 from app import app, CURR_USER_KEY
+from cache import entity_cache
+from fragments import fragments
+from timelines import timelines
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -28,6 +31,9 @@ class UserViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        entity_cache.clear()
+        fragments.clear()
+        timelines.store.clear()
 
         self.testuser1 = User.signup(username="testuser1",
                                     email="test@test.com",
@@ -105,6 +111,50 @@ class UserViewTestCase(TestCase):
             self.assertIn("@testuser1", str(resp.data))
             self.assertIn("@testuser2", str(resp.data))
 
+    def test_users_search_ranks_prefix_first(self):
+        User.signup(username="mytestuser", email="my@test.com", password="password")
+        db.session.commit()
+
+        with self.client as c:
+            html = c.get("/users?q=TEST").get_data(as_text=True)
+
+            self.assertLess(html.index("@testuser1"), html.index("@mytestuser"))
+
+    def test_users_search_short_term_matches_prefixes(self):
+        User.signup(username="mytestuser", email="my@test.com", password="password")
+        db.session.commit()
+
+        with self.client as c:
+            html = c.get("/users?q=Te").get_data(as_text=True)
+
+            self.assertIn("@testuser1", html)
+            self.assertLess(html.index("@testuser1"), html.index("@testuser2"))
+            self.assertNotIn("@mytestuser", html)
+
+    def test_users_search_short_term_is_literal(self):
+        """Prefix matching treats LIKE wildcards as plain characters"""
+
+        User.signup(username="t_rex", email="rex@test.com", password="password")
+        db.session.commit()
+
+        with self.client as c:
+            html = c.get("/users?q=T_").get_data(as_text=True)
+
+            self.assertIn("@t_rex", html)
+            self.assertNotIn("@testuser1", html)
+
+    def test_users_autocomplete(self):
+        with self.client as c:
+            resp = c.get("/users/autocomplete?q=testuser2")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["users"],
+                             [{"id": self.testuser2.id, "username": "testuser2",
+                               "image_url": self.testuser2.image_url}])
+
+            resp = c.get("/users/autocomplete?q=user")
+            self.assertEqual(resp.json["users"], [])
+
     def test_user_show(self):
         with self.client as c:
             resp = c.get(f"/users/{self.testuser1.id}")
@@ -112,5 +162,84 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("@testuser", str(resp.data))
 
+    def test_user_messages_pages(self):
+        """Profile feed pages with a cursor and no repeats"""
+
+        for i in range(25):
+            db.session.add(Message(text=f"warble {i}", user_id=self.testuser1.id))
+        db.session.commit()
+
+        with self.client as c:
+            first = c.get(f"/users/{self.testuser1.id}/messages").json
+            self.assertEqual(len(first["messages"]), 20)
+            self.assertIsNotNone(first["cursor"])
+
+            second = c.get(first["next"]).json
+            self.assertEqual(len(second["messages"]), 5)
+            self.assertIsNone(second["cursor"])
+
+            ids = [m["id"] for m in first["messages"] + second["messages"]]
+            self.assertEqual(len(set(ids)), 25)
+
+            resp = c.get(f"/users/{self.testuser1.id}/messages?cursor=nonsense")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_user_show_conditional_get(self):
+        """Revisiting an unchanged profile is a 304; following the user changes it"""
+
+        uid1, uid2 = self.testuser1.id, self.testuser2.id
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = uid1
+
+            first = c.get(f"/users/{uid2}")
+            etag = first.headers["ETag"]
+            self.assertIn("no-cache", first.headers["Cache-Control"])
+            self.assertIn("private", first.headers["Cache-Control"])
+
+            again = c.get(f"/users/{uid2}", headers={"If-None-Match": etag})
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again.data, b"")
+
+            c.post(f"/users/follow/{uid2}")
+            changed = c.get(f"/users/{uid2}", headers={"If-None-Match": etag})
+            self.assertEqual(changed.status_code, 200)
+            self.assertNotEqual(changed.headers["ETag"], etag)
+
+    def test_conditional_get_ignores_if_modified_since(self):
+        """Following the profile owner isn't hidden by an unchanged newest message"""
+
+        uid1, uid2 = self.testuser1.id, self.testuser2.id
+        db.session.add(Message(text="hello", user_id=uid2))
+        db.session.commit()
 
-            
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = uid1
+            last_modified = c.get(f"/users/{uid2}").headers["Last-Modified"]
+
+            c.post(f"/users/follow/{uid2}")
+            resp = c.get(f"/users/{uid2}", headers={"If-Modified-Since": last_modified})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+    def test_conditional_get_sees_swapped_follows(self):
+        """Unfollowing one user and following another changes the viewer's pages"""
+
+        uid1, uid2 = self.testuser1.id, self.testuser2.id
+        third = User.signup(username="testuser3", email="test3@test.com", password="testuser3")
+        msg = Message(text="hello", user_id=uid2)
+        db.session.add(msg)
+        db.session.commit()
+        uid3, msg_id = third.id, msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = uid1
+            c.post(f"/users/follow/{uid2}")
+            etag = c.get(f"/messages/{msg_id}").headers["ETag"]
+
+            c.post(f"/users/stop-following/{uid2}")
+            c.post(f"/users/follow/{uid3}")
+            resp = c.get(f"/messages/{msg_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
@@ -0,0 +1,469 @@
+"""Precomputed home timelines for Warbler (fan-out on write).
+
+Every user gets a capped list of message ids from the people they follow.
+New messages are pushed onto their followers' lists when they are posted,
+so the homepage only has to read ids and hydrate them in one query.
+
+Authors with a huge number of followers are not fanned out; their recent
+messages are merged into the timeline at read time instead.
+
+Timelines live in Redis when TIMELINE_REDIS_URL is set. Otherwise each
+process keeps its own, which miss messages posted through other
+processes, so in-memory timelines are rebuilt from the database once
+they are TIMELINE_MEMORY_TTL seconds old. A process keeps at most
+TIMELINE_MEMORY_MAX_USERS of them, dropping the least recently read.
+"""
+
+import time
+from collections import OrderedDict
+
+import feed
+from models import db, User, Message, Follows
+from pagination import newest_page
+from partitions import partitions
+from replicas import replicas
+
+TIMELINE_SIZE = 800
+FANOUT_MAX_FOLLOWERS = 10000
+MEMORY_TTL = 60
+MEMORY_MAX_USERS = 10000
+
+
+def _score(msg):
+    """Sort key for a message in a timeline: newest first."""
+
+    return msg.timestamp.timestamp()
+
+
+def _position(before):
+    """(score, id) position in a timeline for a pagination cursor."""
+
+    if before is None:
+        return None
+    timestamp, message_id = before
+    return timestamp.timestamp(), message_id
+
+
+class MemoryTimelineStore:
+    """In-process timeline store (a dict of sorted lists).
+
+    Timelines older than `ttl` seconds count as cold, so with several
+    workers a timeline misses other workers' messages for at most that
+    long. None keeps them forever (a single worker, tests).
+
+    Cold timelines are swept out whenever a new one is warmed, and at
+    most `max_users` are kept: past that the least recently read one is
+    dropped, to be rebuilt if its owner comes back.
+    """
+
+    def __init__(self, size=TIMELINE_SIZE, ttl=None, max_users=MEMORY_MAX_USERS):
+        self.size = size
+        self.ttl = ttl
+        self.max_users = max_users
+        # timelines in least recently read order, warmed in warming order
+        self.timelines = OrderedDict()
+        self.warmed = {}
+        self.celebrities = set()
+
+    def exists(self, user_id):
+        if user_id not in self.timelines:
+            return False
+        if self.ttl is not None and time.monotonic() - self.warmed[user_id] > self.ttl:
+            self.clear(user_id)
+            return False
+        self.timelines.move_to_end(user_id)
+        return True
+
+    def _evict(self):
+        """Drop cold timelines, then the least recently read past max_users."""
+
+        if self.ttl is not None:
+            now = time.monotonic()
+            cold = []
+            for user_id, warmed in self.warmed.items():
+                if now - warmed <= self.ttl:
+                    break
+                cold.append(user_id)
+            for user_id in cold:
+                self.clear(user_id)
+
+        while len(self.timelines) > self.max_users:
+            self.clear(next(iter(self.timelines)))
+
+    def add(self, user_id, entries):
+        """Add (score, message_id) pairs to a user's timeline and trim it."""
+
+        if user_id not in self.timelines:
+            self.warmed[user_id] = time.monotonic()
+            self.timelines[user_id] = []
+            self._evict()
+        timeline = self.timelines.setdefault(user_id, [])
+        known = {message_id for score, message_id in timeline}
+        timeline.extend(entry for entry in entries if entry[1] not in known)
+        timeline.sort(reverse=True)
+        del timeline[self.size:]
+
+    def remove(self, user_id, message_ids):
+        message_ids = set(message_ids)
+        if user_id in self.timelines:
+            self.timelines[user_id] = [entry for entry in self.timelines[user_id]
+                                       if entry[1] not in message_ids]
+
+    def push(self, user_ids, entries):
+        """Add `entries` to those of `user_ids`' timelines that are warm."""
+
+        for user_id in user_ids:
+            if self.exists(user_id):
+                self.add(user_id, entries)
+
+    def retract(self, user_ids, message_ids):
+        """Remove `message_ids` from all of `user_ids`' timelines."""
+
+        for user_id in user_ids:
+            self.remove(user_id, message_ids)
+
+    def ids(self, user_id, limit, before=None):
+        """Return up to `limit` newest message ids for a user.
+
+        `before` is a (score, message_id) position to start after.
+        """
+
+        timeline = self.timelines.get(user_id, [])
+        if before is not None:
+            timeline = [entry for entry in timeline if entry < before]
+        return [message_id for score, message_id in timeline[:limit]]
+
+    def count(self, user_id):
+        return len(self.timelines.get(user_id, []))
+
+    def mark_celebrity(self, user_id):
+        self.celebrities.add(user_id)
+
+    def unmark_celebrity(self, user_id):
+        self.celebrities.discard(user_id)
+
+    def celebrity_ids(self):
+        return set(self.celebrities)
+
+    def clear(self, user_id=None):
+        if user_id is None:
+            self.timelines.clear()
+            self.warmed.clear()
+            self.celebrities.clear()
+        else:
+            self.timelines.pop(user_id, None)
+            self.warmed.pop(user_id, None)
+
+
+class RedisTimelineStore:
+    """Timeline store backed by Redis sorted sets.
+
+    `client` is anything with the redis-py API (redis.Redis, fakeredis).
+    """
+
+    def __init__(self, client, size=TIMELINE_SIZE, prefix="timeline:"):
+        self.client = client
+        self.size = size
+        self.prefix = prefix
+
+    def _key(self, user_id):
+        return f"{self.prefix}{user_id}"
+
+    def exists(self, user_id):
+        # an empty sorted set does not exist in Redis, so warm timelines
+        # are tracked in their own set
+        return bool(self.client.sismember(f"{self.prefix}warm", user_id))
+
+    def add(self, user_id, entries):
+        entries = list(entries)
+        key = self._key(user_id)
+        pipe = self.client.pipeline()
+        if entries:
+            pipe.zadd(key, {message_id: score for score, message_id in entries})
+            pipe.zremrangebyrank(key, 0, -(self.size + 1))
+        pipe.sadd(f"{self.prefix}warm", user_id)
+        pipe.execute()
+
+    def remove(self, user_id, message_ids):
+        message_ids = list(message_ids)
+        if message_ids:
+            self.client.zrem(self._key(user_id), *message_ids)
+
+    def push(self, user_ids, entries):
+        """Add `entries` to those of `user_ids`' timelines that are warm.
+
+        Two round trips however many users: one to check which are warm,
+        one to add and trim.
+        """
+
+        user_ids = list(user_ids)
+        mapping = {message_id: score for score, message_id in entries}
+        if not user_ids or not mapping:
+            return
+
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.sismember(f"{self.prefix}warm", user_id)
+        warm = [user_id for user_id, is_warm in zip(user_ids, pipe.execute()) if is_warm]
+
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in warm:
+            key = self._key(user_id)
+            pipe.zadd(key, mapping)
+            pipe.zremrangebyrank(key, 0, -(self.size + 1))
+        pipe.execute()
+
+    def retract(self, user_ids, message_ids):
+        """Remove `message_ids` from all of `user_ids`' timelines in one round trip."""
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zrem(self._key(user_id), *message_ids)
+        pipe.execute()
+
+    def ids(self, user_id, limit, before=None):
+        key = self._key(user_id)
+        if before is None:
+            return [int(message_id) for message_id in self.client.zrevrange(key, 0, limit - 1)]
+
+        score, last_id = before
+        # entries sharing the cursor's score are filtered here by id
+        ties = self.client.zcount(key, score, score)
+        entries = self.client.zrevrangebyscore(key, score, "-inf", start=0,
+                                               num=limit + ties, withscores=True)
+        return [int(message_id) for message_id, entry_score in entries
+                if (entry_score, int(message_id)) < (score, last_id)][:limit]
+
+    def count(self, user_id):
+        return self.client.zcard(self._key(user_id))
+
+    def mark_celebrity(self, user_id):
+        self.client.sadd(f"{self.prefix}celebrities", user_id)
+
+    def unmark_celebrity(self, user_id):
+        self.client.srem(f"{self.prefix}celebrities", user_id)
+
+    def celebrity_ids(self):
+        return {int(user_id) for user_id in self.client.smembers(f"{self.prefix}celebrities")}
+
+    def clear(self, user_id=None):
+        if user_id is None:
+            keys = list(self.client.scan_iter(f"{self.prefix}*"))
+            if keys:
+                self.client.delete(*keys)
+        else:
+            self.client.delete(self._key(user_id))
+            self.client.srem(f"{self.prefix}warm", user_id)
+
+
+class Timelines:
+    """Fan-out logic on top of a pluggable timeline store."""
+
+    def __init__(self, store=None):
+        self.store = store or MemoryTimelineStore()
+        self.max_followers = FANOUT_MAX_FOLLOWERS
+
+    def init_app(self, app):
+        """Pick the backend from the app config.
+
+        TIMELINE_REDIS_URL selects Redis, otherwise timelines live in
+        memory for TIMELINE_MEMORY_TTL seconds, for at most
+        TIMELINE_MEMORY_MAX_USERS users.
+        """
+
+        size = app.config.setdefault('TIMELINE_SIZE', TIMELINE_SIZE)
+        self.max_followers = app.config.setdefault(
+            'TIMELINE_FANOUT_MAX_FOLLOWERS', FANOUT_MAX_FOLLOWERS)
+        redis_url = app.config.get('TIMELINE_REDIS_URL')
+
+        if redis_url:
+            import redis
+            self.store = RedisTimelineStore(redis.Redis.from_url(redis_url), size=size)
+        else:
+            self.store = MemoryTimelineStore(
+                size=size, ttl=app.config.setdefault('TIMELINE_MEMORY_TTL', MEMORY_TTL),
+                max_users=app.config.setdefault('TIMELINE_MEMORY_MAX_USERS', MEMORY_MAX_USERS))
+
+    def _following_ids(self, user_id):
+        return [followed_id for (followed_id,) in (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id))]
+
+    def _recent(self, author_ids, limit):
+        """(timestamp, id) of recent messages of `author_ids`, for filling timelines."""
+
+        if not author_ids:
+            return []
+        return newest_page(db.session
+                           .query(Message.timestamp, Message.id)
+                           .filter(Message.user_id.in_(author_ids),
+                                   Message.deleted_at.is_(None)),
+                           limit, recent=partitions.recent)
+
+    def rebuild(self, user_id):
+        """Fill a cold timeline from the database."""
+
+        messages = self._recent(self._following_ids(user_id), self.store.size)
+        self.store.add(user_id, [(_score(msg), msg.id) for msg in messages])
+
+    def _fanout_targets(self, author_id):
+        """Follower ids of `author_id`, or None if they have too many to fan out to.
+
+        Decided from the author's followers_count, so the followers of a
+        big account are never loaded; the query is capped as well in case
+        the counter has drifted.
+        """
+
+        followers = (db.session.query(User.followers_count)
+                     .filter(User.id == author_id).scalar()) or 0
+        if followers > self.max_followers:
+            return None
+
+        follower_ids = [follower_id for (follower_id,) in (db.session
+                        .query(Follows.user_following_id)
+                        .filter(Follows.user_being_followed_id == author_id)
+                        .limit(self.max_followers + 1))]
+        if len(follower_ids) > self.max_followers:
+            return None
+        return follower_ids
+
+    def fanout(self, msg):
+        """Push a freshly committed message onto its author's followers' timelines.
+
+        An author pulled at read time who has since dropped back to
+        max_followers is fanned out to again, starting with their recent
+        messages, which were never pushed.
+        """
+
+        follower_ids = self._fanout_targets(msg.user_id)
+        if follower_ids is None:
+            # too expensive to push; followers pull these at read time
+            self.store.mark_celebrity(msg.user_id)
+            return
+
+        entries = [(_score(msg), msg.id)]
+        if msg.user_id in self.store.celebrity_ids():
+            self.store.unmark_celebrity(msg.user_id)
+            entries.extend((_score(recent), recent.id)
+                           for recent in self._recent([msg.user_id], self.store.size)
+                           if recent.id != msg.id)
+
+        # cold timelines are rebuilt from the database on first read
+        self.store.push(follower_ids, entries)
+
+    def retract(self, msg):
+        """Take a deleted message off the timelines it was pushed onto.
+
+        Messages that disappear otherwise (purged accounts, archival) are
+        pruned when a timeline is read, see home().
+        """
+
+        follower_ids = self._fanout_targets(msg.user_id)
+        if follower_ids:
+            self.store.retract(follower_ids, [msg.id])
+
+    def follow(self, user_id, followed_id):
+        """Backfill `user_id`'s timeline with the new followee's messages."""
+
+        if not self.store.exists(user_id) or followed_id in self.store.celebrity_ids():
+            return
+        messages = self._recent([followed_id], self.store.size)
+        self.store.add(user_id, [(_score(msg), msg.id) for msg in messages])
+
+    def unfollow(self, user_id, followed_id):
+        """Prune the unfollowed user's messages from `user_id`'s timeline."""
+
+        if not self.store.exists(user_id):
+            return
+        ids = self.store.ids(user_id, self.store.size)
+        if not ids:
+            return
+        pruned = [message_id for (message_id,) in (db.session
+                  .query(Message.id)
+                  .filter(Message.id.in_(ids), Message.user_id == followed_id))]
+        self.store.remove(user_id, pruned)
+
+    def head(self, user_id, limit):
+        """Ids that can make up the newest `limit` entries of a timeline.
+
+        The ids at the top of the stored timeline plus, if any followed
+        author is pulled at read time, the ids of their newest messages.
+        """
+
+        if not self.store.exists(user_id):
+            self.rebuild(user_id)
+
+        pulled = ()
+        celebrities = self.store.celebrity_ids()
+        if celebrities:
+            followed = set(self._following_ids(user_id)) & celebrities
+            pulled = tuple(msg.id for msg in feed.by_authors(followed, limit))
+
+        return tuple(self.store.ids(user_id, limit)), pulled
+
+    def _hydrate(self, user_id, limit, position):
+        """Up to `limit` messages from the stored timeline, after `position`.
+
+        Ids whose message is gone (deleted, archived, or its author
+        deleted) are pruned from the store and more are read in their
+        place, so a page only comes back short at the end of the stored
+        timeline. Returns (messages, whether the store ran out).
+        """
+
+        messages = []
+        while len(messages) < limit:
+            wanted = limit - len(messages)
+            ids = self.store.ids(user_id, wanted, position)
+            found = feed.by_ids(ids)
+            missing = set(ids) - {msg.id for msg in found}
+            if missing:
+                # a lagging replica may just not have the newest ones yet
+                with replicas.primary():
+                    found.extend(feed.by_ids(missing))
+                missing -= {msg.id for msg in found}
+                self.store.remove(user_id, missing)
+
+            messages.extend(found)
+            if len(ids) < wanted:
+                return messages, True
+            if found:
+                last = min(found, key=lambda msg: (msg.timestamp, msg.id))
+                position = (_score(last), last.id)
+        return messages, False
+
+    def home(self, user_id, limit=100, before=None):
+        """Newest `limit` messages for `user_id`'s homepage.
+
+        `before` is a (timestamp, message_id) cursor from pagination.
+        """
+
+        if not self.store.exists(user_id):
+            self.rebuild(user_id)
+        capped = self.store.count(user_id) >= self.store.size
+
+        messages, exhausted = self._hydrate(user_id, limit, _position(before))
+        seen = {msg.id for msg in messages}
+
+        following = None
+        if exhausted and capped:
+            # paged past the capped timeline: read older messages from the db
+            following = self._following_ids(user_id)
+            older = feed.by_authors(following, limit, before)
+            messages.extend(msg for msg in older if msg.id not in seen)
+            seen.update(msg.id for msg in older)
+
+        celebrities = self.store.celebrity_ids()
+        if celebrities:
+            if following is None:
+                following = self._following_ids(user_id)
+            pulled = feed.by_authors(set(following) & celebrities, limit, before)
+            messages.extend(msg for msg in pulled if msg.id not in seen)
+
+        messages.sort(key=lambda msg: (msg.timestamp, msg.id), reverse=True)
+        return messages[:limit]
+
+
+timelines = Timelines()